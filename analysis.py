@@ -0,0 +1,280 @@
+import chat_history
+import config
+import context_cache
+import figures
+import file_lifecycle
+import gemini_logic
+import ingest
+import jobs
+import map_reduce
+import metrics
+import prompts
+import response_cache
+import retrieval
+import scheduler
+from google.genai import errors
+
+# 分析・チャット応答の処理本体 (jobs のワーカースレッドで実行する)
+# ワーカーからはStreamlitの描画をせず、進捗・出力・警告はすべて job に書き込む
+
+# 応答が途中で途切れた場合に、最初からやり直す回数
+# (送信開始時の混雑 (429/503) は gemini_logic がスケジューラに従って再試行するので、ここでは数えない)
+MAX_STREAM_RESTARTS = 2
+
+
+def _pump(job, stream):
+    """ストリームの出力をジョブのバッファに流し込み、全文を返す"""
+    try:
+        for text in stream:
+            job.write(text)
+    finally:
+        # 取り消し・エラーで途中終了した場合もスケジューラの枠を返す
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    return job.text
+
+
+def run_analysis(job, client, uploaded_files, target_prompt, prepare_followups=True):
+    """
+    ファイルの取り込みから初回分析のストリーミングまでを行う。
+
+    Args:
+        uploaded_files: UploadedFile と同じく name と getvalue() を持つオブジェクトのリスト
+        prepare_followups: Falseなら追加質問用の準備 (数値・検索の索引、コンテキストキャッシュ) を省く
+            (一括処理など、追加質問をしない場合)
+
+    結果は job.result に書き込む:
+        uploaded_names: 今回アップロードしたGemini上のファイル名 (取り込み直後に書き込む)
+        request_reports: ヘッジの内訳
+        chat, used_model, text: 分析結果 (成功時)
+        context: 追加質問で使う資料のコンテキストキャッシュ (成功時)
+        figure_index: HTMLの表から作った財務数値の索引 (表が無ければNone)
+        retrieval_index: 追加質問で関連箇所を探す検索索引 (本文の無い資料があればNone)
+    """
+    job.result["uploaded_names"] = []
+    job.result["request_reports"] = []
+
+    # ファイルの取り込み (PDFアップロードとHTML解析を並列に実行)
+    job.set_progress(0.0, "ファイルを読み込んでいます...")
+
+    def show_progress(done, total, display_name):
+        job.set_progress(done / total, f"読み込み完了: {display_name} ({done}/{total})")
+
+    try:
+        documents, uploaded_names = ingest.ingest_files(client, uploaded_files, show_progress, job.owner)
+    except ingest.IngestError as e:
+        raise jobs.JobError(f"ファイル処理エラー: {e}")
+    job.result["uploaded_names"] = uploaded_names
+    if job.cancel_requested:
+        # リセット済みのセッションは台帳を見直さないので、ここで片付ける
+        file_lifecycle.release(client, job.owner)
+        raise jobs.JobCancelled()
+    if not documents:
+        raise jobs.JobError("解析に失敗しました。")
+
+    # 数値の質問にLLMを使わず答えられるよう、表の数値を索引にしておく
+    job.result["figure_index"] = figures.FigureIndex.from_documents(documents) if prepare_followups else None
+
+    # 同じ資料・プロンプトの分析結果があれば、APIを呼ばずに再生する
+    cache_key = response_cache.make_key(
+        [d["sha256"] for d in documents],
+        target_prompt,
+        prompts.SYSTEM_INSTRUCTION
+    )
+    cached_response = response_cache.get(cache_key)
+    if cached_response and cached_response["used_model"] != config.PRIMARY_MODEL:
+        # 以前に保存されたFallbackモデルの回答は使わない
+        cached_response = None
+
+    for attempt in range(MAX_STREAM_RESTARTS + 1):
+        job.check_cancelled()
+        if attempt:
+            job.restart_output()
+        try:
+            if cached_response:
+                used_model = cached_response["used_model"]
+                chat = gemini_logic.restore_chat_session(
+                    client,
+                    used_model,
+                    prompts.SYSTEM_INSTRUCTION,
+                    map_reduce.document_contents(documents),
+                    target_prompt,
+                    cached_response["text"]
+                )
+                response_stream = response_cache.replay_stream(cached_response["text"])
+            else:
+                # どのモデルが応答したか (ヘッジの効果) を記録する
+                request_report = {}
+                job.result["request_reports"].append(request_report)
+
+                def show_map_progress(done, total):
+                    job.set_progress(done / total, f"資料が大きいため分割して要約しています... ({done}/{total})")
+
+                # 見積もりトークン数に応じて一括送信と分割要約を自動で切り替える
+                job.set_progress(None, "AIが解析中です...")
+                chat, response_stream, used_model = map_reduce.send_analysis_stream(
+                    client,
+                    documents,
+                    target_prompt,
+                    prompts.SYSTEM_INSTRUCTION,
+                    on_progress=show_map_progress,
+                    report=request_report,
+                    notify=job.notify
+                )
+        except (errors.ClientError, errors.ServerError) as e:
+            # 混雑 (429/503) は送信側で再試行済みなので、ここでは繰り返さない
+            if not scheduler.is_retryable_error(e):
+                raise jobs.JobError(f"APIエラーにより解析を完了できませんでした: {e}") from e
+            raise jobs.JobError(f"エラーにより解析を完了できませんでした: {e}") from e
+
+        try:
+            full_response_text = _pump(job, response_stream)
+        except (errors.ClientError, errors.ServerError) as e:
+            # 応答の途中で途切れた場合は、最初からやり直す (待ち時間は送信側の再試行に任せる)
+            if not scheduler.is_retryable_error(e):
+                raise jobs.JobError(f"APIエラーにより解析を完了できませんでした: {e}") from e
+            if attempt == MAX_STREAM_RESTARTS:
+                raise jobs.JobError(f"エラーにより解析を完了できませんでした: {e}") from e
+            job.notify(f"応答が途中で途切れました。最初からやり直します... ({attempt+1}/{MAX_STREAM_RESTARTS})")
+            continue
+
+        # キーはPrimaryモデルのものなので、混雑時にFallbackモデルが答えた回答は保存しない
+        # (保存すると、Primaryが復旧した後も期限までFallbackの回答を再生し続けてしまう)
+        if not cached_response and used_model == config.PRIMARY_MODEL:
+            response_cache.put(cache_key, full_response_text, used_model)
+
+        # 追加質問では関連箇所だけを送れるよう、本文の検索索引を作る
+        retrieval_index = None
+        if prepare_followups and config.RETRIEVAL_ENABLED:
+            retrieval_index = retrieval.RetrievalIndex.from_documents(documents)
+
+        # 検索を使えない資料の場合は、追加質問で資料を送り直さないよう、
+        # 応答したモデル用のキャッシュを先に作っておく (検索を使う場合も必要になった時点で作る)
+        context = context_cache.SessionContext.from_chat(chat, prompts.SYSTEM_INSTRUCTION)
+        if prepare_followups and retrieval_index is None:
+            context.cache_name(client, used_model)
+        job.result.update({
+            "chat": chat,
+            "used_model": used_model,
+            "text": full_response_text,
+            "context": context,
+            "retrieval_index": retrieval_index
+        })
+        return
+
+
+def run_chat(job, client, chat, current_model, prompt, full_history_tokens=None, context=None, retrieval_index=None):
+    """
+    チャットの追加質問に応答する。1回目は既存のセッションで、混雑時は新しいセッションで再試行する。
+    検索索引がある場合は、資料全体の代わりに質問に関連する抜粋だけを添付して送る。
+    会話が長くなっている場合は、送る前に古い会話を要約して履歴を圧縮する。
+
+    Args:
+        full_history_tokens: 圧縮しなかった場合の会話部分のトークン数 (前回の history_report["full_tokens"])
+        context: 資料のコンテキストキャッシュ (run_analysis の結果)。Noneなら資料を履歴に含めて送る
+        retrieval_index: 資料の検索索引 (run_analysis の結果)
+
+    結果は job.result に書き込む:
+        request_reports: ヘッジの内訳
+        history_report: 履歴圧縮の内訳 (chat_history.prepare_chat の report。full_tokens は今回の往復を含む)
+        retrieval_report: 添付した抜粋の内訳 (検索を使った場合)
+        chat, used_model, text: 応答 (成功時。chat は圧縮・再試行で作り直したセッションの場合がある)
+    """
+    job.result["request_reports"] = []
+
+    extra_content = []
+    passages = retrieval_index.search(prompt) if retrieval_index is not None else []
+    if passages:
+        # 抜粋を添付するので、履歴からは資料 (と以前の抜粋) を外し、キャッシュも参照しない
+        history = chat.get_history(curated=True)
+        stripped = chat_history.strip_documents(history, retrieval.HISTORY_PLACEHOLDER)
+        if stripped is not history:
+            chat = gemini_logic.create_chat_session(client, current_model, prompts.SYSTEM_INSTRUCTION, stripped)
+        context = None
+        extra_content = [retrieval.format_passages(passages)]
+        passage_tokens = map_reduce.estimate_tokens(extra_content[0])
+        job.result["retrieval_report"] = {
+            "passages": len(passages),
+            "passage_tokens": passage_tokens,
+            "document_tokens": retrieval_index.document_tokens,
+        }
+        metrics.observe("retrieval_passage_tokens", passage_tokens)
+
+    current_chat, history_report = chat_history.prepare_chat(
+        client, chat, current_model, full_history_tokens, context
+    )
+    job.result["history_report"] = history_report
+    used_model = current_model
+
+    # 1回目は既存のセッションで送り、混雑していれば新しいセッション (ヘッジ・Fallback付き) で送り直す
+    use_existing_session = True
+
+    for attempt in range(MAX_STREAM_RESTARTS + 1):
+        job.check_cancelled()
+        if attempt:
+            job.restart_output()
+        try:
+            clean_stream = None
+            if use_existing_session:
+                use_existing_session = False
+                try:
+                    # スケジューラ経由で送信し、クリーニング用ジェネレータでラップしたものを受け取る
+                    clean_stream = gemini_logic.send_chat_message_stream(
+                        current_chat, extra_content + [prompt] if extra_content else prompt, current_model
+                    )
+                except (errors.ClientError, errors.ServerError) as e:
+                    if not scheduler.is_retryable_error(e):
+                        raise
+                    job.notify("混雑しています。バックアップ回線で再接続中...")
+
+            if clean_stream is None:
+                # 待ち時間・再試行の回数は送信側 (スケジューラ) に任せる
+                old_history = current_chat.get_history(curated=True)
+                request_report = {}
+                job.result["request_reports"].append(request_report)
+                new_chat, new_stream, new_model = gemini_logic.send_message_stream_hedged(
+                    client,
+                    content=extra_content,
+                    prompt=prompt,
+                    system_instruction=prompts.SYSTEM_INSTRUCTION,
+                    previous_history=old_history,
+                    report=request_report,
+                    context=context,
+                    notify=job.notify
+                )
+                current_chat = new_chat
+                used_model = new_model
+                clean_stream = new_stream
+
+        except (errors.ClientError, errors.ServerError) as e:
+            # 429/503は送信側で再試行し尽くした結果なので、ここでは繰り返さない
+            if scheduler.is_retryable_error(e):
+                raise jobs.JobError(f"申し訳ありません、サーバーが大変混雑しており応答できませんでした。しばらく待ってから再度お試しください。({e})")
+            # その他のAPIエラーは即終了
+            raise jobs.JobError(f"APIエラー: {e}")
+
+        try:
+            full_response_text = _pump(job, clean_stream)
+        except jobs.JobCancelled:
+            raise
+        except (errors.ClientError, errors.ServerError) as e:
+            if not scheduler.is_retryable_error(e):
+                raise jobs.JobError(f"APIエラー: {e}")
+            if attempt == MAX_STREAM_RESTARTS:
+                raise jobs.JobError(f"申し訳ありません、サーバーが大変混雑しており応答できませんでした。しばらく待ってから再度お試しください。({e})")
+            # 応答が途中で途切れた場合は、新しいセッションで最初からやり直す
+            job.notify(f"応答が途中で途切れました。バックアップ回線で再接続中... ({attempt+1}/{MAX_STREAM_RESTARTS})")
+            continue
+        except Exception as e:
+            if attempt == MAX_STREAM_RESTARTS:
+                raise jobs.JobError(f"予期せぬエラー: {e}")
+            # それ以外 (接続の切断など) も新しいセッションでやり直す
+            continue
+
+        history_report["full_tokens"] += (
+            map_reduce.estimate_tokens(prompt)
+            + map_reduce.estimate_tokens(full_response_text)
+        )
+        job.result.update({"chat": current_chat, "used_model": used_model, "text": full_response_text})
+        return
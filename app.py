@@ -1,13 +1,19 @@
 import streamlit as st
+import hashlib
 import time
-import os
 import uuid
+import config
+import file_lifecycle
 import prompts
 import utils
-import gemini_logic
+import jobs
+import metrics
+import stream_render
 import help
 import update_history
-from google.genai import errors
+
+# analysis / gemini_logic は google.genai や pandas などの重いライブラリを読み込むため、
+# 分析・チャット・削除を始める時点で import する (使い方・更新履歴のページはAPI関連を読み込まずに表示する)
 
 # ページ設定
 st.set_page_config(
@@ -19,10 +25,21 @@ st.set_page_config(
 # 日本語設定ハック
 utils.setup_japanese_language()
 
+# 計測用エンドポイント (FSBOT_METRICS_SINK に prometheus を指定した場合のみ起動)
+metrics.start_server()
+
+# 異常終了などで残ったアップロード用の一時ファイルを定期的に削除する
+utils.start_temp_janitor()
+
 st.title("決算書まとめBot v0.3.3β")
 
-# クライアント取得
-client = gemini_logic.get_gemini_client()
+def get_client():
+    """Geminiクライアントを返す (APIを使う処理を始める時点で初めて作る)"""
+    import gemini_logic
+    client = gemini_logic.get_gemini_client()
+    # 閉じたタブなどで持ち主のいなくなったファイルを、バックグラウンドで定期的に削除する
+    file_lifecycle.start_sweeper(client)
+    return client
 
 if "current_page" not in st.session_state:
     st.session_state.current_page = "main"
@@ -54,10 +71,17 @@ with st.sidebar:
         col1, col2 = st.columns(2)
         with col1:
             if st.button("削除"):
-                # クラウド上のファイルを削除
-                if st.session_state.get("uploaded_gemini_file_names"):
-                    gemini_logic.delete_files_from_gemini(client, st.session_state.uploaded_gemini_file_names)
-                    st.sidebar.success("クラウド上のファイルを全て削除しました")
+                # 実行中のジョブを止める (取り込み中のジョブは、止まった時点で自分のファイルを片付ける)
+                session_id = st.session_state.get("session_id")
+                jobs.get_manager().cancel_owner(session_id)
+
+                # クラウド上のファイルを削除 (他のセッションでも使っているファイルは残す)
+                if session_id and file_lifecycle.owned_files(session_id):
+                    file_lifecycle.release(get_client(), session_id)
+
+                # 資料のコンテキストキャッシュを削除
+                if st.session_state.get("document_context"):
+                    st.session_state.document_context.release(get_client())
                 
                 # セッション初期化 (current_pageは維持するか、mainに戻すか。ここではmainに戻す)
                 for key in list(st.session_state.keys()):
@@ -82,17 +106,72 @@ if "summary_done" not in st.session_state:
     st.session_state.summary_done = False
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "uploaded_gemini_file_names" not in st.session_state:
-    st.session_state.uploaded_gemini_file_names = []
 if "analysis_mode" not in st.session_state:
     st.session_state.analysis_mode = None 
+# 追加質問ごとの履歴圧縮の内訳 (削減した入力トークン数など)
+if "history_reports" not in st.session_state:
+    st.session_state.history_reports = []
 if "uploader_key" not in st.session_state:
     st.session_state.uploader_key = str(uuid.uuid4())
+# バックグラウンドジョブの持ち主としてのID (リセットすると変わる)
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
+# 使用中のファイルが掃除されないよう、このセッションが生きていることを定期的に記録する
+if time.time() - st.session_state.get("files_touched_at", 0) >= config.FILE_TOUCH_INTERVAL_SECONDS:
+    file_lifecycle.touch(st.session_state.session_id)
+    st.session_state.files_touched_at = time.time()
+if "analysis_job_id" not in st.session_state:
+    st.session_state.analysis_job_id = None
+if "chat_job_id" not in st.session_state:
+    st.session_state.chat_job_id = None
 
 # コールバック関数
 def set_analysis_mode(mode):
     st.session_state.analysis_mode = mode
 
+def get_job(state_key):
+    """セッションに記録したIDのジョブを返す (保持期間切れなどで見つからなければIDを消す)"""
+    job_id = st.session_state.get(state_key)
+    if job_id is None:
+        return None
+    job = jobs.get_manager().get(job_id)
+    if job is None:
+        st.session_state[state_key] = None
+    return job
+
+def follow_job(job, spinner_text):
+    """
+    バックグラウンドジョブの進捗と出力を表示し、ジョブが終わるまで待つ。
+    再実行で表示が中断されても、次の実行で出力バッファの先頭から表示し直す。
+    """
+    with st.spinner(spinner_text):
+        progress_area = st.empty()
+        version = -1
+        while not job.finished and not job.chunks:
+            if job.progress and job.progress[0] is not None:
+                progress_area.progress(job.progress[0], text=job.progress[1])
+            elif job.progress:
+                progress_area.caption(job.progress[1])
+            elif job.status == jobs.QUEUED:
+                progress_area.caption("混み合っているため順番待ちです...")
+            version = job.wait(version, timeout=0.5)
+        progress_area.empty()
+
+    for notice in job.notices:
+        st.warning(notice)
+
+    if job.chunks or not job.finished:
+        with st.chat_message("assistant"):
+            output_area = st.empty()
+            # 再試行で出力がやり直しになったら、同じ場所に表示し直す
+            # chunkはまとめてから表示する (表示回数を減らし、書きかけの表をちらつかせない)
+            while True:
+                stream_render.render_stream(
+                    output_area, job.tail(heartbeat=config.STREAM_RENDER_WINDOW_SECONDS)
+                )
+                if job.finished:
+                    break
+
 # --- メインロジック ---
 
 # --- メインロジック ---
@@ -133,74 +212,41 @@ if st.session_state.current_page == "main":
                     target_prompt = prompts.PROMPT_COMPANY_COMPARISON
 
         # --- 分析実行フロー ---
-        if should_process and target_prompt:
-            with st.spinner("AIが解析中です..."):
-                
-                contents_to_send = []
-                
-                for u_file in uploaded_files:
-                    # ユーティリティでファイルを処理
-                    processed_data = utils.process_uploaded_file(u_file)
-                    
-                    if processed_data:
-                        if processed_data["type"] == "pdf":
-                            # PDFはアップロードが必要
-                             try:
-                                uploaded_gemini_file = gemini_logic.upload_file_to_gemini(
-                                    client, 
-                                    processed_data["content"], # ここはファイルパス
-                                    processed_data["display_name"]
-                                )
-                                contents_to_send.append(uploaded_gemini_file)
-                                st.session_state.uploaded_gemini_file_names.append(uploaded_gemini_file.name)
-                             finally:
-                                 # 一時ファイル削除
-                                 if processed_data["tmp_path"] and os.path.exists(processed_data["tmp_path"]):
-                                     os.remove(processed_data["tmp_path"])
-
-                        elif processed_data["type"] == "html":
-                            # HTMLテキストはヘッダーをつけて追加
-                            clean_text = f"--- File: {processed_data['display_name']} ---\n{processed_data['content']}"
-                            contents_to_send.append(clean_text)
-                
-                if contents_to_send:
-                    # リトライループ (最大3回)
-                    max_retries = 3
-                    for attempt in range(max_retries):
-                        try:
-                            # API呼び出し (ストリーミング)
-                            chat, response_stream, used_model = gemini_logic.send_message_stream_with_fallback(
-                                client,
-                                contents_to_send,
-                                target_prompt,
-                                prompts.SYSTEM_INSTRUCTION
-                            )
-                            
-                            if chat and response_stream:
-                                st.session_state.chat_session = chat
-                                st.session_state.current_model = used_model
-                                
-                                # ストリーミング表示
-                                with st.chat_message("assistant"):
-                                    # st.write_stream はジェネレータを受け取り、完了後に全テキストを返す
-                                    # gemini_logic側でテキスト抽出とクリーニングを行っているのでそのまま渡す
-                                    full_response_text = st.write_stream(response_stream)
-                                
-                                # 履歴保存
-                                st.session_state.messages.append({"role": "assistant", "content": full_response_text})
-                                st.session_state.summary_done = True
-                                st.rerun()
-                                break # 成功したらループを抜ける
-                            else:
-                                if attempt == max_retries - 1:
-                                    st.error("解析に失敗しました。")
-                        
-                        except (errors.ClientError, errors.ServerError) as e:
-                            if attempt < max_retries - 1:
-                                st.warning(f"通信エラーが発生しました。再試行します... ({attempt+1}/{max_retries})")
-                                time.sleep(2)
-                            else:
-                                st.error(f"エラーにより解析を完了できませんでした: {e}")
+        # 分析はバックグラウンドのジョブで実行し、画面はその出力を追いかけて表示する
+        # 同じファイル・プロンプトのジョブが既にあれば、新しく実行せずにそれを表示する
+        if should_process and target_prompt and st.session_state.analysis_job_id is None:
+            import analysis
+            client = get_client()
+            files = list(uploaded_files)
+            # ジョブの重複判定に使うため、取り込み (ジョブの中) より前にここで計算する。
+            # getbuffer は解放するまでファイルを書き換えられない参照が残るので、getvalue を使う
+            file_hashes = [hashlib.sha256(f.getvalue()).hexdigest() for f in files]
+            job = jobs.get_manager().submit(
+                "analysis",
+                file_hashes + [target_prompt],
+                lambda job: analysis.run_analysis(job, client, files, target_prompt),
+                owner=st.session_state.session_id
+            )
+            st.session_state.analysis_job_id = job.job_id
+
+    # 実行中 (または前回の実行中に終わった) 分析ジョブの表示
+    analysis_job = get_job("analysis_job_id")
+    if analysis_job:
+        follow_job(analysis_job, "AIが解析中です...")
+        st.session_state.analysis_job_id = None
+
+        if analysis_job.status == jobs.DONE:
+            st.session_state.chat_session = analysis_job.result["chat"]
+            st.session_state.current_model = analysis_job.result["used_model"]
+            st.session_state.document_context = analysis_job.result["context"]
+            st.session_state.figure_index = analysis_job.result["figure_index"]
+            st.session_state.retrieval_index = analysis_job.result["retrieval_index"]
+            # 履歴保存
+            st.session_state.messages.append({"role": "assistant", "content": analysis_job.result["text"]})
+            st.session_state.summary_done = True
+            st.rerun()
+        elif analysis_job.status == jobs.FAILED:
+            st.error(analysis_job.error)
 
     # --- チャットインターフェース ---
     for message in st.session_state.messages:
@@ -215,66 +261,58 @@ if st.session_state.current_page == "main":
             with st.chat_message("user"):
                 st.markdown(prompt)
 
-            with st.spinner("思考中..."):
-                try:
-                    current_chat = st.session_state.chat_session
-                    max_retries = 3
-                    
-                    for attempt in range(max_retries):
-                        try:
-                            response_stream = None
-                            
-                            # 1回目は既存のセッションで試行
-                            if attempt == 0:
-                                response_stream = current_chat.send_message_stream(prompt)
-                                # 生のイテレータをクリーニング用ジェネレータでラップ
-                                clean_stream = gemini_logic.clean_stream_generator(response_stream)
-                            
-                            # 2回目以降（リトライ）は新しいセッションを作り直す
-                            else:
-                                st.warning(f"混雑しています。バックアップ回線で再接続中... ({attempt}/{max_retries-1})")
-                                time.sleep(2)
-                                
-                                old_history = current_chat.history
-                                new_chat, new_stream, used_model = gemini_logic.send_message_stream_with_fallback(
-                                    client,
-                                    content=[], 
-                                    prompt=prompt,
-                                    system_instruction=prompts.SYSTEM_INSTRUCTION,
-                                    previous_history=old_history
-                                )
-                                
-                                if new_chat and new_stream:
-                                    st.session_state.chat_session = new_chat
-                                    st.session_state.current_model = used_model
-                                    current_chat = new_chat # ループ内での参照用
-                                    clean_stream = new_stream # これは既にクリーニング済み（fallback関数戻り値）
-                                else:
-                                    raise Exception("Retry session creation failed")
-
-                            with st.chat_message("assistant"):
-                                full_response_text = st.write_stream(clean_stream)
-                            
-                            st.session_state.messages.append({"role": "assistant", "content": full_response_text})
-                            break # 成功終了
-
-                        except (errors.ClientError, errors.ServerError) as e:
-                            # 429/503はリトライ対象
-                            if e.code in [429, 503] or "429" in str(e) or "503" in str(e):
-                                if attempt == max_retries - 1:
-                                    st.error(f"申し訳ありません、サーバーが大変混雑しており応答できませんでした。しばらく待ってから再度お試しください。({e})")
-                            else:
-                                # その他のAPIエラーは即終了
-                                st.error(f"APIエラー: {e}")
-                                break
-                                
-                        except Exception as e:
-                             if attempt == max_retries - 1:
-                                st.error(f"予期せぬエラー: {e}")
-                             # それ以外はリトライ続行
-
-                except Exception as e:
-                    st.error(f"システムエラー: {e}")
+            # 表の数値で答えられる質問は、LLMを使わずに索引から回答する
+            local_answer = None
+            if config.LOCAL_ANSWER_ENABLED and st.session_state.get("figure_index") is not None:
+                local_answer = st.session_state.figure_index.answer(prompt)
+            if local_answer:
+                with st.chat_message("assistant"):
+                    st.markdown(local_answer)
+                st.session_state.messages.append({"role": "assistant", "content": local_answer})
+            else:
+                # 応答はバックグラウンドのジョブで生成する
+                import analysis
+                client = get_client()
+                chat = st.session_state.chat_session
+                current_model = st.session_state.get("current_model", config.PRIMARY_MODEL)
+                full_history_tokens = st.session_state.get("history_full_tokens")
+                document_context = st.session_state.get("document_context")
+                retrieval_index = st.session_state.get("retrieval_index")
+                job = jobs.get_manager().submit(
+                    "chat",
+                    [len(st.session_state.messages), prompt],
+                    lambda job: analysis.run_chat(
+                        job, client, chat, current_model, prompt, full_history_tokens, document_context,
+                        retrieval_index
+                    ),
+                    owner=st.session_state.session_id
+                )
+                st.session_state.chat_job_id = job.job_id
+
+    # 実行中 (または前回の実行中に終わった) チャット応答の表示
+    chat_job = get_job("chat_job_id")
+    if chat_job:
+        follow_job(chat_job, "思考中...")
+        st.session_state.chat_job_id = None
+
+        if chat_job.status == jobs.DONE:
+            st.session_state.chat_session = chat_job.result["chat"]
+            st.session_state.current_model = chat_job.result["used_model"]
+            st.session_state.messages.append({"role": "assistant", "content": chat_job.result["text"]})
+
+            history_report = chat_job.result["history_report"]
+            st.session_state.history_full_tokens = history_report["full_tokens"]
+            st.session_state.history_reports.append(history_report)
+            if history_report["saved_tokens"]:
+                st.caption(f"会話履歴を要約して、入力を約{history_report['saved_tokens']:,}トークン削減しました。")
+            retrieval_report = chat_job.result.get("retrieval_report")
+            if retrieval_report:
+                st.caption(
+                    f"資料全体 (約{retrieval_report['document_tokens']:,}トークン) の代わりに、"
+                    f"関連する抜粋{retrieval_report['passages']}件 (約{retrieval_report['passage_tokens']:,}トークン) を送りました。"
+                )
+        elif chat_job.status == jobs.FAILED:
+            st.error(chat_job.error)
 
 elif st.session_state.current_page == "help":
     st.header("使い方")
@@ -0,0 +1,390 @@
+"""
+決算書の一括分析 (Streamlitを使わないコマンドライン版)
+
+ディレクトリまたはマニフェストに並べた決算書を、画面版と同じ取り込み・分析処理で並列に分析し、
+Markdown (1件1ファイル) または JSONL に書き出す。完了した項目はチェックポイントに記録するので、
+途中で止まっても同じコマンドを再実行すれば続きから処理する。
+
+    export GEMINI_API_KEY=...
+    python batch.py filings/ -o out/                          # 1ファイル1件で要点をまとめる
+    python batch.py companies/ --mode trend -o out/           # サブディレクトリ1つを1社として時系列分析
+    python batch.py manifest.jsonl --format jsonl -o out/     # マニフェストの1行を1件として分析
+
+マニフェストは1行に1件のJSON: {"id": "7203", "files": ["7203/2024.pdf", "7203/2025.pdf"], "mode": "trend"}
+(files はマニフェストからの相対パス。id と mode は省略可)
+
+APIの送信ペースは画面版と同じ共通スケジューラ (FSBOT_SCHEDULER_* / --rpm) で全体として制限する。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google import genai
+import analysis
+import config
+import file_lifecycle
+import jobs
+import metrics
+import prompts
+import utils
+
+MODE_PROMPTS = {
+    "summary": prompts.PROMPT_FINANCIAL_SUMMARY,
+    "trend": prompts.PROMPT_TREND_ANALYSIS,
+    "compare": prompts.PROMPT_COMPANY_COMPARISON,
+}
+
+_CHECKPOINT_NAME = "checkpoint.jsonl"
+_RESULTS_NAME = "results.jsonl"
+
+
+class LocalFile:
+    """ローカルのファイルを、取り込み処理 (ingest) が使う UploadedFile と同じ形で扱う"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def getvalue(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def _is_filing(name):
+    return utils.get_file_type(name) is not None
+
+
+def _list_filings(directory):
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if _is_filing(name) and os.path.isfile(os.path.join(directory, name))
+    )
+
+
+def discover_items(source, mode):
+    """
+    入力 (ディレクトリまたはマニフェスト) から分析する項目を作る。
+
+    ディレクトリの場合、summary は決算書1ファイル (サブディレクトリも含む) を1件、
+    trend / compare はサブディレクトリ1つを1件とする (サブディレクトリが無ければ全体で1件)。
+
+    Returns:
+        list: [{"id": 項目ID, "mode": モード, "files": [パス, ...]}, ...]
+    """
+    if os.path.isfile(source):
+        return _read_manifest(source, mode)
+
+    items = []
+    if mode == "summary":
+        for root, dirs, names in os.walk(source):
+            dirs.sort()
+            for name in sorted(names):
+                if _is_filing(name):
+                    path = os.path.join(root, name)
+                    item_id = os.path.splitext(os.path.relpath(path, source))[0]
+                    items.append({"id": item_id, "mode": mode, "files": [path]})
+        return items
+
+    subdirectories = sorted(
+        name for name in os.listdir(source) if os.path.isdir(os.path.join(source, name))
+    )
+    for name in subdirectories:
+        files = _list_filings(os.path.join(source, name))
+        if files:
+            items.append({"id": name, "mode": mode, "files": files})
+    if not subdirectories:
+        files = _list_filings(source)
+        if files:
+            items.append({"id": os.path.basename(os.path.abspath(source)), "mode": mode, "files": files})
+    return items
+
+
+def _read_manifest(path, default_mode):
+    base = os.path.dirname(os.path.abspath(path))
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            files = entry.get("files") or [entry["file"]]
+            files = [p if os.path.isabs(p) else os.path.join(base, p) for p in files]
+            mode = entry.get("mode", default_mode)
+            if mode not in MODE_PROMPTS:
+                raise ValueError(f"{path}:{line_number}: unknown mode {mode!r}")
+            item_id = str(entry.get("id") or os.path.splitext(os.path.basename(files[0]))[0])
+            items.append({"id": item_id, "mode": mode, "files": files})
+    return items
+
+
+def _safe_file_name(item_id):
+    """項目IDを出力ファイル名に使える形にする"""
+    return "".join("_" if c in '/\\:*?"<>|' else c for c in item_id.replace(os.sep, "__"))
+
+
+class Checkpoint:
+    """完了した項目の記録 (JSONL、1行1件の追記のみ)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 異常終了で書きかけになった最後の行
+                        continue
+                    if record.get("status") == "done":
+                        self.done.add(record["id"])
+
+    def record(self, record):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if record["status"] == "done":
+                self.done.add(record["id"])
+
+
+def _read_jsonl(path):
+    """JSONLの各行を読む (異常終了で書きかけになった行は飛ばす)"""
+    records = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+class ResultWriter:
+    """
+    分析結果を Markdown (1件1ファイル) または JSONL に書き出す。
+    JSONLの場合、書き出し後・完了の記録前に止まった項目を再実行しても、同じIDの行は1行だけになる。
+    """
+
+    def __init__(self, output_dir, output_format):
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.lock = threading.Lock()
+        self.written_ids = set()
+        if output_format == "jsonl":
+            self.written_ids = {
+                record.get("id") for record in _read_jsonl(os.path.join(output_dir, _RESULTS_NAME))
+            }
+
+    def write(self, item, result):
+        """書き出したファイルのパスを返す"""
+        if self.output_format == "jsonl":
+            path = os.path.join(self.output_dir, _RESULTS_NAME)
+            record = {
+                "id": item["id"],
+                "mode": item["mode"],
+                "files": item["files"],
+                "model": result["model"],
+                "text": result["text"],
+            }
+            with self.lock:
+                if item["id"] in self.written_ids:
+                    # 前回書き出した行を置き換える (書きかけの行も落とす)
+                    records = [r for r in _read_jsonl(path) if r.get("id") != item["id"]] + [record]
+                    tmp_path = f"{path}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        for r in records:
+                            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+                    os.replace(tmp_path, path)
+                else:
+                    with open(path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    self.written_ids.add(item["id"])
+            return path
+
+        path = os.path.join(self.output_dir, f"{_safe_file_name(item['id'])}.md")
+        body = (
+            f"# {item['id']}\n\n"
+            f"- 分析: {item['mode']}\n"
+            f"- 資料: {', '.join(os.path.basename(p) for p in item['files'])}\n"
+            f"- モデル: {result['model']}\n\n"
+            f"{result['text']}\n"
+        )
+        # 書きかけのファイルを残さないよう、別名で書いてから置き換える
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        return path
+
+
+def analyze_item(client, item, job, keep_uploads=False):
+    """
+    1件を分析する (ワーカースレッドで実行)。失敗した場合は jobs.JobError などを送出する。
+
+    Returns:
+        dict: {"text": 分析結果, "model": 応答したモデル, "input_bytes": 資料の合計サイズ, "seconds": 所要時間}
+    """
+    files = [LocalFile(path) for path in item["files"]]
+    started = time.perf_counter()
+    try:
+        analysis.run_analysis(job, client, files, MODE_PROMPTS[item["mode"]], prepare_followups=False)
+    finally:
+        # 追加質問はしないので、アップロードしたファイルはすぐに削除する (画面で使用中のファイルは残す)
+        uploaded_names = job.result.get("uploaded_names")
+        if uploaded_names and not keep_uploads:
+            file_lifecycle.release(client, job.owner, uploaded_names)
+    return {
+        "text": job.result["text"],
+        "model": job.result["used_model"],
+        "input_bytes": sum(os.path.getsize(path) for path in item["files"]),
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def print_report(stats, elapsed):
+    """全体のスループットを表示する"""
+    done = len(stats["latencies"])
+    print()
+    print(f"完了 {done} 件 / 失敗 {stats['failed']} 件 / スキップ (完了済み) {stats['skipped']} 件")
+    print(f"経過時間 {elapsed:.1f} 秒")
+    if done and elapsed > 0:
+        print(
+            f"スループット {done / elapsed * 60:.1f} 件/分, "
+            f"{stats['input_bytes'] / 1024 / 1024 / elapsed:.2f} MB/秒 (入力資料)"
+        )
+        latencies = stats["latencies"]
+        print(
+            f"1件あたり p50={_percentile(latencies, 50):.1f}秒 "
+            f"p95={_percentile(latencies, 95):.1f}秒 最大={max(latencies):.1f}秒"
+        )
+        models = ", ".join(f"{model}: {count}" for model, count in sorted(stats["models"].items()))
+        print(f"応答したモデル {models}")
+    if stats["retries"]:
+        print(f"再試行 {stats['retries']} 回")
+
+
+def run(client, items, output_dir, output_format="markdown", concurrency=4, checkpoint_path=None, keep_uploads=False):
+    """
+    項目を並列に分析して書き出す。チェックポイントで完了済みの項目は飛ばす。
+
+    Returns:
+        dict: 集計 (print_report に渡すもの)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # 前回の中断などで持ち主のいなくなったファイルを先に片付ける
+    file_lifecycle.sweep(client)
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(output_dir, _CHECKPOINT_NAME))
+    writer = ResultWriter(output_dir, output_format)
+    pending = [item for item in items if item["id"] not in checkpoint.done]
+    stats = {
+        "latencies": [], "failed": 0, "skipped": len(items) - len(pending),
+        "input_bytes": 0, "models": {}, "retries": 0,
+    }
+    running = {}
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = {}
+        for item in pending:
+            # 項目ごとに持ち主を分け、他の実行中の項目と共有しているファイルを完了時に消さないようにする
+            job = jobs.Job(item["id"], "batch", f"batch:{item['id']}")
+            running[item["id"]] = job
+            futures[executor.submit(analyze_item, client, item, job, keep_uploads)] = (item, job)
+
+        for count, future in enumerate(as_completed(futures), start=1):
+            item, job = futures[future]
+            running.pop(item["id"], None)
+            stats["retries"] += len(job.notices)
+            try:
+                result = future.result()
+            except Exception as e:
+                stats["failed"] += 1
+                metrics.increment("batch_items", status="failed")
+                # 原因の調査に使えるよう、元のAPIエラーの種類も残す
+                cause = e.__cause__ or e
+                checkpoint.record({
+                    "id": item["id"],
+                    "status": "failed",
+                    "error": str(e),
+                    "error_type": type(cause).__name__,
+                    "error_code": getattr(cause, "code", None),
+                })
+                print(f"[{count}/{len(pending)}] 失敗 {item['id']}: {e}", file=sys.stderr)
+                continue
+
+            path = writer.write(item, result)
+            # 書き出しが終わってから完了を記録する (途中で止まった場合は再実行で分析し直す)
+            latency = result["seconds"]
+            checkpoint.record({
+                "id": item["id"],
+                "status": "done",
+                "output": path,
+                "model": result["model"],
+                "seconds": round(latency, 3),
+            })
+            stats["latencies"].append(latency)
+            stats["input_bytes"] += result["input_bytes"]
+            stats["models"][result["model"]] = stats["models"].get(result["model"], 0) + 1
+            metrics.increment("batch_items", status="done")
+            print(f"[{count}/{len(pending)}] 完了 {item['id']} ({latency:.1f}秒, {result['model']})")
+    except KeyboardInterrupt:
+        # 実行中の分析を止める (完了済みの分はチェックポイントに残っている)
+        print("中断しています...", file=sys.stderr)
+        for job in running.values():
+            job.cancel_requested = True
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="決算書のディレクトリ、またはマニフェスト (JSONL)")
+    parser.add_argument("--mode", choices=sorted(MODE_PROMPTS), default="summary")
+    parser.add_argument("-o", "--output", required=True, help="出力先ディレクトリ")
+    parser.add_argument("--format", choices=["markdown", "jsonl"], default="markdown")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に分析する項目数")
+    parser.add_argument("--rpm", type=int, help="Primaryモデルの1分あたりの送信数 (省略時は FSBOT_SCHEDULER_PRIMARY_RPM)")
+    parser.add_argument("--checkpoint", help="チェックポイントのパス (省略時は出力先の checkpoint.jsonl)")
+    parser.add_argument("--keep-uploads", action="store_true", help="アップロードしたファイルを削除せずに残す")
+    args = parser.parse_args()
+
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        parser.error("環境変数 GEMINI_API_KEY を設定してください")
+    if args.rpm:
+        # スケジューラを作る前に設定する
+        config.SCHEDULER_PRIMARY_RPM = args.rpm
+
+    items = discover_items(args.source, args.mode)
+    if not items:
+        parser.error(f"{args.source} に決算書 (PDF / HTML) が見つかりません")
+
+    client = genai.Client(api_key=api_key)
+    started = time.perf_counter()
+    try:
+        stats = run(
+            client, items, args.output, args.format, args.concurrency, args.checkpoint, args.keep_uploads
+        )
+    except KeyboardInterrupt:
+        sys.exit(130)
+    print_report(stats, time.perf_counter() - started)
+    sys.exit(1 if stats["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
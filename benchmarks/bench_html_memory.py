@@ -0,0 +1,80 @@
+"""
+HTML取り込みのメモリ使用量ベンチマーク
+
+実際の取り込み経路 (ingest.ingest_files) で、従来の bs4 (本文と表を別々に解析) と
+ストリーミング抽出 (1回の読み込みで本文と表を取り出す) のピークメモリと処理時間を、
+文書サイズごとに比較する。tracemalloc で全ての確保を見るため、解析はスレッドで行う。
+
+    python benchmarks/bench_html_memory.py [サイズMB ...]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# キャッシュに当たって計測にならないよう、一時ディレクトリを使う
+os.environ.setdefault("FSBOT_CACHE_DIR", tempfile.mkdtemp(prefix="fsbot-bench-"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import extract_cache
+import ingest
+import utils
+from corpus import FakeUploadedFile, make_filing_html
+
+# プロセスプールで解析すると子プロセスの確保が計測されないため、スレッドで解析する
+ingest._get_process_pool = lambda: None
+
+
+def measure(func):
+    """処理時間 (トレースなし) とピークメモリ (tracemalloc) を別々に計測する"""
+    extract_cache.clear(disk=True)
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+
+    extract_cache.clear(disk=True)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, elapsed
+
+
+def main(sizes):
+    print(f"{'size':>8} {'method':<26} {'peak MB':>10} {'x size':>8} {'sec':>8}")
+    for size_mb in sizes:
+        data = make_filing_html(size_mb)
+        actual_mb = len(data) / 1024 / 1024
+
+        def run_ingest(backend):
+            def run():
+                config.HTML_EXTRACT_BACKEND = backend
+                documents, _ = ingest.ingest_files(None, [FakeUploadedFile(data, "bench.htm")])
+                return documents[0]["text"], documents[0]["figures"]
+            return run
+
+        def run_iter_only():
+            # 行を順に処理するだけなら、全文を持たないので文書サイズに依存しない
+            count = 0
+            for _ in utils.iter_html_lines(FakeUploadedFile(data, "bench.htm")):
+                count += 1
+            return count
+
+        baseline, peak, elapsed = measure(run_ingest("bs4"))
+        rows = [("ingest_files/bs4", peak, elapsed)]
+        streamed, peak, elapsed = measure(run_ingest("stream"))
+        rows.append(("ingest_files/stream", peak, elapsed))
+        if streamed != baseline:
+            print("  !! stream の出力が bs4 と一致しません")
+        _, peak, elapsed = measure(run_iter_only)
+        rows.append(("iter_html_lines (no join)", peak, elapsed))
+
+        for method, peak, elapsed in rows:
+            peak_mb = peak / 1024 / 1024
+            print(f"{actual_mb:>7.1f}M {method:<26} {peak_mb:>10.1f} {peak_mb / actual_mb:>8.1f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main([float(arg) for arg in sys.argv[1:]] or [1, 5, 20])
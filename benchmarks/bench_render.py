@@ -0,0 +1,114 @@
+"""
+回答の表示 (ストリーム描画) のベンチマーク
+
+疑似APIの回答 (表を多く含むMarkdown) をバックグラウンドのジョブで受け取り、画面版と同じく
+stream_render.render_stream で st.write_stream に流す。streamlit.testing の AppTest で実際に描画させて、
+chunkをそのまま表示する従来の方法 (direct) と、まとめて表示する方法 (coalesce) の
+1回答あたりの表示回数と、描画スレッドのCPU時間を比較する。APIへの通信は行わない。
+
+    python benchmarks/bench_render.py
+    python benchmarks/bench_render.py --response-chars 20000 --chunk-chars 20 --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+
+os.environ.setdefault("FSBOT_CACHE_DIR", tempfile.mkdtemp(prefix="fsbot-bench-"))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, ROOT)
+
+from streamlit.testing.v1 import AppTest
+
+SCRIPT = """
+import sys
+sys.path[:0] = {paths!r}
+import streamlit as st
+import config
+import gemini_logic
+import jobs
+import stream_render
+from fake_gemini import FakeBehavior, FakeGeminiClient
+
+config.STREAM_RENDER_COALESCE = {coalesce!r}
+client = FakeGeminiClient(default_behavior=FakeBehavior(
+    first_chunk_latency=(0, 0),
+    chunk_interval={chunk_interval!r},
+    chunk_chars={chunk_chars!r},
+    response_chars={response_chars!r},
+))
+
+def produce(job):
+    for text in gemini_logic.clean_stream_generator(client._generate_chunks("bench-model")):
+        job.write(text)
+
+job = jobs.get_manager().submit("bench-render", [{run!r}, {coalesce!r}], produce, owner="bench")
+text, stats = stream_render.render_stream(st.empty(), job.tail(heartbeat=config.STREAM_RENDER_WINDOW_SECONDS))
+st.session_state["stats"] = stats
+st.session_state["text_length"] = len(text)
+"""
+
+
+def run_once(args, coalesce, run):
+    script = SCRIPT.format(
+        paths=[ROOT, BENCH_DIR],
+        coalesce=coalesce,
+        chunk_interval=args.chunk_interval,
+        chunk_chars=args.chunk_chars,
+        response_chars=args.response_chars,
+        run=run,
+    )
+    app = AppTest.from_string(script, default_timeout=300)
+    app.run()
+    if app.exception:
+        raise RuntimeError(app.exception[0].value)
+    return dict(app.session_state["stats"], text_length=app.session_state["text_length"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--response-chars", type=int, default=12000)
+    parser.add_argument("--chunk-chars", type=int, default=30)
+    parser.add_argument("--chunk-interval", type=float, default=0.002)
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    results = []
+    run = 0
+    print(f"{'mode':<9} {'chunks':>7} {'renders':>8} {'cpu ms':>8} {'chars':>7}")
+    for coalesce in (False, True):
+        runs = []
+        for _ in range(args.repeat):
+            run += 1
+            runs.append(run_once(args, coalesce, run))
+        result = {
+            "mode": "coalesce" if coalesce else "direct",
+            "chunks": statistics.median(r["chunks"] for r in runs),
+            "renders": statistics.median(r["renders"] for r in runs),
+            "cpu_seconds": statistics.median(r["cpu_seconds"] for r in runs),
+            "text_length": runs[-1]["text_length"],
+        }
+        results.append(result)
+        print(
+            f"{result['mode']:<9} {result['chunks']:>7.0f} {result['renders']:>8.0f} "
+            f"{result['cpu_seconds'] * 1000:>8.1f} {result['text_length']:>7}"
+        )
+
+    direct, coalesced = results
+    if coalesced["renders"] and coalesced["cpu_seconds"]:
+        print(
+            f"renders x{direct['renders'] / coalesced['renders']:.1f} fewer, "
+            f"cpu x{direct['cpu_seconds'] / coalesced['cpu_seconds']:.1f} less"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+起動時間のベンチマーク
+
+app.py を streamlit.testing の AppTest で新しいプロセスごとに実行し、ページごとの初回実行 (コールドスタート)
+と再実行の時間、重いライブラリ (google.genai / pandas / bs4) を読み込んだかを出す。
+再実行は AppTest の待ち合わせ (スレッドの起動・ポーリング) を含む時間 (rerun) と、
+app.py の本体だけの実行時間 (script) を分けて出す。rerun の差の大半は AppTest 側のばらつきなので、
+アプリの変更の影響は script で比べる。
+比較のため、起動時に analysis / gemini_logic を読み込んでクライアントを作っていた従来の動作 (eager) も、
+同じ処理をアプリの実行前に行うことで再現して計測する。APIへの通信は行わない。
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 5 --reruns 20 --page help --page main
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PAGES = ["main", "help", "history"]
+_DUMMY_KEY = "bench-dummy-key"
+
+
+def child(page, eager, reruns):
+    """1プロセス分の計測 (新しいプロセスの中で実行し、結果をJSONで出力する)"""
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from streamlit.runtime.scriptrunner import script_runner
+    from streamlit.testing.v1 import AppTest
+
+    # app.py の本体の実行時間だけを測る
+    script_times = []
+    exec_func = script_runner.exec_func_with_error_handling
+
+    def timed_exec_func(func, ctx):
+        t = time.perf_counter()
+        try:
+            return exec_func(func, ctx)
+        finally:
+            script_times.append(time.perf_counter() - t)
+
+    script_runner.exec_func_with_error_handling = timed_exec_func
+
+    if eager:
+        # 従来の app.py が先頭で行っていた import とクライアントの作成
+        import analysis  # noqa: F401
+        from google import genai
+        genai.Client(api_key=_DUMMY_KEY)
+
+    app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=120)
+    app.secrets["GEMINI_API_KEY"] = _DUMMY_KEY
+    app.session_state["current_page"] = page
+    app.run()
+    first = time.perf_counter() - started
+
+    rerun_times = []
+    del script_times[:]
+    for _ in range(reruns):
+        t = time.perf_counter()
+        app.run()
+        rerun_times.append(time.perf_counter() - t)
+
+    print(json.dumps({
+        "first": first,
+        "rerun": statistics.median(rerun_times) if rerun_times else None,
+        "script": statistics.median(script_times) if script_times else None,
+        "error": bool(app.exception),
+        "genai_loaded": "google.genai" in sys.modules,
+        "pandas_loaded": "pandas" in sys.modules,
+        "bs4_loaded": "bs4" in sys.modules,
+    }))
+
+
+def measure(page, eager, reruns, env):
+    command = [sys.executable, os.path.abspath(__file__), "--child", page, "--reruns", str(reruns)]
+    if eager:
+        command.append("--eager")
+    output = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    # Streamlitの警告などが混ざるので、最後の行だけを読む
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page", choices=PAGES, action="append")
+    parser.add_argument("--repeat", type=int, default=3, help="プロセスを起動し直して計測する回数")
+    parser.add_argument("--reruns", type=int, default=10, help="1プロセスあたりの再実行の回数")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--child", choices=PAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--eager", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.eager, args.reruns)
+        return
+
+    env = dict(os.environ)
+    env.setdefault("FSBOT_CACHE_DIR", tempfile.mkdtemp(prefix="fsbot-bench-"))
+
+    results = []
+    print(f"{'page':<8} {'mode':<6} {'cold start':>11} {'rerun':>8} {'script':>8} {'genai':>6} {'pandas':>7} {'bs4':>4}")
+    for page in args.page or PAGES:
+        for eager in (True, False):
+            runs = [measure(page, eager, args.reruns, env) for _ in range(args.repeat)]
+            result = {
+                "page": page,
+                "mode": "eager" if eager else "lazy",
+                "first": statistics.median(r["first"] for r in runs),
+                "rerun": statistics.median(r["rerun"] for r in runs),
+                "script": statistics.median(r["script"] for r in runs),
+                "genai_loaded": runs[-1]["genai_loaded"],
+                "pandas_loaded": runs[-1]["pandas_loaded"],
+                "bs4_loaded": runs[-1]["bs4_loaded"],
+                "error": any(r["error"] for r in runs),
+            }
+            results.append(result)
+            print(
+                f"{page:<8} {result['mode']:<6} {result['first'] * 1000:>9.0f}ms {result['rerun'] * 1000:>6.1f}ms "
+                f"{result['script'] * 1000:>6.1f}ms "
+                f"{'yes' if result['genai_loaded'] else 'no':>6} {'yes' if result['pandas_loaded'] else 'no':>7} {'yes' if result['bs4_loaded'] else 'no':>4}"
+                + ("  (app raised an exception)" if result["error"] else "")
+            )
+        eager_result, lazy_result = results[-2], results[-1]
+        print(f"{'':<8} cold start saving: {(eager_result['first'] - lazy_result['first']) * 1000:.0f}ms")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
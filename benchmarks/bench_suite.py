@@ -0,0 +1,229 @@
+"""
+オフライン性能ベンチマーク
+
+実APIの代わりに fake_gemini.FakeGeminiClient を使い、本物の gemini_logic / ingest / utils を
+合成コーパスに対して動かして、スループット・レイテンシのパーセンタイル・ピークメモリを出す。
+再試行・ストリーミング・抽出の経路の性能劣化をオフラインで検出するためのもの。
+
+    python benchmarks/bench_suite.py                      # 全シナリオ
+    python benchmarks/bench_suite.py --scenario stream --error-429-rate 0.3
+    python benchmarks/bench_suite.py --json results.json  # 結果をJSONでも保存
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# 計測用に、キャッシュを一時ディレクトリに分け、待ち時間の設定を短くしておく
+# (環境変数で明示した場合はそちらを優先)
+os.environ.setdefault("FSBOT_CACHE_DIR", tempfile.mkdtemp(prefix="fsbot-bench-"))
+os.environ.setdefault("FSBOT_SCHEDULER_PRIMARY_RPM", "100000")
+os.environ.setdefault("FSBOT_SCHEDULER_FALLBACK_RPM", "100000")
+os.environ.setdefault("FSBOT_SCHEDULER_BURST", "1000")
+os.environ.setdefault("FSBOT_BACKOFF_BASE_SECONDS", "0.05")
+os.environ.setdefault("FSBOT_BACKOFF_MAX_SECONDS", "0.5")
+os.environ.setdefault("FSBOT_CIRCUIT_COOLDOWN_SECONDS", "2")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import extract_cache
+import gemini_logic
+import ingest
+import prompts
+import utils
+from google.genai import errors
+from corpus import FakeUploadedFile, make_filing_html, make_filing_pdf
+from fake_gemini import FakeBehavior, FakeGeminiClient, FakeUploadBehavior
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def reset_caches():
+    """アップロード索引と抽出キャッシュを消して、毎回コールドな状態で計測する"""
+    extract_cache.clear(disk=True)
+    for name in os.listdir(config.CACHE_DIR):
+        if name.endswith(".sqlite3"):
+            os.remove(os.path.join(config.CACHE_DIR, name))
+
+
+def run_scenario(name, func, repeat, cold=True):
+    """
+    func を repeat 回実行してレイテンシを集計し、追加の1回でピークメモリを測る。
+    func は (処理量, 単位) を返す (スループットの計算用)。
+    """
+    latencies = []
+    amount, unit = 0, ""
+    for _ in range(repeat):
+        if cold:
+            reset_caches()
+        started = time.perf_counter()
+        amount, unit = func()
+        latencies.append(time.perf_counter() - started)
+
+    if cold:
+        reset_caches()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = sum(latencies) / len(latencies)
+    return {
+        "scenario": name,
+        "runs": repeat,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "throughput": amount / mean if mean > 0 else float("nan"),
+        "unit": f"{unit}/s",
+        "peak_mb": peak / 1024 / 1024,
+    }
+
+
+# --- シナリオ ---
+
+def scenario_extract(args):
+    """HTML本文抽出 (bs4 / stream) のスループット"""
+    results = []
+    for size_mb in args.html_sizes:
+        data = make_filing_html(size_mb)
+        mb = len(data) / 1024 / 1024
+        for backend in ("bs4", "stream"):
+            def run(backend=backend):
+                utils.extract_text_from_html(data, backend=backend)
+                return mb, "MB"
+            results.append(run_scenario(f"extract/{backend}/{size_mb}MB", run, args.repeat))
+    return results
+
+
+def scenario_ingest(args):
+    """複数ファイルの取り込み (PDFアップロード + HTML解析) のレイテンシ"""
+    client = FakeGeminiClient(
+        upload_behavior=FakeUploadBehavior(latency=args.upload_latency, error_503_rate=0.0),
+        seed=args.seed,
+    )
+    files = []
+    for i in range(args.files):
+        if i % 2 == 0:
+            files.append((make_filing_pdf(args.pdf_pages, seed=i), f"filing_{i}.pdf"))
+        else:
+            files.append((make_filing_html(args.html_sizes[0], seed=i), f"filing_{i}.htm"))
+
+    def run():
+        uploaded = [FakeUploadedFile(data, name) for data, name in files]
+        ingest.ingest_files(client, uploaded)
+        return len(files), "files"
+
+    return [
+        run_scenario(f"ingest/{args.files}files/cold", run, args.repeat, cold=True),
+        run_scenario(f"ingest/{args.files}files/warm", run, args.repeat, cold=False),
+    ]
+
+
+def _stream_client(args):
+    primary = FakeBehavior(
+        first_chunk_latency=(args.first_chunk_min, args.first_chunk_max),
+        chunk_chars=args.chunk_chars,
+        response_chars=args.response_chars,
+        error_429_rate=args.error_429_rate,
+        error_503_rate=args.error_503_rate,
+        retry_delay_seconds=args.retry_delay,
+    )
+    fallback = FakeBehavior(
+        first_chunk_latency=(args.first_chunk_min / 2, args.first_chunk_max / 2),
+        chunk_chars=args.chunk_chars,
+        response_chars=args.response_chars,
+    )
+    return FakeGeminiClient(
+        behaviors={config.PRIMARY_MODEL: primary, config.FALLBACK_MODEL: fallback},
+        seed=args.seed,
+    )
+
+
+def scenario_stream(args):
+    """送信から最初のchunk・全文受信までのレイテンシ (再試行・フォールバック込み)"""
+    client = _stream_client(args)
+    first_chunk_latencies = []
+    failures = []
+
+    def run():
+        started = time.perf_counter()
+        try:
+            _, stream, _ = gemini_logic.send_message_stream_with_fallback(
+                client, ["--- File: bench.htm ---\n本文"], prompts.PROMPT_FINANCIAL_SUMMARY, prompts.SYSTEM_INSTRUCTION
+            )
+        except (errors.ClientError, errors.ServerError):
+            failures.append(1)
+            return 0, "chars"
+        chars = 0
+        for i, text in enumerate(stream):
+            if i == 0:
+                first_chunk_latencies.append(time.perf_counter() - started)
+            chars += len(text)
+        return chars, "chars"
+
+    result = run_scenario("stream/full_response", run, args.repeat, cold=False)
+    result["ttfc_p50"] = percentile(first_chunk_latencies, 50)
+    result["ttfc_p99"] = percentile(first_chunk_latencies, 99)
+    result["failures"] = len(failures)
+    result["api_calls"] = dict(client.stats.counts)
+    return [result]
+
+
+SCENARIOS = {
+    "extract": scenario_extract,
+    "ingest": scenario_ingest,
+    "stream": scenario_stream,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    # コーパス
+    parser.add_argument("--html-sizes", type=float, nargs="+", default=[0.5, 2.0])
+    parser.add_argument("--pdf-pages", type=int, default=50)
+    parser.add_argument("--files", type=int, default=6)
+    # 疑似API
+    parser.add_argument("--upload-latency", type=float, default=0.3)
+    parser.add_argument("--first-chunk-min", type=float, default=0.2)
+    parser.add_argument("--first-chunk-max", type=float, default=0.6)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--response-chars", type=int, default=3000)
+    parser.add_argument("--error-429-rate", type=float, default=0.0)
+    parser.add_argument("--error-503-rate", type=float, default=0.0)
+    parser.add_argument("--retry-delay", type=float, default=None)
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        results.extend(SCENARIOS[name](args))
+
+    print(f"{'scenario':<28} {'p50':>7} {'p90':>7} {'p99':>7} {'throughput':>16} {'peak MB':>8}")
+    for r in results:
+        print(
+            f"{r['scenario']:<28} {r['p50']:>7.3f} {r['p90']:>7.3f} {r['p99']:>7.3f} "
+            f"{r['throughput']:>10.1f} {r['unit']:<5} {r['peak_mb']:>8.1f}"
+        )
+        if "ttfc_p50" in r:
+            print(f"{'':<28} ttfc p50={r['ttfc_p50']:.3f}s p99={r['ttfc_p99']:.3f}s failures={r['failures']} calls={r['api_calls']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
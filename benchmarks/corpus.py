@@ -0,0 +1,71 @@
+"""ベンチマーク用の合成コーパス (有価証券報告書・決算短信風のHTML/PDF)"""
+import io
+
+
+class FakeUploadedFile(io.BytesIO):
+    """StreamlitのUploadedFileと同じく、BytesIOに name を持たせたもの"""
+
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def make_filing_html(size_mb, seed=0):
+    """有価証券報告書風の表を多く含むHTMLを、おおよそ指定サイズで作る"""
+    section = (
+        f"<h2>【経営成績等の状況の概要】</h2>"
+        f"<p>当連結会計年度における売上高は前年同期比&#65291;{seed % 10}.2%となりました。</p>"
+        "<script>var x = '<p>ignored</p>';</script><style>td { color: red; }</style>"
+        "<table><tr><th>科目</th><th>前連結会計年度</th><th>当連結会計年度</th></tr>"
+        + "".join(
+            f"<tr><td>勘定科目{i}</td><td>{(i + seed) * 1234:,}</td><td>{(i + seed) * 1301:,}</td></tr>"
+            for i in range(40)
+        )
+        + "</table>\n"
+    )
+    unit = section.encode("utf-8")
+    return unit * max(1, int(size_mb * 1024 * 1024 / len(unit)))
+
+
+def make_filing_pdf(pages, seed=0, scanned_pages=()):
+    """
+    ページごとに1行のテキストを持つ、最小構成のテキストPDFを作る。
+    scanned_pages (1始まり) のページは、テキストの無い画像だけのページ (スキャン画像の代わり) にする。
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pagesは最後に埋める
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Type /XObject /Subtype /Image /Width 1 /Height 1 /ColorSpace /DeviceGray "
+        b"/BitsPerComponent 8 /Length 1 >>\nstream\n\x80\nendstream",
+    ]
+    kids = []
+    for page in range(1, pages + 1):
+        if page in scanned_pages:
+            stream = b"q 612 0 0 792 0 0 cm /Im1 Do Q"
+            resources = b"<< /XObject << /Im1 4 0 R >> >>"
+        else:
+            text = f"Financial summary page {page} revenue {(page + seed) * 1000}".encode("ascii")
+            stream = b"BT /F1 12 Tf 72 720 Td (" + text + b") Tj ET"
+            resources = b"<< /Font << /F1 3 0 R >> >>"
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources " + resources + b" /Contents %d 0 R >>" % content_id
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(kids) + b"] /Count %d >>" % pages
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref_at = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_at))
+    return out.getvalue()
@@ -0,0 +1,272 @@
+"""
+オフライン計測用の Gemini クライアントの代用品
+
+genai.Client のうち、このアプリが使う files.upload / files.delete / files.get、
+caches.create / update / delete、chats.create → send_message_stream、
+models.generate_content を実装する。
+遅延・chunkの大きさ・429/503エラーの発生率を設定でき、実APIなしで
+gemini_logic の再試行・ストリーミング経路をそのまま動かせる。
+"""
+import datetime
+import itertools
+import random
+import threading
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+from google.genai import errors, types
+
+
+@dataclass
+class FakeBehavior:
+    """モデルごとの振る舞い"""
+    # 最初のchunkまでの遅延 (秒) の範囲
+    first_chunk_latency: tuple = (0.2, 0.6)
+    # 2つ目以降のchunkの間隔 (秒)
+    chunk_interval: float = 0.01
+    # 1chunkあたりの文字数
+    chunk_chars: int = 40
+    # 応答全体の文字数
+    response_chars: int = 3000
+    # 最初のchunkの前に 429 / 503 になる確率
+    error_429_rate: float = 0.0
+    error_503_rate: float = 0.0
+    # 429のときに返す RetryInfo.retryDelay (秒)。Noneなら付けない
+    retry_delay_seconds: float = None
+
+
+@dataclass
+class FakeUploadBehavior:
+    # アップロード1件の固定遅延と、1MBあたりの転送時間 (秒)
+    latency: float = 0.3
+    seconds_per_mb: float = 0.2
+    error_503_rate: float = 0.0
+
+
+def _make_error(code, retry_delay_seconds=None):
+    status = {429: "RESOURCE_EXHAUSTED", 503: "UNAVAILABLE"}[code]
+    error = {"code": code, "message": f"fake {status}", "status": status}
+    if retry_delay_seconds is not None:
+        error["details"] = [{
+            "@type": "type.googleapis.com/google.rpc.RetryInfo",
+            "retryDelay": f"{retry_delay_seconds}s",
+        }]
+    cls = errors.ClientError if code < 500 else errors.ServerError
+    return cls(code, {"error": error})
+
+
+class FakeStats:
+    """呼び出し回数の記録"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class _FakeFiles:
+    def __init__(self, client):
+        self.client = client
+        self.store = {}
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def upload(self, file, config=None):
+        behavior = self.client.upload_behavior
+        config = config or {}
+        mime_type = config.get("mime_type") if isinstance(config, dict) else config.mime_type
+        if hasattr(file, "read"):
+            # 実際のSDKと同じく、ファイルオブジェクトの場合は mime_type が必要
+            if not mime_type:
+                raise ValueError("Unknown mime type: mime_type must be specified for file objects")
+            size = len(file.read())
+        else:
+            with open(file, "rb") as f:
+                size = len(f.read())
+        time.sleep(behavior.latency + behavior.seconds_per_mb * size / 1024 / 1024)
+        if self.client.rng.random() < behavior.error_503_rate:
+            self.client.stats.add("files.upload.error")
+            raise _make_error(503)
+
+        display_name = config.get("display_name") if isinstance(config, dict) else config.display_name
+        mime_type = mime_type or "application/pdf"
+        with self.lock:
+            name = f"files/fake-{next(self.counter)}"
+            uploaded = types.File(
+                name=name,
+                display_name=display_name,
+                mime_type=mime_type,
+                size_bytes=size,
+                uri=f"https://fake.invalid/{name}",
+                expiration_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48),
+            )
+            self.store[name] = uploaded
+        self.client.stats.add("files.upload")
+        return uploaded
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.store:
+                raise errors.ClientError(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+            return self.store[name]
+
+    def delete(self, name):
+        with self.lock:
+            self.store.pop(name, None)
+        self.client.stats.add("files.delete")
+
+
+class _FakeCaches:
+    """コンテキストキャッシュ。実APIと同様にモデルごと・有効期間つきで保持する"""
+
+    def __init__(self, client):
+        self.client = client
+        self.store = {}
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _expire_time(config):
+        seconds = float(str(config.ttl or "3600s").rstrip("s"))
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+    def create(self, model, config=None):
+        with self.lock:
+            name = f"cachedContents/fake-{next(self.counter)}"
+            cached = types.CachedContent(
+                name=name,
+                display_name=config.display_name,
+                model=model,
+                expire_time=self._expire_time(config),
+            )
+            self.store[name] = cached
+        self.client.stats.add("caches.create")
+        return cached
+
+    def get(self, name):
+        with self.lock:
+            cached = self.store.get(name)
+        if cached is None or cached.expire_time < datetime.datetime.now(datetime.timezone.utc):
+            raise errors.ClientError(404, {"error": {"code": 404, "message": "cache not found", "status": "NOT_FOUND"}})
+        return cached
+
+    def update(self, name, config=None):
+        cached = self.get(name)
+        cached.expire_time = self._expire_time(config)
+        self.client.stats.add("caches.update")
+        return cached
+
+    def delete(self, name):
+        with self.lock:
+            self.store.pop(name, None)
+        self.client.stats.add("caches.delete")
+
+
+class _FakeChat:
+    def __init__(self, client, model, config, history):
+        self.client = client
+        self.model = model
+        self.config = config
+        self._history = list(history or [])
+
+    def _check_cached_content(self):
+        """実APIと同様に、キャッシュの参照先とシステム指示の併用を検証する"""
+        name = getattr(self.config, "cached_content", None)
+        if not name:
+            return
+        if self.config.system_instruction:
+            raise errors.ClientError(400, {"error": {
+                "code": 400, "status": "INVALID_ARGUMENT",
+                "message": "system_instruction cannot be set when cached_content is used",
+            }})
+        cached = self.client.caches.get(name)
+        if cached.model != self.model:
+            raise errors.ClientError(400, {"error": {
+                "code": 400, "status": "INVALID_ARGUMENT",
+                "message": f"cached content was created for {cached.model}",
+            }})
+        self.client.stats.add("caches.hit")
+
+    @property
+    def history(self):
+        return self._history
+
+    def get_history(self, curated=False):
+        return self._history
+
+    def send_message_stream(self, message):
+        self._check_cached_content()
+        parts = message if isinstance(message, list) else [message]
+        user_parts = [
+            types.Part.from_text(text=p) if isinstance(p, str) else types.Part.from_uri(file_uri=p.uri, mime_type=p.mime_type)
+            for p in parts
+        ]
+        self._history.append(types.Content(role="user", parts=user_parts))
+        text_chunks = []
+        for chunk in self.client._generate_chunks(self.model):
+            text_chunks.append(chunk.text)
+            yield chunk
+        self._history.append(types.Content(role="model", parts=[types.Part.from_text(text="".join(text_chunks))]))
+
+
+class _FakeChats:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model, config=None, history=None):
+        self.client.stats.add("chats.create")
+        return _FakeChat(self.client, model, config, history)
+
+
+class _FakeModels:
+    def __init__(self, client):
+        self.client = client
+
+    def generate_content(self, model, contents, config=None):
+        text = "".join(chunk.text for chunk in self.client._generate_chunks(model))
+        return SimpleNamespace(text=text)
+
+
+class FakeGeminiClient:
+    """
+    genai.Client の代用品。
+
+    Args:
+        behaviors: {モデル名: FakeBehavior}。指定の無いモデルは default_behavior を使う
+        upload_behavior: アップロードの振る舞い
+        seed: 乱数のシード (エラー発生・遅延を再現可能にする)
+    """
+
+    def __init__(self, behaviors=None, default_behavior=None, upload_behavior=None, seed=0):
+        self.behaviors = behaviors or {}
+        self.default_behavior = default_behavior or FakeBehavior()
+        self.upload_behavior = upload_behavior or FakeUploadBehavior()
+        self.rng = random.Random(seed)
+        self.stats = FakeStats()
+        self.files = _FakeFiles(self)
+        self.caches = _FakeCaches(self)
+        self.chats = _FakeChats(self)
+        self.models = _FakeModels(self)
+
+    def _generate_chunks(self, model):
+        behavior = self.behaviors.get(model, self.default_behavior)
+        time.sleep(self.rng.uniform(*behavior.first_chunk_latency))
+        roll = self.rng.random()
+        if roll < behavior.error_429_rate:
+            self.stats.add(f"{model}.429")
+            raise _make_error(429, behavior.retry_delay_seconds)
+        if roll < behavior.error_429_rate + behavior.error_503_rate:
+            self.stats.add(f"{model}.503")
+            raise _make_error(503)
+
+        self.stats.add(f"{model}.ok")
+        # 実際のAPIと同様に、エスケープされた改行 (\\n) を含む表を返す
+        row = "| 売上高 | 1,234 | 1,301 | (P.12) |\\n"
+        body = ("## 財務ハイライト\\n" + row * (behavior.response_chars // len(row) + 1))[:behavior.response_chars]
+        for start in range(0, len(body), behavior.chunk_chars):
+            if start:
+                time.sleep(behavior.chunk_interval)
+            yield SimpleNamespace(text=body[start:start + behavior.chunk_chars])
@@ -0,0 +1,184 @@
+import logging
+from google.genai import types
+import config
+import gemini_logic
+import map_reduce
+import metrics
+import prompts
+
+# 追加質問のたびに会話の全履歴を送ると、ターンを重ねるごとに遅く・高くなる
+# 資料 (添付ファイル・HTML本文・部分要約) と直近の会話はそのまま残し、
+# 会話部分の見積もりトークン数が閾値を超えたら、それより古い会話を要約1件に置き換える
+
+logger = logging.getLogger(__name__)
+
+_ACKNOWLEDGEMENT = "承知しました。資料とこれまでの会話の要約を踏まえて回答します。"
+
+
+def is_document_part(part):
+    """資料として常に残すパートかどうか"""
+    if part.file_data is not None or part.inline_data is not None:
+        return True
+    text = part.text or ""
+    return (
+        text.startswith("--- File: ")
+        or text.startswith("--- 部分要約: ")
+        or text == prompts.PROMPT_REDUCE_PREFIX
+        or text.startswith(prompts.RETRIEVAL_CONTEXT_HEADER)
+    )
+
+
+def strip_documents(history, placeholder):
+    """
+    すべての発言から資料 (と検索で添付した抜粋) を取り除いた履歴を返す。
+    資料が無ければ history をそのまま返す。資料だけだった発言は placeholder に置き換える。
+    """
+    if not any(
+        is_document_part(p) for c in history if c.role == "user" for p in c.parts or []
+    ):
+        return history
+    stripped = []
+    for content in history:
+        if content.role != "user":
+            stripped.append(content)
+            continue
+        parts = [p for p in content.parts or [] if not is_document_part(p)]
+        if not parts:
+            parts = [types.Part.from_text(text=placeholder)]
+        stripped.append(types.Content(role="user", parts=parts))
+    return stripped
+
+
+def _content_tokens(content):
+    return sum(map_reduce.estimate_tokens(part.text) for part in content.parts or [] if part.text)
+
+
+def split_history(history):
+    """
+    履歴を資料と会話の往復に分ける。
+
+    Returns:
+        tuple: (document_parts, turns)
+            turns は [user Content, model Content, ...] のリストのリスト (古い順)
+    """
+    document_parts = []
+    turns = []
+    for content in history:
+        if not turns and content.role == "user" and not document_parts:
+            # 最初の発言から資料を取り出し、残り (プロンプト・以前の要約) を1つ目の発言にする
+            document_parts = [p for p in content.parts or [] if is_document_part(p)]
+            rest = [p for p in content.parts or [] if not is_document_part(p)]
+            turns.append([types.Content(role="user", parts=rest)])
+        elif content.role == "user" or not turns:
+            turns.append([content])
+        else:
+            turns[-1].append(content)
+    return document_parts, turns
+
+
+def conversation_tokens(history):
+    """資料を除いた会話部分の見積もりトークン数"""
+    _, turns = split_history(history)
+    return sum(_content_tokens(c) for turn in turns for c in turn)
+
+
+def _render_transcript(turns):
+    lines = []
+    for turn in turns:
+        for content in turn:
+            speaker = "ユーザー" if content.role == "user" else "AI"
+            text = "\n".join(p.text for p in content.parts or [] if p.text)
+            if text:
+                lines.append(f"{speaker}: {text}")
+    return "\n\n".join(lines)
+
+
+def compact_history(client, history, keep_turns=None, token_threshold=None):
+    """
+    会話部分が token_threshold を超えていれば、直近 keep_turns 往復より古い会話を要約に置き換えた
+    履歴を返す。以前の要約も古い会話の一部として要約し直すので、要約は常に1件になる。
+
+    Returns:
+        list: 圧縮後の履歴。圧縮の必要が無い場合はNone
+    """
+    if keep_turns is None:
+        keep_turns = config.HISTORY_KEEP_TURNS
+    if token_threshold is None:
+        token_threshold = config.HISTORY_COMPACTION_TOKEN_THRESHOLD
+
+    document_parts, turns = split_history(history)
+    tokens = sum(_content_tokens(c) for turn in turns for c in turn)
+    if tokens <= token_threshold or len(turns) <= keep_turns:
+        return None
+
+    old_turns = turns[:-keep_turns] if keep_turns > 0 else turns
+    recent_turns = turns[-keep_turns:] if keep_turns > 0 else []
+    summary_text, _ = gemini_logic.generate_with_fallback(
+        client,
+        [prompts.PROMPT_HISTORY_SUMMARY, _render_transcript(old_turns)],
+        prompts.HISTORY_SUMMARY_SYSTEM_INSTRUCTION
+    )
+
+    summary_part = types.Part.from_text(text=f"{prompts.HISTORY_SUMMARY_HEADER}\n{summary_text}")
+    compacted = [
+        types.Content(role="user", parts=document_parts + [summary_part]),
+        types.Content(role="model", parts=[types.Part.from_text(text=_ACKNOWLEDGEMENT)]),
+    ]
+    for turn in recent_turns:
+        compacted.extend(turn)
+    return compacted
+
+
+def prepare_chat(client, chat, model, full_tokens=None, context=None):
+    """
+    追加質問を送る前に、必要であれば履歴を圧縮したチャットセッションに作り直す。
+    圧縮の要約に失敗した場合は、圧縮せずにそのまま送る。
+    context (context_cache.SessionContext) があれば、資料をコンテキストキャッシュから参照する
+    セッションに作り直す。
+
+    Args:
+        chat: 現在のチャットセッション
+        model: 現在のモデル名
+        full_tokens: 圧縮しなかった場合の会話部分のトークン数 (前回の report["full_tokens"])。
+            Noneなら現在の履歴から数える
+
+    Returns:
+        tuple: (chat_session, report)
+            report: {"compacted": 今回圧縮したか, "full_tokens": 圧縮しなかった場合のトークン数,
+                     "sent_tokens": 実際に送る履歴のトークン数, "saved_tokens": 削減したトークン数}
+    """
+    history = chat.get_history(curated=True)
+    sent_tokens = conversation_tokens(history)
+    if full_tokens is None:
+        full_tokens = sent_tokens
+
+    compacted = None
+    if config.HISTORY_COMPACTION_ENABLED:
+        try:
+            compacted = compact_history(client, history)
+        except Exception as e:
+            logger.warning("Failed to compact chat history: %s", e)
+
+    rebuild = compacted is not None
+    if compacted is not None:
+        history = compacted
+        sent_tokens = conversation_tokens(compacted)
+        metrics.increment("history_compactions")
+
+    cached_content = None
+    if context is not None:
+        resolved, cached_content = context.resolve(client, model, history)
+        if resolved is not history:
+            history = resolved
+            rebuild = True
+    if rebuild:
+        chat = gemini_logic.create_chat_session(client, model, prompts.SYSTEM_INSTRUCTION, history, cached_content)
+
+    saved_tokens = max(0, full_tokens - sent_tokens)
+    metrics.observe("history_tokens_saved", saved_tokens)
+    return chat, {
+        "compacted": compacted is not None,
+        "full_tokens": full_tokens,
+        "sent_tokens": sent_tokens,
+        "saved_tokens": saved_tokens,
+    }
@@ -0,0 +1,173 @@
+# アプリ全体の設定値
+# 環境変数で上書きできるようにしておく (Streamlit Cloud / ローカル共通)
+import os
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+# ローカルキャッシュ (アップロード済みファイルの索引など) の保存先
+CACHE_DIR = os.environ.get(
+    "FSBOT_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"),
+)
+
+# 使用するモデル
+PRIMARY_MODEL = "gemini-2.5-flash"
+FALLBACK_MODEL = "gemini-2.5-flash-lite"
+TEMPERATURE = 0.2
+
+# --- Geminiファイルアップロードのキャッシュ ---
+# Gemini Files APIのファイルは48時間で失効するため、少し余裕を持たせる
+UPLOAD_CACHE_TTL_SECONDS = _env_int("FSBOT_UPLOAD_CACHE_TTL_SECONDS", 47 * 60 * 60)
+# 索引に保持する最大件数 (超えた分は最終利用が古いものから削除)
+UPLOAD_CACHE_MAX_ENTRIES = _env_int("FSBOT_UPLOAD_CACHE_MAX_ENTRIES", 500)
+
+# --- 複数ファイルの並列取り込み ---
+# PDFアップロードを同時に実行するスレッド数
+INGEST_UPLOAD_WORKERS = _env_int("FSBOT_INGEST_UPLOAD_WORKERS", 4)
+# HTML解析に使うプロセス数 (0ならスレッドで実行)
+INGEST_PARSE_PROCESSES = _env_int("FSBOT_INGEST_PARSE_PROCESSES", 2)
+
+# --- HTMLテキスト抽出 ---
+# "stream": 木を作らずにトークン単位で抽出 (高速・省メモリ。表の数値も同じ読み込みで取り出す)
+# "bs4": BeautifulSoup(html.parser) で木を作って抽出 (従来の方式。結果は同一)
+HTML_EXTRACT_BACKEND = os.environ.get("FSBOT_HTML_EXTRACT_BACKEND", "stream")
+# "stream" のときに1回で読み込むバイト数 (KB)
+HTML_STREAM_CHUNK_KB = _env_int("FSBOT_HTML_STREAM_CHUNK_KB", 64)
+# 抽出結果キャッシュのメモリ上限とディスク上限 (MB)
+EXTRACT_CACHE_MEMORY_MB = _env_int("FSBOT_EXTRACT_CACHE_MEMORY_MB", 64)
+EXTRACT_CACHE_DISK_MB = _env_int("FSBOT_EXTRACT_CACHE_DISK_MB", 512)
+
+# --- 大きな資料の分割要約 (map-reduce) ---
+# 見積もり入力トークン数がこれを超えたら、一括送信ではなく分割要約に切り替える
+SINGLE_SHOT_TOKEN_BUDGET = _env_int("FSBOT_SINGLE_SHOT_TOKEN_BUDGET", 600_000)
+# 分割要約で1回のリクエストに含めるセクションの最大トークン数
+MAP_SECTION_TOKEN_BUDGET = _env_int("FSBOT_MAP_SECTION_TOKEN_BUDGET", 60_000)
+# 分割要約を同時に実行する数
+MAP_CONCURRENCY = _env_int("FSBOT_MAP_CONCURRENCY", 4)
+# 分割要約で、ページ範囲ごとに切り出したPDFをリクエストに直接含める最大サイズ (バイト)
+# (APIのリクエスト上限に収まらない場合は、アップロード済みのPDF全体を範囲を指定して送る)
+MAP_INLINE_PDF_MAX_BYTES = _env_int("FSBOT_MAP_INLINE_PDF_MAX_BYTES", 15 * 1024 * 1024)
+
+# --- 分析結果のキャッシュ ---
+# 同じ資料・プロンプト・モデルの分析結果を再利用する期間と、保存する合計サイズの上限
+RESPONSE_CACHE_TTL_SECONDS = _env_int("FSBOT_RESPONSE_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60)
+RESPONSE_CACHE_MAX_MB = _env_int("FSBOT_RESPONSE_CACHE_MAX_MB", 200)
+# キャッシュ済みの回答を表示するときの1回あたりの文字数
+RESPONSE_REPLAY_CHUNK_CHARS = _env_int("FSBOT_RESPONSE_REPLAY_CHUNK_CHARS", 400)
+
+# --- リクエストスケジューラ (全セッション共通) ---
+# モデルごとの1分あたりの送信数と、まとめて送れる数
+SCHEDULER_PRIMARY_RPM = _env_int("FSBOT_SCHEDULER_PRIMARY_RPM", 60)
+SCHEDULER_FALLBACK_RPM = _env_int("FSBOT_SCHEDULER_FALLBACK_RPM", 120)
+SCHEDULER_BURST = _env_int("FSBOT_SCHEDULER_BURST", 5)
+# 同時に実行中にできるリクエスト数 (ストリーミング中のものを含む)
+SCHEDULER_MAX_IN_FLIGHT = _env_int("FSBOT_SCHEDULER_MAX_IN_FLIGHT", 16)
+# 429/503の後の再試行間隔 (指数バックオフ) と、全モデルを試す最大回数
+BACKOFF_BASE_SECONDS = _env_float("FSBOT_BACKOFF_BASE_SECONDS", 1.0)
+BACKOFF_MAX_SECONDS = _env_float("FSBOT_BACKOFF_MAX_SECONDS", 30.0)
+MAX_RETRY_ROUNDS = _env_int("FSBOT_MAX_RETRY_ROUNDS", 3)
+# 連続でこの回数混雑したモデルは、クールダウンの間Fallbackモデルに切り替える
+CIRCUIT_FAILURE_THRESHOLD = _env_int("FSBOT_CIRCUIT_FAILURE_THRESHOLD", 3)
+CIRCUIT_COOLDOWN_SECONDS = _env_float("FSBOT_CIRCUIT_COOLDOWN_SECONDS", 60.0)
+
+# --- ヘッジ (投機的) リクエスト ---
+# 有効にすると、Primaryモデルが一定時間内に最初の応答を返さない場合に
+# Fallbackモデルにも同じリクエストを送り、先に応答した方を使う
+HEDGE_ENABLED = os.environ.get("FSBOT_HEDGE_ENABLED", "0") == "1"
+HEDGE_DELAY_SECONDS = _env_float("FSBOT_HEDGE_DELAY_SECONDS", 8.0)
+
+# --- 計測 ---
+# 出力先: "" (無効) / "jsonl" / "prometheus" / "jsonl,prometheus"
+METRICS_SINK = os.environ.get("FSBOT_METRICS_SINK", "")
+METRICS_JSONL_PATH = os.environ.get("FSBOT_METRICS_JSONL_PATH", os.path.join(CACHE_DIR, "metrics.jsonl"))
+# Prometheus形式のエンドポイントのポート (127.0.0.1 で待ち受ける)
+METRICS_PORT = _env_int("FSBOT_METRICS_PORT", 9464)
+
+# --- バックグラウンドジョブ ---
+# サーバー全体で同時に実行するジョブ (分析・チャット応答) の数。超えた分は順番待ちになる
+JOB_MAX_CONCURRENT = _env_int("FSBOT_JOB_MAX_CONCURRENT", 4)
+# 終了したジョブの結果をメモリに残しておく時間 (再実行・再読み込み後の再表示用)
+JOB_RETENTION_SECONDS = _env_int("FSBOT_JOB_RETENTION_SECONDS", 60 * 60)
+
+# --- チャット履歴の圧縮 ---
+# 追加質問の入力トークンを抑えるため、資料と直近の会話だけをそのまま残し、
+# それより古い会話は要約に置き換える
+HISTORY_COMPACTION_ENABLED = os.environ.get("FSBOT_HISTORY_COMPACTION_ENABLED", "1") == "1"
+# そのまま残す直近の往復数
+HISTORY_KEEP_TURNS = _env_int("FSBOT_HISTORY_KEEP_TURNS", 4)
+# 資料を除いた会話部分の見積もりトークン数がこれを超えたら圧縮する
+HISTORY_COMPACTION_TOKEN_THRESHOLD = _env_int("FSBOT_HISTORY_COMPACTION_TOKEN_THRESHOLD", 20_000)
+
+# --- コンテキストキャッシュ (Gemini API) ---
+# 追加質問のたびに資料を送り直さないよう、資料とシステム指示をGemini側にキャッシュする
+CONTEXT_CACHE_ENABLED = os.environ.get("FSBOT_CONTEXT_CACHE_ENABLED", "1") == "1"
+# キャッシュの有効期間 (秒)。使うたびに延長する
+CONTEXT_CACHE_TTL_SECONDS = _env_int("FSBOT_CONTEXT_CACHE_TTL_SECONDS", 60 * 60)
+# APIの最小トークン数に満たない資料はキャッシュしない (テキストのみの資料の見積もりで判定)
+CONTEXT_CACHE_MIN_TOKENS = _env_int("FSBOT_CONTEXT_CACHE_MIN_TOKENS", 2048)
+
+# --- 財務数値の索引によるローカル回答 ---
+# HTMLの表から抽出した数値で答えられる質問 (「売上高は？」など) は、LLMを使わずに回答する
+LOCAL_ANSWER_ENABLED = os.environ.get("FSBOT_LOCAL_ANSWER_ENABLED", "1") == "1"
+# これより長い質問は文章での説明が必要とみなしてLLMに任せる
+LOCAL_ANSWER_MAX_QUESTION_CHARS = _env_int("FSBOT_LOCAL_ANSWER_MAX_QUESTION_CHARS", 40)
+
+# --- 資料の検索 (追加質問で関連箇所だけを送る) ---
+# 資料の本文からBM25の索引を作り、追加質問では資料全体ではなく上位の抜粋だけを送る
+RETRIEVAL_ENABLED = os.environ.get("FSBOT_RETRIEVAL_ENABLED", "1") == "1"
+# 送る抜粋の数と、1つの抜粋の目安の文字数
+RETRIEVAL_TOP_K = _env_int("FSBOT_RETRIEVAL_TOP_K", 8)
+RETRIEVAL_CHUNK_CHARS = _env_int("FSBOT_RETRIEVAL_CHUNK_CHARS", 800)
+
+# --- PDFの取り込み ---
+# "local": テキストを埋め込んだPDFは手元で本文を取り出してテキストとして送り、
+#          スキャン画像のページだけを切り出してアップロードする (pypdf が必要)
+# "upload": 従来どおりPDFをそのままアップロードしてGeminiに読み取らせる
+PDF_EXTRACT_MODE = os.environ.get("FSBOT_PDF_EXTRACT_MODE", "local")
+# 取り出せた文字数がこれ未満で、画像を含むページはスキャン画像とみなす
+PDF_TEXT_MIN_CHARS = _env_int("FSBOT_PDF_TEXT_MIN_CHARS", 20)
+# 取り出した文字のうち、決算書に出てこない文字 (私用領域・制御文字・置換文字など) の割合がこれを超えるページは
+# 文字化け (ToUnicode の無いCIDフォントなど) とみなし、テキストの代わりにPDFのページをアップロードする
+PDF_TEXT_MAX_GARBLED_RATIO = _env_float("FSBOT_PDF_TEXT_MAX_GARBLED_RATIO", 0.1)
+
+# --- アップロード用の一時ファイル ---
+# PDFは通常、メモリ上のバイト列をそのままアップロードする
+# ファイルのパスしか受け付けない古いSDKを使う場合だけ、一時ファイルに書き出してからアップロードする
+UPLOAD_VIA_TEMP_FILE = os.environ.get("FSBOT_UPLOAD_VIA_TEMP_FILE", "0") == "1"
+# これより古い一時ファイルは、異常終了などで残ったものとして削除する (秒)
+TEMP_FILE_MAX_AGE_SECONDS = _env_int("FSBOT_TEMP_FILE_MAX_AGE_SECONDS", 60 * 60)
+# 残った一時ファイルを確認する間隔 (秒)
+TEMP_JANITOR_INTERVAL_SECONDS = _env_int("FSBOT_TEMP_JANITOR_INTERVAL_SECONDS", 10 * 60)
+
+# --- アップロードしたファイルの後片付け ---
+# どのセッションからもこの時間使われていないファイルは、持ち主がいなくなったとみなして削除する (秒)
+FILE_ORPHAN_TTL_SECONDS = _env_int("FSBOT_FILE_ORPHAN_TTL_SECONDS", 3 * 60 * 60)
+# 持ち主のいなくなったファイルを探して削除する間隔 (秒)
+FILE_SWEEP_INTERVAL_SECONDS = _env_int("FSBOT_FILE_SWEEP_INTERVAL_SECONDS", 10 * 60)
+# ファイルの削除を同時に実行するスレッド数
+FILE_DELETE_CONCURRENCY = _env_int("FSBOT_FILE_DELETE_CONCURRENCY", 8)
+# セッションがファイルを使っていることを記録する間隔 (秒)
+FILE_TOUCH_INTERVAL_SECONDS = _env_int("FSBOT_FILE_TOUCH_INTERVAL_SECONDS", 60)
+
+# --- 回答の表示 ---
+# ストリームのchunkを、文字数・時間でまとめてから表示する (表示の回数を減らし、サーバーのCPUを抑える)
+STREAM_RENDER_COALESCE = os.environ.get("FSBOT_STREAM_RENDER_COALESCE", "1") == "1"
+# これだけたまったら、段落・表の行の区切りで表示する
+STREAM_RENDER_MIN_CHARS = _env_int("FSBOT_STREAM_RENDER_MIN_CHARS", 200)
+# これを超えたら、区切りを待たずに表示する
+STREAM_RENDER_MAX_CHARS = _env_int("FSBOT_STREAM_RENDER_MAX_CHARS", 2000)
+# 前回の表示からこれだけ経ったら、たまった文字数が少なくても区切りで表示する (秒)
+STREAM_RENDER_WINDOW_SECONDS = _env_float("FSBOT_STREAM_RENDER_WINDOW_SECONDS", 0.25)
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from google.genai import types
+import chat_history
+import config
+import map_reduce
+import metrics
+
+# 添付資料とシステム指示を Gemini のコンテキストキャッシュ (client.caches) に置き、
+# 追加質問やFallbackモデルで作り直したセッションでは資料を送り直さずにキャッシュを参照する
+# キャッシュはモデルごとに必要なので、使うモデルの分だけ必要になった時点で作る
+# 「分析をリセット」で削除し、放置されたセッションの分は有効期間 (TTL) で失効する
+
+logger = logging.getLogger(__name__)
+
+# 有効期間の残りがこれを下回ったら使う前に延長する (秒)
+_REFRESH_MARGIN_SECONDS = 5 * 60
+
+# キャッシュに置いた資料の代わりに、最初の発言に残す文
+_DOCUMENTS_PLACEHOLDER = "（添付資料はキャッシュ済みです）"
+
+
+class SessionContext:
+    """
+    1セッション分の資料と、モデルごとのコンテキストキャッシュ。
+    セッションステートに保存して、追加質問・再試行のたびに使う。
+    """
+
+    def __init__(self, document_parts, system_instruction):
+        self.document_parts = document_parts
+        self.system_instruction = system_instruction
+        # モデル名 -> [キャッシュ名, 失効時刻 (time.time())]。作成に失敗したモデルは None
+        self.caches = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_chat(cls, chat, system_instruction):
+        """分析が終わったチャットセッションの履歴から資料を取り出して作る"""
+        document_parts, _ = chat_history.split_history(chat.get_history(curated=True))
+        return cls(document_parts, system_instruction)
+
+    def _eligible(self):
+        if not config.CONTEXT_CACHE_ENABLED or not self.document_parts:
+            return False
+        # PDFは1ページでも数百トークンになるので、添付ファイルがあればキャッシュする
+        if any(p.file_data is not None for p in self.document_parts):
+            return True
+        text_tokens = sum(map_reduce.estimate_tokens(p.text) for p in self.document_parts if p.text)
+        return text_tokens >= config.CONTEXT_CACHE_MIN_TOKENS
+
+    def cache_name(self, client, model):
+        """
+        model 用のキャッシュ名を返す (無ければ作り、失効が近ければ延長する)。
+        キャッシュを使えない場合はNone。
+        """
+        if not self._eligible():
+            return None
+        with self.lock:
+            if model in self.caches and self.caches[model] is None:
+                return None
+            ttl = f"{config.CONTEXT_CACHE_TTL_SECONDS}s"
+            entry = self.caches.get(model)
+            try:
+                if entry is None:
+                    cached = client.caches.create(
+                        model=model,
+                        config=types.CreateCachedContentConfig(
+                            contents=[types.Content(role="user", parts=self.document_parts)],
+                            system_instruction=self.system_instruction,
+                            display_name="fsbot-session-documents",
+                            ttl=ttl,
+                        ),
+                    )
+                    entry = [cached.name, time.time() + config.CONTEXT_CACHE_TTL_SECONDS]
+                    self.caches[model] = entry
+                    metrics.increment("context_caches_created", model=model)
+                elif entry[1] - time.time() < _REFRESH_MARGIN_SECONDS:
+                    client.caches.update(name=entry[0], config=types.UpdateCachedContentConfig(ttl=ttl))
+                    entry[1] = time.time() + config.CONTEXT_CACHE_TTL_SECONDS
+            except Exception as e:
+                # 対応していないモデルや、資料が最小トークン数に満たない場合など
+                logger.warning("Failed to prepare context cache for %s: %s", model, e)
+                metrics.increment("context_cache_errors", model=model)
+                self.caches[model] = None
+                return None
+            return entry[0]
+
+    def resolve(self, client, model, history):
+        """
+        model でセッションを作るときの履歴とキャッシュ名を返す。
+        キャッシュを使える場合は資料を取り除いた履歴を、使えない場合は資料を含む履歴を返す。
+        (変更が無い場合は history をそのまま返す)
+
+        Returns:
+            tuple: (history, cached_content_name or None)
+        """
+        name = self.cache_name(client, model)
+        if name is not None:
+            return chat_history.strip_documents(history, _DOCUMENTS_PLACEHOLDER), name
+        document_parts, _ = chat_history.split_history(history)
+        if document_parts or not history or not self.document_parts:
+            return history, None
+        # キャッシュ前提で資料を取り除いた履歴に、資料を戻す
+        first = history[0]
+        parts = [p for p in first.parts or [] if p.text != _DOCUMENTS_PLACEHOLDER]
+        return [types.Content(role=first.role, parts=self.document_parts + parts)] + list(history[1:]), None
+
+    def release(self, client):
+        """作成したキャッシュをすべて削除する"""
+        with self.lock:
+            names = [entry[0] for entry in self.caches.values() if entry]
+            self.caches = {}
+        for name in names:
+            try:
+                client.caches.delete(name=name)
+            except Exception as e:
+                logger.warning("Failed to delete context cache %s: %s", name, e)
@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+import config
+
+# HTMLから抽出したテキストを内容ハッシュで引けるようにするキャッシュ
+# メモリ上のLRUを1段目、gzip圧縮したファイルを2段目として使い、
+# Streamlitの再実行や同じ決算書の再アップロードでは解析自体を省略する
+
+logger = logging.getLogger(__name__)
+
+# 抽出処理の仕様を変えたときはこの値を上げて、古いキャッシュを無効にする
+EXTRACTOR_VERSION = 1
+
+_DISK_DIR = os.path.join(config.CACHE_DIR, "html_text")
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+_memory_bytes = 0
+
+
+def content_key(data):
+    """HTMLのバイト列からキャッシュのキーを作る"""
+    return key_for_hash(hashlib.sha256(data).hexdigest())
+
+
+def key_for_hash(sha256):
+    """計算済みの内容ハッシュからキャッシュのキーを作る"""
+    return f"{sha256}-v{EXTRACTOR_VERSION}"
+
+
+def _disk_path(key):
+    return os.path.join(_DISK_DIR, f"{key}.txt.gz")
+
+
+def get(key):
+    """キャッシュ済みのテキストを返す。無ければNone"""
+    with _lock:
+        text = _memory.get(key)
+        if text is not None:
+            _memory.move_to_end(key)
+            return text
+
+    path = _disk_path(key)
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            text = f.read()
+    except (OSError, EOFError):
+        return None
+    # 最終利用時刻を更新して、ディスク側の削除順に反映させる
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    _remember(key, text)
+    return text
+
+
+def put(key, text, prune=True):
+    """
+    抽出結果をメモリとディスクの両方に保存する。
+    prune=False なら上限の確認を省く (続けて何件も書き込む場合は、最後に prune() を呼ぶこと)
+    """
+    _remember(key, text)
+    try:
+        os.makedirs(_DISK_DIR, exist_ok=True)
+        # 書きかけのファイルを読まれないよう、別名で書いてから置き換える
+        tmp_path = f"{_disk_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=1) as f:
+            f.write(text)
+        os.replace(tmp_path, _disk_path(key))
+        if prune:
+            _prune_disk()
+    except OSError as e:
+        # ディスクに書けなくてもメモリキャッシュだけで動作は続ける
+        logger.warning("Failed to write extract cache %s: %s", key, e)
+
+
+def clear(disk=False):
+    """メモリ上のキャッシュを空にする。disk=Trueならディスク上のキャッシュも削除する"""
+    global _memory_bytes
+    with _lock:
+        _memory.clear()
+        _memory_bytes = 0
+    if disk and os.path.isdir(_DISK_DIR):
+        for name in os.listdir(_DISK_DIR):
+            try:
+                os.remove(os.path.join(_DISK_DIR, name))
+            except OSError:
+                pass
+
+
+def _remember(key, text):
+    """メモリ上のLRUに登録し、上限を超えた分を古い順に捨てる"""
+    global _memory_bytes
+    size = sys.getsizeof(text)
+    limit = config.EXTRACT_CACHE_MEMORY_MB * 1024 * 1024
+    if size > limit:
+        # 1件で上限を超えるものはディスクにだけ置く
+        return
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return
+        _memory[key] = text
+        _memory_bytes += size
+        while _memory_bytes > limit:
+            _, evicted = _memory.popitem(last=False)
+            _memory_bytes -= sys.getsizeof(evicted)
+
+
+def prune():
+    """ディスク上のキャッシュを上限以内に収める"""
+    if not os.path.isdir(_DISK_DIR):
+        return
+    try:
+        _prune_disk()
+    except OSError as e:
+        logger.warning("Failed to prune extract cache: %s", e)
+
+
+def _prune_disk():
+    """ディスク上のキャッシュが上限を超えたら、最終利用が古いものから削除する"""
+    limit = config.EXTRACT_CACHE_DISK_MB * 1024 * 1024
+    entries = []
+    total = 0
+    with os.scandir(_DISK_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".txt.gz"):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    if total <= limit:
+        return
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= limit:
+            break
@@ -0,0 +1,550 @@
+import json
+import re
+import time
+import unicodedata
+from html.parser import HTMLParser
+import numpy as np
+import pandas as pd
+import config
+import metrics
+
+# HTML (EDINET/TDnet のXBRLから生成された表) の財務数値を、
+# 指標 × 期間 × 会社 の表 (pandas.DataFrame) に索引化し、
+# 「売上高は？」「営業利益率の推移」のような数値の質問にはLLMを使わずに答える
+
+# 抽出処理の仕様を変えたときはこの値を上げて、古いキャッシュを無効にする
+FIGURES_VERSION = 2
+
+_ERA_OFFSETS = {"令和": 2018, "平成": 1988, "昭和": 1925}
+_DATE_PATTERN = re.compile(r"(令和|平成|昭和)?\s*(元|\d{1,4})\s*年\s*(\d{1,2})\s*月")
+_SLASH_DATE_PATTERN = re.compile(r"(20\d{2}|19\d{2})\s*[/.]\s*(\d{1,2})")
+_TERM_PATTERN = re.compile(r"第\s*(\d+)\s*期")
+# 表紙の【事業年度】などにある当期の期間 (相対的な期間を年月に置き換える基準)
+_FISCAL_PERIOD_PATTERN = re.compile(r"【(?:事業年度|会計期間|四半期会計期間|中間会計期間|計算期間)】([^【\n]{0,80})")
+_RELATIVE_PERIOD_PATTERN = re.compile(r"(前々|前|当)(連結)?(会計年度|事業年度|期|四半期|中間)")
+_NUMBER_PATTERN = re.compile(r"^(?P<sign>[△▲\-−])?\(?(?P<number>\d[\d,]*(?:\.\d+)?)\)?$")
+_UNIT_PATTERN = re.compile(r"単位\s*[:：]?\s*(百万円|千円|億円|円|%|株|人|名)")
+_FOOTNOTE_PATTERN = re.compile(r"[※*]\s*\d*|\(注\d*\)|注\d+")
+_LEADING_NUMBERING_PATTERN = re.compile(r"^(\(\d+\)|[①-⑳]|\d+\.)")
+# 「自己資本比率(%)」のように指標名の後ろに付いている単位
+_METRIC_UNIT_PATTERN = re.compile(r"\((%|百万円|千円|億円|円|株|人|名|倍)\)$")
+
+# 表のセルとして扱うタグ
+_CELL_TAGS = {"td", "th"}
+
+
+class _TableCollector(HTMLParser):
+    """HTML中の表を、行 × セル文字列のリストとして集める (直前の文章も単位の判定用に残す)"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tables = []
+        self._stack = []
+        self._cell = None
+        self._colspan = 1
+        self._recent_text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            # 「(単位：百万円)」は続く複数の表に掛かることが多いので、表の後も直前の文章を消さずに残す
+            preceding = "".join(self._recent_text)[-200:]
+            self._stack.append({"rows": [], "preceding": preceding})
+        elif not self._stack:
+            return
+        elif tag == "tr":
+            self._stack[-1]["rows"].append([])
+        elif tag in _CELL_TAGS:
+            self._end_cell()
+            self._cell = []
+            try:
+                self._colspan = max(1, min(50, int(dict(attrs).get("colspan") or 1)))
+            except ValueError:
+                self._colspan = 1
+        elif tag == "br" and self._cell is not None:
+            self._cell.append(" ")
+
+    def handle_endtag(self, tag):
+        if not self._stack:
+            return
+        if tag in _CELL_TAGS:
+            self._end_cell()
+        elif tag == "table":
+            self._end_cell()
+            table = self._stack.pop()
+            if table["rows"]:
+                self.tables.append(table)
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+        elif not self._stack:
+            self._recent_text.append(data)
+            if len(self._recent_text) > 50:
+                self._recent_text = self._recent_text[-20:]
+
+    def _end_cell(self):
+        if self._cell is None:
+            return
+        text = " ".join("".join(self._cell).split())
+        table = self._stack[-1]
+        if not table["rows"]:
+            table["rows"].append([])
+        table["rows"][-1].extend([text] * self._colspan)
+        self._cell = None
+        self._colspan = 1
+
+
+def _normalize(text):
+    return unicodedata.normalize("NFKC", text or "").strip()
+
+
+def parse_number(text):
+    """表のセルの数値を float にする (△・▲・括弧は負数)。数値でなければNone"""
+    text = _FOOTNOTE_PATTERN.sub("", _normalize(text)).replace(" ", "").replace("¥", "")
+    text = text.rstrip("%円")
+    match = _NUMBER_PATTERN.match(text)
+    if not match:
+        return None
+    value = float(match.group("number").replace(",", ""))
+    if match.group("sign") or (text.startswith("(") and text.endswith(")")):
+        value = -value
+    return value
+
+
+def parse_period(text):
+    """
+    表の見出しセルから期間を読み取る。
+
+    Returns:
+        tuple: (期間の表示名, 並び順の値) / 期間でなければ (None, None)
+    """
+    text = _normalize(text)
+    # 「自 2023年4月1日 至 2024年3月31日」のような場合は、期末の日付を使う
+    dates = _DATE_PATTERN.findall(text)
+    if dates:
+        era, year, month = dates[-1]
+        year = 1 if year == "元" else int(year)
+        if era:
+            year += _ERA_OFFSETS[era]
+        elif year < 100:
+            year += 2000
+        month = int(month)
+        return f"{year}年{month}月期", year * 100 + month
+    slash = _SLASH_DATE_PATTERN.findall(text)
+    if slash:
+        year, month = slash[-1]
+        return f"{int(year)}年{int(month)}月期", int(year) * 100 + int(month)
+    term = _TERM_PATTERN.search(text)
+    if term:
+        return f"第{int(term.group(1))}期", float(term.group(1))
+    relative = _RELATIVE_PERIOD_PATTERN.search(text)
+    if relative:
+        order = {"前々": -2.0, "前": -1.0, "当": 0.0}[relative.group(1)]
+        return relative.group(0), order
+    return None, None
+
+
+def normalize_metric(text):
+    """
+    指標名の表記ゆれ (全角・空白・注記番号) をそろえる。
+
+    Returns:
+        tuple: (指標名, 指標名に付いていた単位 or "")
+    """
+    text = _FOOTNOTE_PATTERN.sub("", _normalize(text))
+    text = "".join(_LEADING_NUMBERING_PATTERN.sub("", text).split())
+    unit_match = _METRIC_UNIT_PATTERN.search(text)
+    if unit_match:
+        return text[:unit_match.start()], unit_match.group(1)
+    return text, ""
+
+
+def _table_records(table, table_no):
+    rows = [row for row in table["rows"] if any(row)]
+    if len(rows) < 2:
+        return []
+
+    # 数値を含む最初の行より前を見出し行とし、列ごとに見出しをつなげて期間を読む
+    first_data = None
+    for i, row in enumerate(rows):
+        if any(parse_number(cell) is not None for cell in row[1:]):
+            first_data = i
+            break
+    if not first_data:
+        return []
+    width = max(len(row) for row in rows)
+    periods = []
+    for col in range(1, width):
+        header = " ".join(row[col] for row in rows[:first_data] if col < len(row) and row[col])
+        label, order = parse_period(header)
+        if label and (not periods or periods[-1][1] != label):
+            periods.append((col, label, order))
+    if not periods:
+        return []
+
+    # 見出し行にある単位を優先し、無ければ表の前で最後に書かれた単位を使う
+    header_units = _UNIT_PATTERN.findall(_normalize(" ".join(cell for row in rows[:first_data] for cell in row)))
+    preceding_units = _UNIT_PATTERN.findall(_normalize(table["preceding"]))
+    unit = header_units[0] if header_units else (preceding_units[-1] if preceding_units else "")
+
+    records = []
+    for row in rows[first_data:]:
+        label = next((cell for cell in row if normalize_metric(cell)[0]), "")
+        metric, metric_unit = normalize_metric(label)
+        if not metric or parse_number(metric) is not None:
+            continue
+        # 「自己資本比率 | (%) | 40.1 | ...」のように単位が別のセルにある場合
+        for cell in row[1:]:
+            unit_cell = _METRIC_UNIT_PATTERN.fullmatch(_normalize(cell).replace(" ", ""))
+            if unit_cell:
+                metric_unit = unit_cell.group(1)
+                break
+        # 空白セルで列がずれている表が多いので、数値セルの数と期間の数が一致すれば順に対応させる
+        numeric_cells = [parse_number(cell) for cell in row[1:] if parse_number(cell) is not None]
+        if len(numeric_cells) == len(periods):
+            values = numeric_cells
+        else:
+            values = [parse_number(row[col]) if col < len(row) else None for col, _, _ in periods]
+        for (_, period, order), value in zip(periods, values):
+            if value is not None:
+                records.append((metric, period, order, value, metric_unit or unit, table_no))
+    return records
+
+
+class RecordExtractor:
+    """
+    HTMLの文字列を少しずつ受け取り、財務数値を取り出す。
+    本文の抽出 (html_text.iter_lines の on_text) と同じ読み込みで表も集めるために使う。
+    """
+
+    def __init__(self):
+        self._collector = _TableCollector()
+
+    def feed(self, text):
+        self._collector.feed(text)
+
+    def records(self):
+        """
+        Returns:
+            list: [(metric, period, period_order, value, unit, table_no), ...]
+        """
+        self._collector.close()
+        records = []
+        for table_no, table in enumerate(self._collector.tables, start=1):
+            records.extend(_table_records(table, table_no))
+        return records
+
+
+def extract_records(data):
+    """
+    HTMLのバイト列から財務数値を取り出す (プロセスプールで実行できるよう、引数・戻り値は単純な型)。
+
+    Returns:
+        list: [(metric, period, period_order, value, unit, table_no), ...]
+    """
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        text = data.decode("cp932", errors="replace")
+    extractor = RecordExtractor()
+    extractor.feed(text)
+    return extractor.records()
+
+
+def fiscal_period(text):
+    """
+    本文の【事業年度】などから当期を読み取る。
+
+    Returns:
+        tuple: (期末の並び順の値 (年×100+月), 期数 or None) / 見つからなければ (None, None)
+    """
+    match = _FISCAL_PERIOD_PATTERN.search(_normalize(text or "")[:20000])
+    if not match:
+        return None, None
+    label, order = parse_period(match.group(1))
+    if label is None or not label.endswith("月期"):
+        return None, None
+    term = _TERM_PATTERN.search(match.group(1))
+    return order, (int(term.group(1)) if term else None)
+
+
+def resolve_periods(records, text=None):
+    """
+    「当連結会計年度」「第76期」のような期間を年月の期間に置き換え、年月の期間と同じ順番で並ぶようにする。
+    当期の基準は本文の【事業年度】、無ければ表にある最新の年月の期間とする (どちらも無ければそのまま)。
+    """
+    anchor, anchor_term = fiscal_period(text)
+    if anchor is None:
+        absolute = [order for _, period, order, _, _, _ in records if period.endswith("月期")]
+        anchor = max(absolute) if absolute else None
+    if anchor is None:
+        return records
+
+    resolved = []
+    for metric, period, order, value, unit, table_no in records:
+        if period.endswith("月期"):
+            pass
+        elif _TERM_PATTERN.fullmatch(period):
+            if anchor_term is None:
+                resolved.append((metric, period, order, value, unit, table_no))
+                continue
+            order = anchor - (anchor_term - int(order)) * 100
+        else:
+            # 相対的な期間 (-2, -1, 0) は、前期・前々期を1年ずつ前とみなす
+            order = anchor + int(order) * 100
+        if not period.endswith("月期"):
+            period = f"{int(order) // 100}年{int(order) % 100}月期"
+        resolved.append((metric, period, order, value, unit, table_no))
+    return resolved
+
+
+def cache_key(sha256):
+    """抽出結果を extract_cache に保存するときのキー"""
+    return f"{sha256}-figures-v{FIGURES_VERSION}"
+
+
+def dump_records(records):
+    return json.dumps(records, ensure_ascii=False)
+
+
+def load_records(text):
+    return [tuple(r) for r in json.loads(text)]
+
+
+_COMPANY_PATTERN = re.compile(r"【会社名】\s*\n?\s*([^\n]+)")
+
+
+def detect_company(text, display_name):
+    """本文の【会社名】から会社名を取る。見つからなければファイル名を使う"""
+    match = _COMPANY_PATTERN.search(text or "")
+    if match:
+        return match.group(1).strip()
+    return display_name.rsplit(".", 1)[0]
+
+
+# --- 質問への回答 ---
+
+# 質問に出てくる言い方と、表の指標名の先頭の対応 (ローカルで答えるのは、ここと _RATIOS にある指標だけ)
+_METRIC_ALIASES = {
+    "売上高": ("売上高", "売上収益", "営業収益", "純売上高"),
+    "営業利益": ("営業利益",),
+    "経常利益": ("経常利益",),
+    "当期純利益": ("親会社株主に帰属する当期純利益", "当期純利益"),
+    "純資産": ("純資産合計", "純資産額"),
+    "総資産": ("資産合計", "総資産額"),
+    "ROE": ("自己資本利益率",),
+    "EPS": ("1株当たり当期純利益",),
+    "営業キャッシュフロー": ("営業活動によるキャッシュ・フロー",),
+}
+_ALIAS_WORDS = {
+    "売上": "売上高", "売上高": "売上高", "売上収益": "売上高", "営業収益": "売上高",
+    "営業利益": "営業利益", "経常利益": "経常利益",
+    "純利益": "当期純利益", "当期純利益": "当期純利益", "親会社株主に帰属する当期純利益": "当期純利益",
+    "純資産": "純資産", "総資産": "総資産", "ROE": "ROE", "自己資本利益率": "ROE", "EPS": "EPS",
+    "1株当たり利益": "EPS", "株当たり利益": "EPS", "1株当たり当期純利益": "EPS",
+    "営業CF": "営業キャッシュフロー", "営業キャッシュフロー": "営業キャッシュフロー",
+    "営業活動によるキャッシュ・フロー": "営業キャッシュフロー",
+}
+# 比率の名前と (分子, 分母) の指標
+_RATIOS = {
+    "営業利益率": ("営業利益", "売上高"),
+    "経常利益率": ("経常利益", "売上高"),
+    "純利益率": ("当期純利益", "売上高"),
+    "自己資本比率": ("純資産", "総資産"),
+}
+_TREND_WORDS = ("推移", "トレンド", "増減", "伸び", "成長", "前年比", "前期比", "変化", "比較", "過去")
+_YEAR_PATTERN = re.compile(r"(20\d{2})")
+# 数値を尋ねる質問で、指標名・会社名・期間のほかに使う言い回し
+# 取り除いても言葉が残る質問 (「売上高を増やすために何をしていますか」など) は、説明が必要とみなしてLLMに任せる
+_LOOKUP_PHRASES = sorted((
+    "教えてください", "教えて", "知りたい", "見せて", "表示して", "一覧", "いくら", "どのくらい", "どれくらい",
+    "何円", "ですか", "でしたか", "でした", "です", "数値", "金額", "実績", "値", "額",
+    "連結", "単体", "当期", "前期", "今期", "直近", "最新", "各期", "毎期", "年度", "期",
+    "は", "の", "を", "と", "も", "や", "および", "及び",
+), key=len, reverse=True)
+_QUESTION_PERIOD_PATTERN = re.compile(r"(令和|平成)?\d{1,4}年度?(\d{1,2}月)?期?|第\d+期")
+_QUESTION_PUNCTUATION_PATTERN = re.compile(r"[\s、。,.・?!「」()]")
+
+_COLUMNS = ["company", "metric", "period", "period_order", "value", "unit", "source", "table"]
+
+
+class FigureIndex:
+    """指標 × 期間 × 会社 の財務数値の索引"""
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.metrics = list(dict.fromkeys(frame["metric"]))
+
+    @classmethod
+    def from_documents(cls, documents):
+        """ingest.ingest_files の文書のうち、figures を持つもの (HTML) から作る"""
+        frames = []
+        for document in documents:
+            records = document.get("figures")
+            if not records:
+                continue
+            frame = pd.DataFrame.from_records(
+                resolve_periods(records, document.get("text")),
+                columns=["metric", "period", "period_order", "value", "unit", "table"]
+            )
+            frame["company"] = detect_company(document.get("text"), document["display_name"])
+            frame["source"] = document["display_name"]
+            frames.append(frame)
+        if not frames:
+            return None
+        frame = pd.concat(frames, ignore_index=True)[_COLUMNS]
+        frame["value"] = frame["value"].astype(np.float64)
+        frame["period_order"] = pd.to_numeric(frame["period_order"], errors="coerce")
+        # 同じ指標・期間が複数の表にある場合 (主要な経営指標等の推移と財務諸表など) は最初の表を使う
+        frame = frame.drop_duplicates(subset=["company", "metric", "period"], keep="first")
+        return cls(frame.reset_index(drop=True))
+
+    def __len__(self):
+        return len(self.frame)
+
+    def _labels_for(self, canonical):
+        prefixes = _METRIC_ALIASES.get(canonical, (canonical,))
+        for prefix in prefixes:
+            labels = [m for m in self.metrics if m.startswith(prefix)]
+            if labels:
+                # 「営業利益又は営業損失(△)」などより、完全一致・短いものを優先する
+                return sorted(labels, key=len)[:1]
+        return []
+
+    def lookup(self, metric, company=None):
+        """指標1つ分の行を、会社・期間の順に並べて返す"""
+        rows = self.frame[self.frame["metric"] == metric]
+        if company:
+            rows = rows[rows["company"] == company]
+        return rows.sort_values(["company", "period_order"], kind="stable")
+
+    def series(self, canonical):
+        """別名を含めて指標を探し、(会社, 期間) ごとの値を返す"""
+        labels = self._labels_for(canonical)
+        if not labels:
+            return None
+        return self.lookup(labels[0])
+
+    def ratio(self, numerator, denominator):
+        """2つの指標の比率 (%) を会社・期間ごとにまとめて計算する"""
+        top = self.series(numerator)
+        bottom = self.series(denominator)
+        if top is None or bottom is None:
+            return None
+        keys = ["company", "period", "period_order"]
+        merged = top[keys + ["value", "source", "table"]].merge(
+            bottom[keys + ["value"]], on=keys, suffixes=("_num", "_den")
+        )
+        if merged.empty:
+            return None
+        denominator_values = merged["value_den"].to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.where(denominator_values != 0, merged["value_num"].to_numpy() / denominator_values * 100, np.nan)
+        merged["value"] = values
+        merged["unit"] = "%"
+        return merged[["company", "period", "period_order", "value", "unit", "source", "table"]].sort_values(
+            ["company", "period_order"], kind="stable"
+        )
+
+    def answer(self, question):
+        """
+        既知の指標の数値だけを尋ねる質問であれば、索引から回答のMarkdownを作る。
+        それ以外の質問 (説明を求める質問・索引に無い指標) の場合はNone (LLMに任せる)。
+        """
+        started_at = time.perf_counter()
+        question = _normalize(question)
+        if len(question) > config.LOCAL_ANSWER_MAX_QUESTION_CHARS:
+            return None
+
+        title, rows, term = self._match(question)
+        if rows is None or rows.empty or not self._is_lookup(question, term):
+            return None
+
+        companies = [c for c in dict.fromkeys(self.frame["company"]) if c and c in question]
+        if companies:
+            rows = rows[rows["company"].isin(companies)]
+        years = _YEAR_PATTERN.findall(question)
+        if years:
+            rows = rows[rows["period"].str.contains("|".join(years))]
+        if rows.empty:
+            return None
+
+        trend = any(w in question for w in _TREND_WORDS)
+        if not trend and not years:
+            # 単純な質問には、会社ごとの最新の期間だけを答える
+            rows = rows.groupby("company", sort=False).tail(1)
+
+        text = _render(title, rows, trend)
+        metrics.observe("local_answer_seconds", time.perf_counter() - started_at)
+        metrics.increment("local_answers")
+        return text
+
+    def _match(self, question):
+        """質問に出てくる既知の指標・比率を探し、(見出し, 行, 質問中の言い方) を返す"""
+        for name, (numerator, denominator) in _RATIOS.items():
+            if name in question:
+                if name in self.metrics:
+                    return name, self.lookup(name), name
+                return f"{name} (計算値: {numerator} ÷ {denominator})", self.ratio(numerator, denominator), name
+
+        for word, canonical in sorted(_ALIAS_WORDS.items(), key=lambda item: -len(item[0])):
+            if word in question:
+                rows = self.series(canonical)
+                if rows is not None:
+                    return rows["metric"].iloc[0], rows, word
+                return None, None, None
+        return None, None, None
+
+    def _is_lookup(self, question, term):
+        """指標名・会社名・期間・決まった言い回しを除くと何も残らない (数値だけを尋ねている) か"""
+        rest = question.replace(term, " ")
+        for company in self.frame["company"].unique():
+            if company:
+                rest = rest.replace(company, " ")
+        rest = _QUESTION_PERIOD_PATTERN.sub(" ", rest)
+        for word in _TREND_WORDS + tuple(_LOOKUP_PHRASES):
+            rest = rest.replace(word, " ")
+        return not _QUESTION_PUNCTUATION_PATTERN.sub("", rest)
+
+
+def _format_value(value, unit):
+    if pd.isna(value):
+        return "-"
+    if unit == "%":
+        return f"{value:,.1f}%"
+    text = f"{value:,.0f}" if float(value).is_integer() else f"{value:,.2f}"
+    return f"{text}{unit}" if unit in ("円", "株", "人", "名") else text
+
+
+def _render(title, rows, trend):
+    units = [u for u in dict.fromkeys(rows["unit"]) if u and u != "%"]
+    heading = f"**{title}**" + (f" (単位：{units[0]})" if len(units) == 1 and units[0] not in ("円", "株", "人", "名") else "")
+    multiple_companies = rows["company"].nunique() > 1
+
+    columns = (["会社"] if multiple_companies else []) + ["期間", "値"]
+    if trend:
+        columns.append("前期比")
+        # 会社ごとに期間順で並べ、前期からの増減をまとめて計算する
+        # (比率どうしは差をポイントで、金額などは増減率で示す)
+        previous = rows.groupby("company", sort=False)["value"].shift(1).to_numpy()
+        current = rows["value"].to_numpy()
+        is_ratio = (rows["unit"] == "%").to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            changes = np.where(is_ratio, current - previous, (current - previous) / np.abs(previous) * 100)
+        changes[~np.isfinite(changes)] = np.nan
+    columns.append("出典")
+
+    lines = [heading, "", "| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+    for i, row in enumerate(rows.itertuples(index=False)):
+        cells = [row.company] if multiple_companies else []
+        cells += [row.period, _format_value(row.value, row.unit)]
+        if trend:
+            change = changes[i]
+            if np.isnan(change):
+                cells.append("-")
+            else:
+                cells.append(f"{change:+.1f}pt" if row.unit == "%" else f"{change:+.1f}%")
+        cells.append(f"({row.source} 表{row.table})")
+        lines.append("| " + " | ".join(cells) + " |")
+    lines += ["", "※資料の表から自動で抽出した値です。正確な値は元資料でご確認ください。"]
+    return "\n".join(lines)
@@ -0,0 +1,132 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import config
+
+# Geminiにアップロード済みのファイルを、PDFの内容ハッシュから引けるようにする索引
+# 同じ決算書を何度開いても再アップロードせずに済むようにする
+# 複数セッションから同時に触られるので、SQLiteに保存して排他はDB側に任せる
+
+_DB_PATH = os.path.join(config.CACHE_DIR, "upload_cache.sqlite3")
+_lock = threading.Lock()
+
+
+def _connect():
+    os.makedirs(config.CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(_DB_PATH, timeout=10)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS uploads (
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            remote_name TEXT NOT NULL,
+            uri TEXT NOT NULL,
+            mime_type TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            PRIMARY KEY (sha256, size, model)
+        )
+    """)
+    return conn
+
+
+@contextlib.contextmanager
+def _db():
+    """コミットしてから確実にクローズする接続を返す"""
+    conn = _connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def lookup(sha256, size, model):
+    """
+    キャッシュ済みのアップロード情報を返す。無い、または期限切れの場合はNone。
+
+    Returns:
+        dict: {"name", "uri", "mime_type"} or None
+    """
+    now = time.time()
+    with _lock, _db() as conn:
+        row = conn.execute(
+            "SELECT remote_name, uri, mime_type, expires_at FROM uploads "
+            "WHERE sha256 = ? AND size = ? AND model = ?",
+            (sha256, size, model),
+        ).fetchone()
+        if row is None:
+            return None
+        remote_name, uri, mime_type, expires_at = row
+        if expires_at <= now:
+            # 期限切れ (Gemini側でも既に消えている) なので索引からも落とす
+            conn.execute(
+                "DELETE FROM uploads WHERE sha256 = ? AND size = ? AND model = ?",
+                (sha256, size, model),
+            )
+            return None
+        conn.execute(
+            "UPDATE uploads SET last_used_at = ? WHERE sha256 = ? AND size = ? AND model = ?",
+            (now, sha256, size, model),
+        )
+    return {"name": remote_name, "uri": uri, "mime_type": mime_type}
+
+
+def record(sha256, size, model, remote_name, uri, mime_type, expires_at=None):
+    """
+    アップロード結果を索引に登録する。
+
+    Returns:
+        list: LRUで索引から追い出されたリモートファイル名 (呼び出し側で削除する)
+    """
+    now = time.time()
+    if expires_at is None:
+        expires_at = now + config.UPLOAD_CACHE_TTL_SECONDS
+    with _lock, _db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO uploads "
+            "(sha256, size, model, remote_name, uri, mime_type, expires_at, last_used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (sha256, size, model, remote_name, uri, mime_type, expires_at, now),
+        )
+        return _evict(conn, now)
+
+
+def _evict(conn, now):
+    """期限切れのエントリと、上限件数を超えた古いエントリを削除する"""
+    evicted = [
+        name for (name,) in conn.execute(
+            "SELECT remote_name FROM uploads WHERE expires_at <= ?", (now,)
+        )
+    ]
+    conn.execute("DELETE FROM uploads WHERE expires_at <= ?", (now,))
+
+    (count,) = conn.execute("SELECT COUNT(*) FROM uploads").fetchone()
+    overflow = count - config.UPLOAD_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        rows = conn.execute(
+            "SELECT sha256, size, model, remote_name FROM uploads "
+            "ORDER BY last_used_at ASC LIMIT ?",
+            (overflow,),
+        ).fetchall()
+        for sha256, size, model, remote_name in rows:
+            conn.execute(
+                "DELETE FROM uploads WHERE sha256 = ? AND size = ? AND model = ?",
+                (sha256, size, model),
+            )
+            # 期限切れでなくてもGemini上には残っているので、削除対象として返す
+            evicted.append(remote_name)
+    return evicted
+
+
+def forget(remote_names):
+    """リモートファイルを削除したときに、対応するエントリを索引から外す"""
+    if not remote_names:
+        return
+    with _lock, _db() as conn:
+        conn.executemany(
+            "DELETE FROM uploads WHERE remote_name = ?",
+            [(name,) for name in remote_names],
+        )
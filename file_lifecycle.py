@@ -0,0 +1,237 @@
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import file_cache
+import metrics
+
+# Geminiにアップロードしたファイルの台帳 (持ち主のセッションと利用時刻) と、その後片付け
+# - 取り込みの時点で、アップロード・再利用したファイルを使うセッションを持ち主として登録する
+#   (アップロード索引から再利用したファイルは、使うセッションごとに持ち主が増える。持ち主の無い取り込みは owner="")
+# - セッションは画面の操作のたびに (一定間隔で) touch して、まだ使っていることを記録する
+# - 「分析をリセット」では、他に使っているセッションが無いファイルだけを削除する
+# - タブを閉じたなどで、どの持ち主からも FILE_ORPHAN_TTL_SECONDS 使われていないファイルは、
+#   バックグラウンドの掃除 (start_sweeper) で削除する
+# 複数のプロセスから同時に使われるので、SQLiteに保存して排他はDB側に任せる
+
+logger = logging.getLogger(__name__)
+
+_DB_PATH = os.path.join(config.CACHE_DIR, "remote_files.sqlite3")
+_lock = threading.Lock()
+_sweeper_lock = threading.Lock()
+_sweeper_started = False
+
+# Gemini Files APIのファイルが自動で削除されるまでの時間 (これより古い記録は削除せずに台帳から外す)
+_REMOTE_LIFETIME_SECONDS = 48 * 60 * 60
+
+
+def _connect():
+    os.makedirs(config.CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(_DB_PATH, timeout=10)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS remote_files (
+            remote_name TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_seen_at REAL NOT NULL,
+            PRIMARY KEY (remote_name, owner)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS remote_files_owner ON remote_files (owner)")
+    return conn
+
+
+@contextlib.contextmanager
+def _db():
+    """コミットしてから確実にクローズする接続を返す"""
+    conn = _connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def register(remote_names, owner=None):
+    """
+    リモートファイルを台帳に登録する (登録済みなら利用時刻を更新する)。
+    owner を指定すると、そのセッションを持ち主として登録し、持ち主なしの登録は外す。
+    """
+    if not remote_names:
+        return
+    now = time.time()
+    owner = owner or ""
+    with _lock, _db() as conn:
+        conn.executemany(
+            "INSERT INTO remote_files (remote_name, owner, created_at, last_seen_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (remote_name, owner) DO UPDATE SET last_seen_at = excluded.last_seen_at",
+            [(name, owner, now, now) for name in remote_names],
+        )
+        if owner:
+            conn.executemany(
+                "DELETE FROM remote_files WHERE remote_name = ? AND owner = ''",
+                [(name,) for name in remote_names],
+            )
+
+
+def touch(owner):
+    """セッションがまだ使われていることを記録する (持ち主のファイルが掃除されないようにする)"""
+    if not owner:
+        return
+    with _lock, _db() as conn:
+        conn.execute("UPDATE remote_files SET last_seen_at = ? WHERE owner = ?", (time.time(), owner))
+
+
+def owned_files(owner):
+    """owner が持ち主として登録されているファイル名のリスト"""
+    with _lock, _db() as conn:
+        return [name for (name,) in conn.execute(
+            "SELECT remote_name FROM remote_files WHERE owner = ?", (owner,)
+        )]
+
+
+def _live_names(conn, names, now):
+    """names のうち、いずれかの持ち主がまだ使っている (TTL以内に利用した) もの"""
+    deadline = now - config.FILE_ORPHAN_TTL_SECONDS
+    return {
+        name for name in names
+        if conn.execute(
+            "SELECT 1 FROM remote_files WHERE remote_name = ? AND last_seen_at >= ? LIMIT 1",
+            (name, deadline),
+        ).fetchone()
+    }
+
+
+def _forget(remote_names):
+    with _lock, _db() as conn:
+        conn.executemany(
+            "DELETE FROM remote_files WHERE remote_name = ?",
+            [(name,) for name in remote_names],
+        )
+
+
+def _delete_remote(client, remote_name):
+    """1件削除する。削除できた (または既に無い) 場合はTrue"""
+    try:
+        client.files.delete(name=remote_name)
+        return True
+    except Exception as e:
+        if getattr(e, "code", None) == 404:
+            return True
+        logger.warning("Failed to delete file %s: %s", remote_name, e)
+        return False
+
+
+def delete_files(client, remote_names):
+    """
+    リモートファイルを並列に削除し、台帳とアップロード索引から外す。
+    削除に失敗したファイルは台帳に残し、次回の掃除で再試行する。
+
+    Returns:
+        list: 削除できたファイル名
+    """
+    names = list(dict.fromkeys(remote_names))
+    if not names:
+        return []
+    # 削除したファイルが再利用されないよう、先にアップロード索引から外しておく
+    file_cache.forget(names)
+    workers = max(1, min(config.FILE_DELETE_CONCURRENCY, len(names)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda name: _delete_remote(client, name), names))
+    deleted = [name for name, ok in zip(names, results) if ok]
+    _forget(deleted)
+    metrics.increment("remote_files_deleted", len(deleted))
+    if len(deleted) < len(names):
+        metrics.increment("remote_file_delete_errors", len(names) - len(deleted))
+    return deleted
+
+
+def release(client, owner, remote_names=None):
+    """
+    owner を持ち主から外し、他に使っているセッションが無くなったファイルを削除する。
+    remote_names を指定した場合は、そのファイルだけを対象にする。
+
+    Returns:
+        list: 削除したファイル名
+    """
+    now = time.time()
+    with _lock, _db() as conn:
+        names = [name for (name,) in conn.execute(
+            "SELECT remote_name FROM remote_files WHERE owner = ?", (owner,)
+        )]
+        if remote_names is not None:
+            wanted = set(remote_names)
+            names = [name for name in names if name in wanted]
+        conn.executemany(
+            "DELETE FROM remote_files WHERE remote_name = ? AND owner = ?",
+            [(name, owner) for name in names],
+        )
+        deletable = [name for name in names if name not in _live_names(conn, [name], now)]
+        # 削除に失敗した場合は次回の掃除で再試行されるよう、使われていない持ち主なしの記録として残す
+        conn.executemany(
+            "INSERT OR IGNORE INTO remote_files (remote_name, owner, created_at, last_seen_at) VALUES (?, '', ?, 0)",
+            [(name, now) for name in deletable],
+        )
+    return delete_files(client, deletable)
+
+
+def reclaim(client, remote_names):
+    """
+    remote_names のうち、どのセッションも使っていないファイルを削除する (アップロード索引から追い出した場合など)。
+    使っているセッションがあるファイルは残し、使われなくなってから掃除で削除する。
+    """
+    if not remote_names:
+        return []
+    with _lock, _db() as conn:
+        live = _live_names(conn, remote_names, time.time())
+    return delete_files(client, [name for name in remote_names if name not in live])
+
+
+def sweep(client):
+    """
+    どの持ち主からも FILE_ORPHAN_TTL_SECONDS 以上使われていないファイルを削除する。
+
+    Returns:
+        list: 削除したファイル名
+    """
+    now = time.time()
+    with _lock, _db() as conn:
+        # Gemini側で既に自動削除されたファイルは、APIを呼ばずに台帳から外す
+        conn.execute(
+            "DELETE FROM remote_files WHERE remote_name IN ("
+            "SELECT remote_name FROM remote_files GROUP BY remote_name HAVING MIN(created_at) < ?)",
+            (now - _REMOTE_LIFETIME_SECONDS,),
+        )
+        orphans = [name for (name,) in conn.execute(
+            "SELECT remote_name FROM remote_files GROUP BY remote_name HAVING MAX(last_seen_at) < ?",
+            (now - config.FILE_ORPHAN_TTL_SECONDS,),
+        )]
+        (total,) = conn.execute("SELECT COUNT(DISTINCT remote_name) FROM remote_files").fetchone()
+
+    reclaimed = delete_files(client, orphans)
+    metrics.increment("remote_files_reclaimed", len(reclaimed))
+    metrics.gauge("remote_files_live", total - len(reclaimed))
+    return reclaimed
+
+
+def start_sweeper(client):
+    """掃除を定期的に行うスレッドを起動する (プロセスにつき1回だけ)"""
+    global _sweeper_started
+    with _sweeper_lock:
+        if _sweeper_started:
+            return
+        _sweeper_started = True
+
+    def run():
+        while True:
+            try:
+                sweep(client)
+            except Exception as e:
+                logger.exception("Failed to sweep remote files: %s", e)
+            time.sleep(config.FILE_SWEEP_INTERVAL_SECONDS)
+
+    threading.Thread(target=run, name="remote-file-sweeper", daemon=True).start()
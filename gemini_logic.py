@@ -1,114 +1,460 @@
 import streamlit as st
+import queue
+import threading
 import time
 from google import genai
 from google.genai import types, errors
+import config
+import file_cache
+import file_lifecycle
+import metrics
+import scheduler
 
 # クライアントの初期化
 @st.cache_resource
 def get_gemini_client():
     return genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
 
-def upload_file_to_gemini(client, file_path, display_name):
-    """Geminiにファイルをアップロードする"""
+@metrics.timed("upload")
+def upload_file_to_gemini(client, file, display_name, mime_type=None):
+    """
+    Geminiにファイルをアップロードする。
+
+    Args:
+        file: ファイルのパス、またはバイナリのファイルオブジェクト (seek できるもの)
+        mime_type: ファイルオブジェクトの場合は必須 (内容から判別されないため)
+    """
+    upload_config = {'display_name': display_name}
+    if mime_type:
+        upload_config['mime_type'] = mime_type
+    if hasattr(file, "seek"):
+        # 失敗後に再度呼ばれた場合も先頭から送る
+        file.seek(0)
     try:
         uploaded_file = client.files.upload(
-            file=file_path, 
-            config={'display_name': display_name}
+            file=file, 
+            config=upload_config
         )
         return uploaded_file
     except Exception as e:
         raise e
 
-def delete_files_from_gemini(client, file_names):
-    """Gemini上のファイルを削除する"""
-    for fname in file_names:
-        try:
-            client.files.delete(name=fname)
-        except Exception as e:
-            # 個別の削除エラーはログに出すか無視して続行
-            print(f"Failed to delete {fname}: {e}")
+def upload_file_to_gemini_cached(client, file, display_name, sha256, size, model=config.PRIMARY_MODEL, mime_type=None, owner=None):
+    """
+    内容ハッシュが一致するファイルが既にアップロード済みならそれを再利用し、
+    無ければアップロードして索引に登録する。
+    file / mime_type は upload_file_to_gemini と同じ。file には、アップロードが必要になった時点で
+    呼ばれてパスまたはファイルオブジェクトを返す関数も渡せる (再利用する場合は呼ばれない)。
+    owner を指定すると、再利用・アップロードしたファイルをそのセッションのものとして台帳に登録する。
 
-def create_chat_session(client, model, system_instruction, history=[]):
-    """チャットセッションを作成する"""
-    generation_config = types.GenerateContentConfig(
-        system_instruction=system_instruction,
-        temperature=0.2
+    Returns:
+        tuple: (gemini_file, from_cache)
+    """
+    cached = file_cache.lookup(sha256, size, model)
+    metrics.increment("upload_cache_lookups", result="hit" if cached else "miss")
+    if cached:
+        # 見つけた時点で持ち主として登録し、他のセッションのリセットや掃除で削除されないようにする
+        file_lifecycle.register([cached["name"]], owner)
+        gemini_file = types.File(
+            name=cached["name"],
+            uri=cached["uri"],
+            mime_type=cached["mime_type"],
+            display_name=display_name,
+        )
+        return gemini_file, True
+
+    if callable(file):
+        file = file()
+    uploaded_file = upload_file_to_gemini(client, file, display_name, mime_type)
+    # 持ち主のセッションが決まる前に中断されても、掃除で削除されるよう台帳に載せておく
+    file_lifecycle.register([uploaded_file.name], owner)
+    expires_at = None
+    if uploaded_file.expiration_time:
+        # 失効直前のファイルを掴まないよう、1時間早めに期限切れとして扱う
+        expires_at = uploaded_file.expiration_time.timestamp() - 60 * 60
+    evicted = file_cache.record(
+        sha256, size, model,
+        uploaded_file.name, uploaded_file.uri, uploaded_file.mime_type,
+        expires_at=expires_at,
     )
+    if evicted:
+        # 索引から外れても、使っているセッションがあるファイルはそのまま残す
+        file_lifecycle.reclaim(client, evicted)
+    return uploaded_file, False
+
+def delete_files_from_gemini(client, file_names):
+    """Gemini上のファイルを削除する (並列に削除し、台帳と索引からも外す)"""
+    return file_lifecycle.delete_files(client, file_names)
+
+@metrics.timed("chat_create")
+def create_chat_session(client, model, system_instruction, history=[], cached_content=None):
+    """
+    チャットセッションを作成する。
+    cached_content (コンテキストキャッシュ名) を指定した場合、システム指示はキャッシュに含まれているので送らない。
+    """
+    if cached_content:
+        generation_config = types.GenerateContentConfig(
+            cached_content=cached_content,
+            temperature=config.TEMPERATURE
+        )
+    else:
+        generation_config = types.GenerateContentConfig(
+            system_instruction=system_instruction,
+            temperature=config.TEMPERATURE
+        )
     return client.chats.create(
         model=model,
         config=generation_config,
         history=history
     )
 
+def _create_session_for(client, model, system_instruction, history, context):
+    """
+    context (context_cache.SessionContext) があれば、そのモデル用のコンテキストキャッシュを参照する
+    セッションを作る (キャッシュを使えない場合は資料を含む履歴で作る)。
+    """
+    cached_content = None
+    if context is not None:
+        history, cached_content = context.resolve(client, model, history)
+    return create_chat_session(client, model, system_instruction, history, cached_content)
+
+def restore_chat_session(client, model, system_instruction, content, prompt, response_text):
+    """
+    保存済みの回答から、その回答を受け取った直後と同じ状態のチャットセッションを作る。
+    chats.create はローカルでセッションを作るだけなので、APIは呼ばれない。
+    """
+    contents = content if isinstance(content, list) else [content]
+    user_parts = []
+    for item in contents + [prompt]:
+        if isinstance(item, types.File):
+            user_parts.append(types.Part.from_uri(file_uri=item.uri, mime_type=item.mime_type))
+        else:
+            user_parts.append(types.Part.from_text(text=item))
+    history = [
+        types.Content(role="user", parts=user_parts),
+        types.Content(role="model", parts=[types.Part.from_text(text=response_text)]),
+    ]
+    return create_chat_session(client, model, system_instruction, history)
+
+def generate_with_fallback(client, contents, system_instruction):
+    """
+    ストリーミングせずに1回だけ生成する (要約の分割処理などで使う)。
+    429/503の場合はスケジューラに従ってFallbackモデルやバックオフ後に再試行する。
+
+    Returns:
+        tuple: (response_text, used_model)
+    """
+    sched = scheduler.get_scheduler()
+    generation_config = types.GenerateContentConfig(
+        system_instruction=system_instruction,
+        temperature=config.TEMPERATURE
+    )
+    last_error = None
+    for attempt in range(config.MAX_RETRY_ROUNDS):
+        for model_name in sched.models_to_try():
+            slot = sched.acquire(model_name)
+            try:
+                response = client.models.generate_content(
+                    model=model_name,
+                    contents=contents,
+                    config=generation_config
+                )
+            except (errors.ClientError, errors.ServerError) as e:
+                slot.release(e)
+                if not scheduler.is_retryable_error(e):
+                    raise
+                last_error = e
+                continue
+            slot.release()
+            return (response.text or ""), model_name
+        if attempt < config.MAX_RETRY_ROUNDS - 1:
+            sched.wait_before_retry(attempt, last_error)
+    raise last_error
+
 def clean_stream_generator(stream):
     """
     ストリームからテキストを抽出し、エスケープされた改行文字を修正してyieldするジェネレータ
+    chunkの境目で "\\" と "n" が分かれても修正できるよう、末尾の "\\" は次のchunkに持ち越す
     """
+    pending = ""
     for chunk in stream:
-        if chunk.text:
-            yield chunk.text.replace("\\n", "\n")
+        if not chunk.text:
+            continue
+        text = pending + chunk.text
+        pending = ""
+        if text.endswith("\\"):
+            text, pending = text[:-1], "\\"
+        if text:
+            yield text.replace("\\n", "\n")
+    if pending:
+        yield pending
 
 
 
-def send_message_stream_with_fallback(client, content, prompt, system_instruction, previous_history=[]):
+def _open_stream(model_name, send, slot=None):
+    """
+    スケジューラの実行枠を確保してストリーミングを開始し、最初のchunkまで取得する。
+    send_message_stream はジェネレータを返すが、実際のリクエスト開始やエラー発生は
+    最初の要素を取得する時まで遅延する場合があるため、ここで429エラーを確実に捕捉する。
+    実行枠はストリームを読み終えた (または破棄された) 時点で返却される。
+    slot を渡した場合は、確保済みのその枠を使う。
     """
-    メッセージをストリーミング送信し、429エラーが発生した場合はFallbackモデルで再試行する。
-    
+    if slot is None:
+        slot = scheduler.get_scheduler().acquire(model_name)
+    started_at = time.perf_counter()
+    try:
+        iterator = iter(send())
+        try:
+            first_chunk = next(iterator)
+        except StopIteration:
+            # 空のレスポンスの場合
+            first_chunk = None
+    except Exception as e:
+        slot.release(e)
+        raise
+    metrics.observe("time_to_first_chunk_seconds", time.perf_counter() - started_at, model=model_name)
+
+    # 最初のchunkと残りのiteratorを結合したストリームを返す
+    return _SlotStream(slot, first_chunk, iterator)
+
+class _SlotStream:
+    """
+    最初のchunkと残りのiteratorを結合したストリーム。
+    読み終えた時、エラーになった時、閉じられた (破棄された) 時にスケジューラの実行枠を返す。
+    """
+
+    def __init__(self, slot, first_chunk, iterator):
+        self.slot = slot
+        self.first_chunk = first_chunk
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.first_chunk:
+            chunk, self.first_chunk = self.first_chunk, None
+            return chunk
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.slot.release()
+            raise
+        except Exception as e:
+            self.slot.release(e)
+            raise
+
+    def close(self, cancelled=False):
+        """
+        ストリームを閉じてから実行枠を返す (リクエストが終わるまで同時実行数に数える)。
+        cancelled が真なら、結果を使わなかったものとしてブレーカーには成否を記録しない。
+        """
+        close = getattr(self.iterator, "close", None)
+        try:
+            if close:
+                close()
+        finally:
+            if cancelled:
+                self.slot.cancel()
+            else:
+                self.slot.release()
+
+    def __del__(self):
+        self.slot.release()
+
+def send_chat_message_stream(chat, prompt, model_name):
+    """既存のチャットセッションにストリーミング送信する (スケジューラ経由)"""
+    stream = clean_stream_generator(_open_stream(model_name, lambda: chat.send_message_stream(prompt)))
+    return metrics.measure_text_stream(stream, model=model_name)
+
+def _build_message_payload(content, prompt):
+    if isinstance(content, list):
+        return content + [prompt] if prompt else content
+    return [content, prompt] if prompt else [content]
+
+def send_message_stream_with_fallback(client, content, prompt, system_instruction, previous_history=[], context=None, models=None, notify=None):
+    """
+    メッセージをストリーミング送信し、429/503エラーが発生した場合はFallbackモデルで再試行する。
+    どのモデルも混雑している場合は、スケジューラのバックオフに従って待ってから再試行する。
+    context (context_cache.SessionContext) を渡すと、資料は送り直さずにコンテキストキャッシュを参照する。
+    models を渡すと、1巡目はそのモデルの順番で試す (呼び出し元で決めた順番を使い回す場合)。
+    notify を渡すと、モデルの切り替えなどの案内をそれに渡す (jobs.Job.notify など)。
+    ワーカースレッドからも呼ばれるので、ここではStreamlitの描画をしない。
+
     Returns:
         tuple: (chat_session, response_stream, used_model)
+
+    Raises:
+        混雑以外のAPIエラーはそのまま送出する。再試行しても全モデルが混雑していた場合は最後のエラーを送出する。
     """
-    primary_model = "gemini-2.5-flash"
-    fallback_model = "gemini-2.5-flash-lite"
-    models_to_try = [primary_model, fallback_model]
-    
-    if isinstance(content, list):
-        message_payload = content + [prompt] if prompt else content
-    else:
-        message_payload = [content, prompt] if prompt else [content]
-        
-    active_chat = None
-    response_stream = None
-    used_model = ""
+    sched = scheduler.get_scheduler()
+    message_payload = _build_message_payload(content, prompt)
 
-    for model_name in models_to_try:
-        try:
-            chat = create_chat_session(client, model_name, system_instruction, previous_history)
-            
-            # send_message_stream はジェネレータを返すが、実際のリクエスト開始やエラー発生は
-            # 最初の要素を取得する時まで遅延する場合がある。
-            # そのため、ここで最初のchunkを取得してみることで、429エラーをこのtryブロック内で確実に捕捉する。
-            stream = chat.send_message_stream(message_payload)
-            
-            # イテレータ化して最初の要素を取得
-            iterator = iter(stream)
+    last_error = None
+    for attempt in range(config.MAX_RETRY_ROUNDS):
+        round_models = models if attempt == 0 and models else sched.models_to_try()
+        for model_name in round_models:
             try:
-                first_chunk = next(iterator)
-            except StopIteration:
-                # 空のレスポンスの場合
-                first_chunk = None
-
-            # 成功したら、最初のchunkと残りのiteratorを結合して新しいジェネレータを作る
-            def reconstructed_stream():
-                if first_chunk:
-                    yield first_chunk
-                yield from iterator
-
-            active_chat = chat
-            # clean_stream_generator には結合したジェネレータを渡す
-            response_stream = clean_stream_generator(reconstructed_stream())
-            used_model = model_name
-            break
+                chat = _create_session_for(client, model_name, system_instruction, previous_history, context)
+                stream = _open_stream(model_name, lambda: chat.send_message_stream(message_payload))
+                # clean_stream_generator には結合したジェネレータを渡す
+                stream = metrics.measure_text_stream(clean_stream_generator(stream), model=model_name)
+                return chat, stream, model_name
 
-        except (errors.ClientError, errors.ServerError) as e:
-            if e.code in [429, 503] or "429" in str(e) or "503" in str(e):
-                st.warning(f"モデル {model_name} が混雑しています(429/503)。次のモデルに切り替えます...")
-                time.sleep(1)
-                continue
-            else:
-                st.error(f"APIエラーが発生しました: {e}")
-                break
+            except (errors.ClientError, errors.ServerError) as e:
+                if not scheduler.is_retryable_error(e):
+                    raise
+                metrics.increment("model_fallbacks", model=model_name)
+                if notify:
+                    notify(f"モデル {model_name} が混雑しています(429/503)。次のモデルに切り替えます...")
+                last_error = e
+
+        if attempt < config.MAX_RETRY_ROUNDS - 1:
+            sched.wait_before_retry(attempt, last_error)
+
+    raise last_error
+
+class _HedgeCancelled(Exception):
+    """勝者が決まった後に実行枠が取れたため、送らずに取り消したヘッジのリクエスト"""
+
+def send_message_stream_hedged(client, content, prompt, system_instruction, previous_history=[], report=None, context=None, notify=None):
+    """
+    send_message_stream_with_fallback のヘッジ版。
+    Primaryモデルが HEDGE_DELAY_SECONDS 以内に最初のchunkを返さない場合、Fallbackモデルにも
+    同じリクエストを送り、先に最初のchunkを返した方を採用して、もう一方は破棄する。
+    ヘッジが無効な場合や、Primaryモデルが使えない状態の場合は従来どおりの動作になる。
+
+    Args:
+        report: 渡された場合、結果の内訳を書き込む dict
+            {"winner", "hedged", "time_to_first_chunk", "primary_time_to_first_chunk", "saved_seconds"}
+            primary_time_to_first_chunk と saved_seconds は、破棄したPrimaryの応答が
+            後から届いた時点で書き込まれる。
+        context, notify: send_message_stream_with_fallback と同じ
+
+    Returns:
+        tuple: (chat_session, response_stream, used_model)
+
+    Raises:
+        send_message_stream_with_fallback と同じ
+    """
+    if report is None:
+        report = {}
+    sched = scheduler.get_scheduler()
+    models_to_try = sched.models_to_try()
+    if not config.HEDGE_ENABLED or len(models_to_try) < 2:
+        chat, stream, used_model = send_message_stream_with_fallback(
+            client, content, prompt, system_instruction, previous_history, context,
+            models=models_to_try, notify=notify
+        )
+        report.update({"winner": used_model, "hedged": False})
+        return chat, stream, used_model
+
+    primary_model, fallback_model = models_to_try[0], models_to_try[1]
+    message_payload = _build_message_payload(content, prompt)
+    results = queue.Queue()
+    started_at = time.monotonic()
+    # 勝者が決まった後に実行枠が取れた方は、送らずに枠を返す
+    # (送信済みの方は、リクエストが終わるまで枠を持ち、ストリームを閉じた時点で返す)
+    cancelled = threading.Event()
+
+    def attempt(model_name):
+        # ワーカースレッドで実行するので、ここではStreamlitの描画をしない
+        slot = sched.acquire(model_name)
+        if cancelled.is_set():
+            slot.cancel()
+            results.put((model_name, None, None, _HedgeCancelled(), time.monotonic() - started_at))
+            return
+        try:
+            chat = _create_session_for(client, model_name, system_instruction, previous_history, context)
+            stream = _open_stream(model_name, lambda: chat.send_message_stream(message_payload), slot)
         except Exception as e:
-            st.error(f"予期せぬエラーが発生しました: {e}")
+            # セッションを作れなかった場合も枠を返す (_open_stream で返した後なら何もしない)
+            slot.release(e)
+            results.put((model_name, None, None, e, time.monotonic() - started_at))
+            return
+        results.put((model_name, chat, stream, None, time.monotonic() - started_at))
+
+    def launch(model_name):
+        threading.Thread(target=attempt, args=(model_name,), daemon=True).start()
+
+    launch(primary_model)
+    fallback_launched = False
+    pending = 1
+    winner = None
+    last_error = None
+
+    while pending:
+        try:
+            # Fallbackを出す前は、ヘッジ開始までの時間だけ待つ
+            timeout = None if fallback_launched else config.HEDGE_DELAY_SECONDS
+            item = results.get(timeout=timeout)
+        except queue.Empty:
+            metrics.increment("hedges_launched", model=fallback_model)
+            report["hedged"] = True
+            launch(fallback_model)
+            fallback_launched = True
+            pending += 1
+            continue
+
+        pending -= 1
+        model_name, chat, stream, error, elapsed = item
+        if error is None:
+            winner = item
             break
-            
-    return active_chat, response_stream, used_model
+
+        if model_name == primary_model:
+            report["primary_time_to_first_chunk"] = None
+        if not scheduler.is_retryable_error(error):
+            if pending:
+                # もう一方の結果を待つ
+                last_error = error
+                continue
+            raise error
+        last_error = error
+        if not fallback_launched:
+            # Primaryが混雑で失敗した場合は、待たずにFallbackを出す (従来の切り替えと同じ)
+            metrics.increment("model_fallbacks", model=model_name)
+            if notify:
+                notify(f"モデル {model_name} が混雑しています(429/503)。次のモデルに切り替えます...")
+            launch(fallback_model)
+            fallback_launched = True
+            pending += 1
+
+    if winner is None:
+        # どちらも混雑している場合は、バックオフしてから通常の再試行に任せる
+        sched.wait_before_retry(0, last_error)
+        chat, stream, used_model = send_message_stream_with_fallback(
+            client, content, prompt, system_instruction, previous_history, context, notify=notify
+        )
+        report.update({"winner": used_model})
+        return chat, stream, used_model
+
+    model_name, chat, stream, _, elapsed = winner
+    report.setdefault("hedged", False)
+    report.update({"winner": model_name, "time_to_first_chunk": elapsed})
+    if model_name == primary_model:
+        report["primary_time_to_first_chunk"] = elapsed
+        report["saved_seconds"] = 0.0
+    cancelled.set()
+    if pending:
+        # 負けた方は別スレッドで受け取り、届いたストリームを閉じる
+        threading.Thread(
+            target=_discard_hedge_losers,
+            args=(results, pending, primary_model, elapsed, report),
+            daemon=True,
+        ).start()
+    metrics.increment("hedge_winners", model=model_name, hedged=report["hedged"])
+    stream = metrics.measure_text_stream(clean_stream_generator(stream), model=model_name)
+    return chat, stream, model_name
+
+def _discard_hedge_losers(results, pending, primary_model, winner_elapsed, report):
+    """ヘッジで採用しなかったリクエストを後始末し、Primaryの応答時間を記録する"""
+    for _ in range(pending):
+        model_name, _, stream, error, elapsed = results.get()
+        if stream is not None:
+            # ここで初めて負けた方のリクエストが終わるので、実行枠もここで返す
+            stream.close(cancelled=True)
+        if model_name == primary_model and error is None:
+            report["primary_time_to_first_chunk"] = elapsed
+            report["saved_seconds"] = elapsed - winner_elapsed
+            metrics.observe("hedge_saved_seconds", elapsed - winner_elapsed)
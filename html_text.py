@@ -0,0 +1,245 @@
+import codecs
+import re
+from collections import Counter
+from html.entities import html5
+from html.parser import HTMLParser
+
+# BeautifulSoupの木を作らずに、HTMLから本文の行を取り出す軽量な抽出器
+# utils.extract_text_from_html (html.parser + get_text) と同じ結果になるよう、
+# BeautifulSoupが html.parser を使うときの文字列の扱いをそのまま再現している
+# 入力は少しずつ読み込むので、大きな文書でもメモリ使用量がほぼ一定になる
+
+# 中の文字列が get_text の対象外になるタグ (script/style は decompose 済みの扱い)
+_EXCLUDED_CONTAINERS = {"script", "style", "template", "rt", "rp"}
+
+# 終了タグを持たない要素 (BeautifulSoupの HTMLTreeBuilder.empty_element_tags と同じ)
+_VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen",
+    "link", "menuitem", "meta", "param", "source", "track", "wbr",
+    "basefont", "bgsound", "command", "frame", "image", "isindex",
+    "nextid", "spacer",
+}
+
+# 名前付き文字参照 (bs4 の EntitySubstitution.HTML_ENTITY_TO_CHARACTER と同じ内容。
+# bs4 を読み込まずに済むよう、標準ライブラリの表から末尾の ";" を除いて作る)
+_NAMED_ENTITIES = {name[:-1]: character for name, character in html5.items() if name.endswith(";")}
+
+# 数値文字参照の数字部分と、その後ろに続く (参照ではない) 文字列
+_DECIMAL_REFERENCE = re.compile(r"^([0-9]+)(.*)")
+_HEX_REFERENCE = re.compile(r"^([0-9a-f]+)(.*)")
+
+
+def _numeric_character(number):
+    """
+    数値文字参照の番号を文字にする (HTML仕様の numeric character reference end state)。
+    範囲外・サロゲートは U+FFFD にし、0x80-0x9F はWindows-1252の文字として読む。
+    """
+    if number == 0 or number > 0x10FFFF or 0xD800 <= number <= 0xDFFF:
+        return "\ufffd"
+    if 0x80 <= number <= 0x9F:
+        try:
+            return bytes([number]).decode("cp1252")
+        except UnicodeDecodeError:
+            # Windows-1252で未定義の番号は制御文字のまま残す
+            pass
+    return chr(number)
+
+
+def _dereference_charref(name):
+    """
+    html.parser が渡す数値文字参照 ("12354" / "x3042") を展開する。
+    BeautifulSoup (html.parser) と同じく、数字の後ろに続く文字列は参照の外の文字列として扱う。
+
+    Returns:
+        tuple: (展開した文字, 参照の後ろに続く文字列)
+    """
+    base, pattern = 10, _DECIMAL_REFERENCE
+    if name[:1] in ("x", "X"):
+        name = name[1:]
+        base, pattern = 16, _HEX_REFERENCE
+    try:
+        return _numeric_character(int(name, base)), ""
+    except ValueError:
+        match = pattern.search(name)
+        if match is None:
+            return "", name
+        return _numeric_character(int(match.group(1), base)), match.group(2)
+
+
+class HtmlTextExtractor(HTMLParser):
+    """
+    HTMLを少しずつ feed し、確定した本文の行を pop_lines で受け取る。
+    行は前後の空白を除去済みで、空行は含まない。
+    """
+
+    def __init__(self):
+        # 文字参照は BeautifulSoup と同じ方法で自前で展開する
+        super().__init__(convert_charrefs=False)
+        self._open_tags = []
+        # 閉じられていないタグが多い文書でも終了タグの照合が遅くならないよう、数も持っておく
+        self._open_counts = Counter()
+        self._already_closed_void = []
+        self._excluded_depth = 0
+        self._pending_data = []
+        self._lines = []
+
+    def pop_lines(self):
+        """これまでに確定した行を返し、内部のバッファを空にする"""
+        lines = self._lines
+        self._lines = []
+        return lines
+
+    def close(self):
+        super().close()
+        self._end_data()
+
+    # --- 文字列の区切り ---
+
+    def _end_data(self, included=None):
+        """
+        溜まっている文字列を1つのテキストノードとして確定させる。
+        includedを省略した場合は、除外対象のタグの中かどうかで判定する。
+        """
+        if not self._pending_data:
+            return
+        text = "".join(self._pending_data)
+        self._pending_data = []
+        if included is None:
+            included = self._excluded_depth == 0
+        if included:
+            for line in text.splitlines():
+                line = line.strip()
+                if line:
+                    self._lines.append(line)
+
+    # --- タグ ---
+
+    def handle_starttag(self, tag, attrs):
+        self._end_data()
+        if tag in _VOID_ELEMENTS:
+            # 後から現れる冗長な終了タグ (<br>...</br>) は読み飛ばす
+            self._already_closed_void.append(tag)
+            return
+        self._push_tag(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        # <tag/> は開始と同時に閉じる
+        self._end_data()
+        if tag not in _VOID_ELEMENTS:
+            self._push_tag(tag)
+            self._close_tag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._already_closed_void:
+            # 既に閉じた空要素の終了タグは、文字列の区切りにもならない
+            self._already_closed_void.remove(tag)
+            return
+        self._end_data()
+        self._close_tag(tag)
+
+    def _push_tag(self, tag):
+        self._open_tags.append(tag)
+        self._open_counts[tag] += 1
+        if tag in _EXCLUDED_CONTAINERS:
+            self._excluded_depth += 1
+
+    def _close_tag(self, tag):
+        if not self._open_counts[tag]:
+            # 対応する開始タグが無い終了タグは BeautifulSoup と同様に無視する
+            return
+        while self._open_tags:
+            closed = self._open_tags.pop()
+            self._open_counts[closed] -= 1
+            if closed in _EXCLUDED_CONTAINERS:
+                self._excluded_depth -= 1
+            if closed == tag:
+                break
+
+    # --- 文字列 ---
+
+    def handle_data(self, data):
+        self._pending_data.append(data)
+
+    def handle_charref(self, name):
+        dereferenced, extra_data = _dereference_charref(name)
+        if dereferenced:
+            self.handle_data(dereferenced)
+        if extra_data:
+            self.handle_data(extra_data)
+
+    def handle_entityref(self, name):
+        character = _NAMED_ENTITIES.get(name)
+        self.handle_data(character if character is not None else "&%s" % name)
+
+    # --- 本文に含めないもの (コメント・DOCTYPE・処理命令) ---
+
+    def handle_comment(self, data):
+        self._end_data()
+
+    def handle_decl(self, decl):
+        self._end_data()
+
+    def handle_pi(self, data):
+        self._end_data()
+
+    def unknown_decl(self, data):
+        self._end_data()
+        if data.upper().startswith("CDATA["):
+            # CDATAセクションは template などの中にあっても get_text の対象になる
+            self._pending_data.append(data[len("CDATA["):])
+            self._end_data(included=True)
+        else:
+            self._pending_data.append(data)
+            self._end_data(included=False)
+
+
+def _detect_encoding(fileobj, chunk_size):
+    """
+    全体がUTF-8として読めるかを先に確かめる (読めなければcp932)。
+    途中まで行を返した後にエンコーディングを切り替えることがないよう、解析前に判定する。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                decoder.decode(b"", final=True)
+                return "utf-8"
+            decoder.decode(chunk)
+    except UnicodeDecodeError:
+        return "cp932"
+
+
+def iter_lines(fileobj, chunk_size=64 * 1024, on_text=None):
+    """
+    ファイルオブジェクトからHTMLを少しずつ読み、本文の行を順に返すジェネレータ。
+    文書全体の文字列や木を保持しないので、メモリ使用量は文書の大きさにほぼ依存しない。
+    文字コードは従来どおり utf-8 を試し、読めなければ cp932 として扱う。
+
+    Args:
+        fileobj: 先頭から読めるバイナリのファイルオブジェクト (UploadedFile, BytesIO など)
+        chunk_size: 1回に読むバイト数
+        on_text: 読み込んで文字列にした断片ごとに呼ばれる (同じ読み込みで表の数値なども取り出す場合)
+    """
+    start = fileobj.tell()
+    encoding = _detect_encoding(fileobj, chunk_size)
+    fileobj.seek(start)
+
+    # cp932として読めない場合は、従来と同様に UnicodeDecodeError を送出する
+    decoder = codecs.getincrementaldecoder(encoding)()
+    parser = HtmlTextExtractor()
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        text = decoder.decode(chunk)
+        if on_text:
+            on_text(text)
+        parser.feed(text)
+        yield from parser.pop_lines()
+    text = decoder.decode(b"", final=True)
+    if on_text:
+        on_text(text)
+    parser.feed(text)
+    parser.close()
+    yield from parser.pop_lines()
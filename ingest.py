@@ -0,0 +1,327 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import config
+import extract_cache
+import figures
+import gemini_logic
+import metrics
+import pdf_text
+import utils
+
+# 複数ファイル (トレンド分析・企業比較) の取り込みを並列に行う
+# PDFのアップロードはI/O待ちなのでスレッド、HTMLの解析 (本文・表の数値) とPDFのテキスト抽出は
+# CPUを使うのでプロセスで実行する
+
+logger = logging.getLogger(__name__)
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+class IngestError(Exception):
+    """取り込み中にいずれかのファイルで失敗したことを表す"""
+
+    def __init__(self, display_name, cause):
+        super().__init__(f"{display_name}: {cause}")
+        self.display_name = display_name
+        self.cause = cause
+
+
+def _get_process_pool():
+    """HTML解析用のプロセスプールを返す (Streamlitの再実行をまたいで使い回す)"""
+    global _process_pool
+    if config.INGEST_PARSE_PROCESSES <= 0:
+        return None
+    with _process_pool_lock:
+        if _process_pool is None:
+            try:
+                _process_pool = ProcessPoolExecutor(max_workers=config.INGEST_PARSE_PROCESSES)
+            except (OSError, NotImplementedError):
+                # プロセスを作れない環境ではスレッドで解析する
+                return None
+        return _process_pool
+
+
+def _upload_pdf(client, data, display_name, owner=None):
+    """
+    PDFのバイト列を (コピーせずに) アップロードする。
+    一時ファイルを使う設定でも、アップロード済みのファイルを再利用する場合は書き出さない。
+    """
+    processed_data = utils.prepare_pdf(data, display_name, via_temp_file=False)
+    tmp_paths = []
+
+    def open_content():
+        if config.UPLOAD_VIA_TEMP_FILE:
+            tmp_paths.append(utils.write_temp_file(data, ".pdf"))
+            return tmp_paths[-1]
+        return processed_data["content"]
+
+    try:
+        gemini_file, from_cache = gemini_logic.upload_file_to_gemini_cached(
+            client,
+            open_content,
+            processed_data["display_name"],
+            processed_data["sha256"],
+            processed_data["size"],
+            mime_type=processed_data["mime_type"],
+            owner=owner
+        )
+        return gemini_file, from_cache, processed_data
+    finally:
+        # 一時ファイルを使った場合は、成功・失敗にかかわらず削除
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+@metrics.timed("html_extract")
+def _parse_html(data):
+    """
+    HTMLを1回だけ読み、本文テキストと表の財務数値を取り出す (プロセスプールで実行する)。
+    本文は行ごとに取り出し、表は同じ読み込みで集めるので、バイト列をワーカーに送るのも1回で済む。
+
+    Returns:
+        tuple: (本文テキスト, figures.extract_records と同じ形の財務数値)
+    """
+    extractor = figures.RecordExtractor()
+    text = "\n".join(utils.iter_html_lines(io.BytesIO(data), on_text=extractor.feed))
+    return text, extractor.records()
+
+
+def _extract_pdf_pages(data, display_name, process_pool):
+    """PDFの本文をページごとに取り出す。ローカル抽出を使わない・使えない場合はNone"""
+    if not pdf_text.available():
+        return None
+    try:
+        if process_pool is not None:
+            return process_pool.submit(pdf_text.extract_pages, data).result()
+        return pdf_text.extract_pages(data)
+    except Exception as e:
+        # 暗号化・破損などで読めないPDFは、従来どおりそのままアップロードする
+        logger.warning("Failed to extract PDF text locally (%s): %s", display_name, e)
+        metrics.increment("pdf_local_extract_errors")
+        return None
+
+
+def _ingest_pdf(client, data, display_name, process_pool=None, owner=None):
+    """
+    PDFを取り込む (ワーカースレッドで実行)。
+    テキストを取り出せるPDFは本文をテキストで送り、スキャン画像のページだけをアップロードする。
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    page_texts = _extract_pdf_pages(data, display_name, process_pool)
+    scanned_pages = [number for number, text in enumerate(page_texts or [], start=1) if text is None]
+
+    if page_texts is None or len(scanned_pages) == len(page_texts):
+        # 全ページがスキャン画像の場合も、切り出さずに元のPDFをそのまま送る
+        gemini_file, from_cache, processed_data = _upload_pdf(client, data, display_name, owner)
+        metrics.increment("pdf_pages", processed_data["pages"], mode="upload")
+        return {
+            "type": "pdf",
+            "file": gemini_file,
+            "from_cache": from_cache,
+            "sha256": sha256,
+            "pages": processed_data["pages"],
+            "page_texts": None
+        }
+
+    metrics.increment("pdf_pages", len(page_texts) - len(scanned_pages), mode="local")
+    gemini_file, from_cache = None, True
+    if scanned_pages:
+        metrics.increment("pdf_pages", len(scanned_pages), mode="scanned")
+        gemini_file, from_cache, _ = _upload_pdf(
+            client,
+            pdf_text.extract_scanned_pages(data, scanned_pages),
+            pdf_text.scanned_display_name(display_name),
+            owner
+        )
+    return {
+        "type": "pdf",
+        "file": gemini_file,
+        "from_cache": from_cache,
+        "sha256": sha256,
+        "pages": len(page_texts),
+        "page_texts": page_texts
+    }
+
+
+@metrics.timed("ingest")
+def ingest_files(client, uploaded_files, on_progress=None, owner=None):
+    """
+    アップロードされたファイルを並列に処理し、Geminiに送る文書を入力順で返す。
+    いずれかのファイルで失敗した場合は、今回新たにアップロードしたファイルを削除してから
+    IngestErrorを送出する。
+
+    Args:
+        client: Geminiクライアント
+        uploaded_files: StreamlitのUploadedFileオブジェクトのリスト
+        on_progress: 1ファイル完了ごとに (完了数, 総数, ファイル名) で呼ばれるコールバック。
+            ingest_files を呼び出したスレッドから呼ばれる (ワーカーの中からは呼ばない)。
+        owner: アップロード・再利用したファイルを台帳に登録する持ち主 (セッションID)
+
+    Returns:
+        tuple: (documents, uploaded_gemini_file_names)
+            documents は入力順の dict のリスト: {
+                "type": "pdf" or "html",
+                "display_name": filename,
+                "content": Geminiに送るコンテンツ (アップロードしたPDFはFile、
+                    HTML・本文を取り出したPDFはヘッダー付きテキスト),
+                "sha256": content_hash,
+                "pages": estimated_page_count (PDF only),
+                "text": clean_text (HTML・本文を取り出したPDF),
+                "page_texts": ページごとの本文。スキャン画像のページはNone (本文を取り出したPDF only),
+                "scanned_file": スキャン画像のページを切り出してアップロードしたFile (該当ページがある場合のみ),
+                "figures": figures.extract_records の結果 (HTML only)
+            }
+            Geminiに送る順のコンテンツは map_reduce.document_contents で作る。
+    """
+    # UploadedFileはスレッド・プロセス間で共有しないよう、ここでバイト列にしておく
+    items = []
+    for u_file in uploaded_files:
+        file_type = utils.get_file_type(u_file.name)
+        if file_type:
+            items.append((file_type, u_file.name, u_file.getvalue()))
+
+    total = len(items)
+    html_hashes = [
+        hashlib.sha256(data).hexdigest() if file_type == "html" else None
+        for file_type, _, data in items
+    ]
+    cache_keys = [extract_cache.key_for_hash(h) if h else None for h in html_hashes]
+    results = [None] * total
+    # HTMLは本文と表の数値の処理 (別々に行う場合は2つ) が終わった時点で完了にする
+    remaining = [1] * total
+    failure = None
+    needs_process_pool = any(t == "html" for t, _, _ in items) or (
+        pdf_text.available() and any(t == "pdf" for t, _, _ in items)
+    )
+    process_pool = _get_process_pool() if needs_process_pool else None
+
+    with ThreadPoolExecutor(max_workers=config.INGEST_UPLOAD_WORKERS) as thread_pool:
+        futures = {}
+        done = 0
+
+        def submit_parse(func, data):
+            if process_pool is not None:
+                return process_pool.submit(func, data)
+            return thread_pool.submit(func, data)
+
+        for index, (file_type, display_name, data) in enumerate(items):
+            if file_type == "pdf":
+                futures[thread_pool.submit(_ingest_pdf, client, data, display_name, process_pool, owner)] = (index, "pdf")
+                continue
+
+            # 解析済みのHTMLはキャッシュから取り出し、ワーカーには渡さない
+            results[index] = {"type": "html", "text": None, "figures": None}
+            cached_text = extract_cache.get(cache_keys[index])
+            cached_figures = extract_cache.get(figures.cache_key(html_hashes[index]))
+            remaining[index] = 0
+            if cached_text is None and cached_figures is None and config.HTML_EXTRACT_BACKEND == "stream":
+                # 本文も表もまだ無い場合は、1回の読み込みで両方を取り出す
+                futures[submit_parse(_parse_html, data)] = (index, "html")
+                remaining[index] = 1
+                continue
+            if cached_text is not None:
+                results[index]["text"] = cached_text
+            else:
+                futures[submit_parse(utils.extract_text_from_html, data)] = (index, "text")
+                remaining[index] += 1
+            if cached_figures is not None:
+                results[index]["figures"] = figures.load_records(cached_figures)
+            else:
+                futures[submit_parse(figures.extract_records, data)] = (index, "figures")
+                remaining[index] += 1
+            if remaining[index] == 0:
+                done += 1
+                if on_progress:
+                    on_progress(done, total, display_name)
+
+        for future in as_completed(futures):
+            index, kind = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                if failure is None:
+                    failure = IngestError(items[index][1], e)
+                    # まだ始まっていない処理は取り消す (実行中のものは完了を待って後始末する)
+                    for other in futures:
+                        other.cancel()
+                continue
+
+            if kind == "html":
+                text, records = result
+                extract_cache.put(cache_keys[index], text)
+                extract_cache.put(figures.cache_key(html_hashes[index]), figures.dump_records(records))
+                results[index]["text"] = text
+                results[index]["figures"] = records
+            elif kind == "text":
+                extract_cache.put(cache_keys[index], result)
+                results[index]["text"] = result
+            elif kind == "figures":
+                extract_cache.put(figures.cache_key(html_hashes[index]), figures.dump_records(result))
+                results[index]["figures"] = result
+            else:
+                results[index] = result
+            remaining[index] -= 1
+            if remaining[index]:
+                continue
+            done += 1
+            if on_progress and failure is None:
+                on_progress(done, total, items[index][1])
+
+    if failure is not None:
+        # 途中までアップロードしたファイルを片付ける (他で再利用中のキャッシュは残す)
+        fresh_uploads = [
+            r["file"].name for r in results
+            if r and r["type"] == "pdf" and r["file"] is not None and not r["from_cache"]
+        ]
+        if fresh_uploads:
+            gemini_logic.delete_files_from_gemini(client, fresh_uploads)
+        raise failure
+
+    documents = []
+    uploaded_names = []
+    for index, ((file_type, display_name, data), result) in enumerate(zip(items, results)):
+        if file_type == "pdf" and result["page_texts"] is not None:
+            page_texts = result["page_texts"]
+            documents.append({
+                "type": "pdf",
+                "display_name": display_name,
+                # ページごとに (P.XX) の印を付けたテキストで送る
+                "content": pdf_text.build_content(display_name, page_texts),
+                "sha256": result["sha256"],
+                "pages": result["pages"],
+                "text": "\n".join(text for text in page_texts if text),
+                "page_texts": page_texts,
+                "scanned_file": result["file"]
+            })
+            if result["file"] is not None:
+                uploaded_names.append(result["file"].name)
+        elif file_type == "pdf":
+            documents.append({
+                "type": "pdf",
+                "display_name": display_name,
+                "content": result["file"],
+                "sha256": result["sha256"],
+                "pages": result["pages"],
+                # 分割要約でページ範囲ごとのPDFを切り出すため、元のバイト列も持っておく
+                "data": data
+            })
+            uploaded_names.append(result["file"].name)
+        else:
+            documents.append({
+                "type": "html",
+                "display_name": display_name,
+                # HTMLテキストはヘッダーをつけて送る
+                "content": f"--- File: {display_name} ---\n{result['text']}",
+                "sha256": html_hashes[index],
+                "text": result["text"],
+                "figures": result["figures"]
+            })
+    return documents, uploaded_names
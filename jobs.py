@@ -0,0 +1,252 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import metrics
+
+# 分析・チャット応答などの重い処理を、Streamlitのスクリプト実行とは別のスレッドで動かすジョブ管理
+# - 出力 (ストリーミングのchunk) はジョブごとのバッファに溜め、画面側はそれを追いかけて表示する
+# - 画面の再実行・ブラウザの再読み込みで表示が中断しても、処理は続き、途中から表示し直せる
+# - 同じ内容のジョブを重ねて投入した場合は、実行中 (または完了済み) のジョブを返す
+# - サーバー全体で同時に実行するジョブ数に上限を設け、超えた分は順番待ちにする
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+_FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """ジョブが取り消されたことを表す (ワーカー内で送出して処理を打ち切る)"""
+
+
+class JobError(Exception):
+    """ジョブの失敗を、画面に表示するメッセージ付きで表す"""
+
+
+class Job:
+    """
+    1件のジョブの状態と出力バッファ。
+    ワーカースレッドが書き込み、画面側 (スクリプト実行スレッド) が読み出す。
+    """
+
+    def __init__(self, job_id, kind, owner):
+        self.job_id = job_id
+        self.kind = kind
+        self.owner = owner
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # 出力のchunk。再試行で出力をやり直すと generation が増える
+        self.chunks = []
+        self.generation = 0
+        # 進捗 (0.0〜1.0, 表示文) と、画面に出す警告メッセージ
+        self.progress = None
+        self.notices = []
+        # ワーカーが書き込む結果 (途中経過を含む)
+        self.result = {}
+        self.error = None
+        self.cancel_requested = False
+        # 状態が変わるたびに増える番号 (画面側の待ち合わせ用)
+        self.version = 0
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in _FINISHED
+
+    @property
+    def text(self):
+        with self._cond:
+            return "".join(self.chunks)
+
+    def _changed(self):
+        self.version += 1
+        self._cond.notify_all()
+
+    # --- ワーカー側 ---
+
+    def check_cancelled(self):
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def write(self, text):
+        """出力を1chunk追加する"""
+        self.check_cancelled()
+        with self._cond:
+            self.chunks.append(text)
+            self._changed()
+
+    def restart_output(self):
+        """再試行のため、それまでの出力を捨てる"""
+        with self._cond:
+            self.chunks = []
+            self.generation += 1
+            self._changed()
+
+    def set_progress(self, fraction, text):
+        with self._cond:
+            self.progress = (fraction, text)
+            self._changed()
+
+    def notify(self, message):
+        """画面に表示する警告メッセージを追加する (再試行の案内など)"""
+        with self._cond:
+            self.notices.append(message)
+            self._changed()
+
+    def _set_status(self, status, error=None):
+        with self._cond:
+            self.status = status
+            if status == RUNNING:
+                self.started_at = time.time()
+            elif status in _FINISHED:
+                self.finished_at = time.time()
+                self.error = error
+            self._changed()
+
+    # --- 画面側 ---
+
+    def wait(self, version, timeout):
+        """
+        状態が version から変わるか timeout 秒経つまで待ち、現在の version を返す。
+        """
+        with self._cond:
+            if self.version == version and not self.finished:
+                self._cond.wait(timeout)
+            return self.version
+
+    def tail(self, start=0, heartbeat=None):
+        """
+        出力を start 番目のchunkから順に返すジェネレータ。
+        ジョブが終わるか、再試行で出力がやり直しになったら終了する。
+        st.write_stream にそのまま渡せる。
+
+        Args:
+            heartbeat: 指定すると、新しい出力が無いまま heartbeat 秒経つたびに空文字を返す
+                (stream_render.coalesce が時間でまとめた出力を表示するため)
+        """
+        index = start
+        with self._cond:
+            generation = self.generation
+        while True:
+            with self._cond:
+                waited = False
+                while (
+                    index >= len(self.chunks)
+                    and not self.finished
+                    and self.generation == generation
+                    and not (heartbeat and waited)
+                ):
+                    self._cond.wait(timeout=heartbeat or 1.0)
+                    waited = True
+                if self.generation != generation:
+                    return
+                new_chunks = self.chunks[index:]
+                finished = self.finished
+            if not new_chunks and not finished:
+                yield ""
+            for chunk in new_chunks:
+                yield chunk
+            index += len(new_chunks)
+            if finished:
+                return
+
+
+class JobManager:
+    """ジョブの投入・重複排除・同時実行数の制御を行う (プロセス全体で1つ)"""
+
+    def __init__(self, max_concurrent):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_concurrent), thread_name_prefix="fsbot-job")
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, kind, key_parts, func, owner=None):
+        """
+        ジョブを投入する。同じ kind・key_parts・owner のジョブが実行中・順番待ち・完了済みなら
+        新しく実行せずにそれを返す (失敗・取り消し済みの場合は実行し直す)。
+
+        Args:
+            kind: ジョブの種類 ("analysis", "chat" など)
+            key_parts: 重複判定に使う値のリスト (文字列にして連結する)
+            func: ワーカーで実行する関数。func(job) の形で呼ばれる
+            owner: ジョブを投入したセッションのID
+
+        Returns:
+            Job: 投入された (または既存の) ジョブ
+        """
+        digest = hashlib.sha256()
+        for part in [kind, owner] + list(key_parts):
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\0")
+        job_id = digest.hexdigest()[:32]
+
+        with self.lock:
+            self._prune()
+            existing = self.jobs.get(job_id)
+            if existing is not None and existing.status not in (FAILED, CANCELLED):
+                metrics.increment("jobs_deduplicated", kind=kind)
+                return existing
+            job = Job(job_id, kind, owner)
+            self.jobs[job_id] = job
+
+        metrics.increment("jobs_submitted", kind=kind)
+        self.executor.submit(self._run, job, func)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel_owner(self, owner):
+        """セッションのジョブをすべて取り消す (実行中のものは次のchunkで止まる)"""
+        with self.lock:
+            targets = [job for job in self.jobs.values() if job.owner == owner and not job.finished]
+        for job in targets:
+            job.cancel_requested = True
+        return targets
+
+    def _prune(self):
+        """保持期間を過ぎた終了済みジョブを捨てる (lockを取った状態で呼ぶ)"""
+        expire_before = time.time() - config.JOB_RETENTION_SECONDS
+        for job_id in [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished and job.finished_at < expire_before
+        ]:
+            del self.jobs[job_id]
+
+    def _run(self, job, func):
+        if job.cancel_requested:
+            job._set_status(CANCELLED)
+            return
+        job._set_status(RUNNING)
+        metrics.observe("job_queue_seconds", job.started_at - job.created_at, kind=job.kind)
+        try:
+            func(job)
+        except JobCancelled:
+            job._set_status(CANCELLED)
+        except JobError as e:
+            job._set_status(FAILED, str(e))
+        except Exception as e:
+            job._set_status(FAILED, f"予期せぬエラー: {e}")
+        else:
+            job._set_status(DONE)
+        metrics.observe("job_seconds", job.finished_at - job.started_at, kind=job.kind, status=job.status)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """プロセス全体で共有するジョブ管理を返す (Streamlitの全セッションで共通)"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(config.JOB_MAX_CONCURRENT)
+        return _manager
@@ -0,0 +1,275 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.genai import types
+import config
+import gemini_logic
+import pdf_text
+import prompts
+
+# 入力トークン数を見積もり、コンテキストに収まる場合は従来どおり一括送信、
+# 収まらない場合は資料をセクションに分けて部分要約 (map) し、それらを統合 (reduce) する
+
+logger = logging.getLogger(__name__)
+
+# Geminiが PDF 1ページあたりに消費するトークン数
+PDF_TOKENS_PER_PAGE = 258
+
+# EDINET/TDnet の本文で見出しとして使われる行 (【...】、第N部、第N章 など)
+_HEADING_PATTERN = re.compile(r"^(【.+】|第[0-9０-９一二三四五六七八九十]+[部章節]|[0-9０-９]+【.+】)")
+
+
+def is_heading(line):
+    """本文の行が見出し (【...】、第N部 など) かどうか"""
+    return bool(_HEADING_PATTERN.match(line))
+
+
+def estimate_tokens(text):
+    """
+    テキストのトークン数を見積もる。
+    日本語は1文字あたりおおよそ1トークン、ASCIIは4文字で1トークンとして数える。
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def estimate_document_tokens(document):
+    """ingest.ingest_files が返す文書1件のトークン数を見積もる"""
+    if document["type"] == "pdf" and document.get("page_texts") is None:
+        return document["pages"] * PDF_TOKENS_PER_PAGE
+    tokens = estimate_tokens(document["content"])
+    if document.get("scanned_file") is not None:
+        tokens += document["page_texts"].count(None) * PDF_TOKENS_PER_PAGE
+    return tokens
+
+
+def document_contents(documents):
+    """文書のリストから、Geminiに送るコンテンツを入力順に並べたリストを作る"""
+    contents = []
+    for document in documents:
+        contents.append(document["content"])
+        if document.get("scanned_file") is not None:
+            contents.append(document["scanned_file"])
+    return contents
+
+
+def estimate_request_tokens(documents, prompt, system_instruction):
+    """一括送信した場合の入力トークン数を見積もる"""
+    return (
+        sum(estimate_document_tokens(d) for d in documents)
+        + estimate_tokens(prompt)
+        + estimate_tokens(system_instruction)
+    )
+
+
+def split_html_sections(text, token_budget):
+    """
+    HTMLから抽出した本文を見出し行で区切り、token_budget以内のセクションにまとめる。
+    1つの見出しの中身が大きすぎる場合は行単位でさらに分割する。
+
+    Returns:
+        list: [(section_label, section_text), ...]
+    """
+    # 見出しごとのブロックに分ける
+    blocks = []
+    heading, lines = "冒頭", []
+    for line in text.split("\n"):
+        if is_heading(line) and lines:
+            blocks.append((heading, lines))
+            heading, lines = line, []
+        elif is_heading(line):
+            heading = line
+        lines.append(line)
+    if lines:
+        blocks.append((heading, lines))
+
+    # 予算に収まるまで隣接するブロックをまとめる
+    sections = []
+    current_labels, current_lines, current_tokens = [], [], 0
+    for heading, block_lines in blocks:
+        for line in block_lines:
+            line_tokens = estimate_tokens(line)
+            if current_lines and current_tokens + line_tokens > token_budget:
+                sections.append((current_labels, current_lines))
+                current_labels, current_lines, current_tokens = [], [], 0
+            if not current_labels or current_labels[-1] != heading:
+                current_labels.append(heading)
+            current_lines.append(line)
+            current_tokens += line_tokens
+    if current_lines:
+        sections.append((current_labels, current_lines))
+
+    result = []
+    for labels, section_lines in sections:
+        label = labels[0] if len(labels) == 1 else f"{labels[0]} 〜 {labels[-1]}"
+        result.append((label, "\n".join(section_lines)))
+    return result
+
+
+def split_pdf_sections(pages, token_budget):
+    """
+    PDFをページ範囲で分割する。
+
+    Returns:
+        list: [(section_label, first_page, last_page), ...]
+    """
+    pages_per_section = max(1, token_budget // PDF_TOKENS_PER_PAGE)
+    sections = []
+    for first_page in range(1, pages + 1, pages_per_section):
+        last_page = min(pages, first_page + pages_per_section - 1)
+        sections.append((f"P.{first_page}〜P.{last_page}", first_page, last_page))
+    return sections
+
+
+def split_page_text_sections(page_texts, token_budget):
+    """
+    本文を取り出したPDFを、token_budget以内に収まる連続したページ範囲に分割する。
+    スキャン画像のページ (None) は PDF_TOKENS_PER_PAGE として数える。
+
+    Returns:
+        list: [(section_label, first_page, last_page), ...]
+    """
+    sections = []
+    first_page, current_tokens = 1, 0
+    for number, text in enumerate(page_texts, start=1):
+        page_tokens = PDF_TOKENS_PER_PAGE if text is None else estimate_tokens(text)
+        if number > first_page and current_tokens + page_tokens > token_budget:
+            sections.append((f"P.{first_page}〜P.{number - 1}", first_page, number - 1))
+            first_page, current_tokens = number, 0
+        current_tokens += page_tokens
+    if page_texts:
+        sections.append((f"P.{first_page}〜P.{len(page_texts)}", first_page, len(page_texts)))
+    return sections
+
+
+def build_map_requests(documents, token_budget):
+    """
+    文書をセクションに分け、部分要約のリクエスト内容を作る。
+
+    Returns:
+        list: [(display_name, section_label, contents), ...] (文書・セクションの順)
+    """
+    requests = []
+    for document in documents:
+        name = document["display_name"]
+        page_texts = document.get("page_texts")
+        if page_texts is not None:
+            for label, first_page, last_page in split_page_text_sections(page_texts, token_budget):
+                instruction = prompts.PROMPT_SECTION_SUMMARY.format(display_name=name, section_label=label)
+                contents = [pdf_text.build_content(name, page_texts, first_page, last_page)]
+                # 範囲にスキャン画像のページがあれば、切り出したPDFも添付する
+                if None in page_texts[first_page - 1:last_page]:
+                    contents.append(document["scanned_file"])
+                requests.append((name, label, contents + [instruction]))
+        elif document["type"] == "pdf":
+            sections = split_pdf_sections(document["pages"], token_budget)
+            for label, first_page, last_page in sections:
+                instruction = prompts.PROMPT_SECTION_SUMMARY.format(display_name=name, section_label=label)
+                if len(sections) == 1:
+                    requests.append((name, label, [document["content"], instruction]))
+                    continue
+                part = _pdf_range_part(document, first_page, last_page)
+                if part is not None:
+                    instruction += prompts.PROMPT_SECTION_PDF_PAGES.format(first_page=first_page, last_page=last_page)
+                    requests.append((name, label, [part, instruction]))
+                else:
+                    # 切り出せない場合は、アップロード済みのPDF全体に範囲を指定して送る
+                    instruction += f"添付PDFのうち P.{first_page}〜P.{last_page} の範囲だけを対象にしてください。"
+                    requests.append((name, label, [document["content"], instruction]))
+        else:
+            for label, section_text in split_html_sections(document["text"], token_budget):
+                instruction = prompts.PROMPT_SECTION_SUMMARY.format(display_name=name, section_label=label)
+                requests.append((name, label, [f"--- File: {name} ---\n{section_text}", instruction]))
+    return requests
+
+
+def _pdf_range_part(document, first_page, last_page):
+    """
+    PDFのページ範囲を切り出し、リクエストに直接含めるPartにする。
+    (範囲ごとに資料全体を送ると、入力トークンがセクション数倍に増え、大きな資料は結局収まらないため)
+    切り出せない場合 (pypdf が無い・元のバイト列が無い・大きすぎる) はNone。
+    """
+    data = document.get("data")
+    if data is None or not pdf_text.can_split():
+        return None
+    try:
+        pages = pdf_text.extract_scanned_pages(data, range(first_page, last_page + 1))
+    except Exception as e:
+        logger.warning("Failed to split PDF %s: %s", document["display_name"], e)
+        return None
+    if len(pages) > config.MAP_INLINE_PDF_MAX_BYTES:
+        return None
+    return types.Part.from_bytes(data=pages, mime_type="application/pdf")
+
+
+def summarize_sections(client, documents, on_progress=None):
+    """
+    各セクションを並列に部分要約する。
+    部分要約は抽出だけを行うので、信頼度や免責文を求めない専用のシステムプロンプトを使う。
+
+    Args:
+        on_progress: 1セクション完了ごとに (完了数, 総数) で呼ばれるコールバック (メインスレッド)
+
+    Returns:
+        list: 統合用の部分要約テキスト (文書・セクションの順)
+    """
+    requests = build_map_requests(documents, config.MAP_SECTION_TOKEN_BUDGET)
+    summaries = [None] * len(requests)
+    with ThreadPoolExecutor(max_workers=config.MAP_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(
+                gemini_logic.generate_with_fallback, client, contents, prompts.SECTION_SYSTEM_INSTRUCTION
+            ): index
+            for index, (_, _, contents) in enumerate(requests)
+        }
+        done = 0
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                summary_text, _ = future.result()
+                name, label, _ = requests[index]
+                summaries[index] = f"--- 部分要約: {name} ({label}) ---\n{summary_text}"
+                done += 1
+                if on_progress:
+                    on_progress(done, len(requests))
+        except Exception:
+            # 1つでも失敗したら残りは取り消して呼び出し側の再試行に任せる
+            for future in futures:
+                future.cancel()
+            raise
+    return summaries
+
+
+def send_analysis_stream(client, documents, prompt, system_instruction, on_progress=None, report=None, notify=None):
+    """
+    見積もりトークン数に応じて一括送信と分割要約を切り替えて分析を実行する。
+    戻り値は send_message_stream_with_fallback と同じ。
+
+    Args:
+        documents: ingest.ingest_files が返す文書のリスト
+        on_progress: 分割要約の進捗コールバック (一括送信の場合は呼ばれない)
+        report: gemini_logic.send_message_stream_hedged に渡す内訳の記録先
+        notify: モデルの切り替えなどの案内の送り先 (jobs.Job.notify など)
+
+    Returns:
+        tuple: (chat_session, response_stream, used_model)
+    """
+    estimated = estimate_request_tokens(documents, prompt, system_instruction)
+    if estimated <= config.SINGLE_SHOT_TOKEN_BUDGET:
+        contents = document_contents(documents)
+        return gemini_logic.send_message_stream_hedged(
+            client, contents, prompt, system_instruction, report=report, notify=notify
+        )
+
+    # 部分要約を元資料の代わりにして、同じプロンプトで統合する
+    summaries = summarize_sections(client, documents, on_progress)
+    return gemini_logic.send_message_stream_hedged(
+        client,
+        [prompts.PROMPT_REDUCE_PREFIX] + summaries,
+        prompt,
+        system_instruction,
+        report=report,
+        notify=notify
+    )
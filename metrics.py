@@ -0,0 +1,193 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config
+
+# 処理時間・スループット・再試行回数などの計測
+# FSBOT_METRICS_SINK で出力先を選ぶ ("jsonl" / "prometheus" / 両方をカンマ区切り)
+# 未設定の場合は何もしない (計測箇所の呼び出しコストはほぼゼロ)
+
+logger = logging.getLogger(__name__)
+
+_SINKS = {s.strip() for s in config.METRICS_SINK.split(",") if s.strip()}
+ENABLED = bool(_SINKS)
+
+_lock = threading.Lock()
+_jsonl_file = None
+# Prometheus形式で公開する集計値: (名前, ラベル) -> 値 / [件数, 合計, 最大]
+_counters = {}
+_gauges = {}
+_summaries = {}
+_server_started = False
+
+_NOOP_SPAN = contextlib.nullcontext()
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _emit(kind, name, value, labels):
+    global _jsonl_file
+    key = (name, _label_key(labels))
+    with _lock:
+        if kind == "counter":
+            _counters[key] = _counters.get(key, 0) + value
+        elif kind == "gauge":
+            _gauges[key] = value
+        else:
+            summary = _summaries.setdefault(key, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+        if "jsonl" in _SINKS:
+            if _jsonl_file is None:
+                os.makedirs(os.path.dirname(config.METRICS_JSONL_PATH), exist_ok=True)
+                _jsonl_file = open(config.METRICS_JSONL_PATH, "a", encoding="utf-8")
+            record = {"ts": time.time(), "type": kind, "name": name, "value": value}
+            if labels:
+                record["labels"] = labels
+            _jsonl_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            _jsonl_file.flush()
+
+
+def increment(name, value=1, **labels):
+    """カウンターを増やす (再試行回数など)"""
+    if ENABLED:
+        _emit("counter", name, value, labels)
+
+
+def gauge(name, value, **labels):
+    """現在の値を記録する (保持しているファイル数など。前回の値は上書きする)"""
+    if ENABLED:
+        _emit("gauge", name, value, labels)
+
+
+def observe(name, value, **labels):
+    """1回分の測定値を記録する (秒数・文字数など)"""
+    if ENABLED:
+        _emit("summary", name, value, labels)
+
+
+class _Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = dict(self.labels, status="error" if exc_type else "ok")
+        _emit("summary", f"{self.name}_seconds", time.perf_counter() - self.started_at, labels)
+        return False
+
+
+def span(name, **labels):
+    """
+    処理区間の所要時間を記録するコンテキストマネージャ。
+    <name>_seconds として、成功・失敗を status ラベルに付けて記録する。
+    """
+    if not ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, labels)
+
+
+def timed(name, **labels):
+    """関数の所要時間を span と同じ形式で記録するデコレータ (無効時は関数をそのまま返す)"""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span(name, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def measure_text_stream(stream, **labels):
+    """
+    テキストのストリームを通過させながら、文字数と1秒あたりの文字数を記録する。
+    計測の起点は最初のchunkを受け取った時点 (最初のchunkまでの時間は別に記録している)。
+    """
+    if not ENABLED:
+        return stream
+    return _measured_text_stream(stream, labels)
+
+
+def _measured_text_stream(stream, labels):
+    chars = 0
+    first_at = None
+    try:
+        for text in stream:
+            if first_at is None:
+                first_at = time.perf_counter()
+            chars += len(text)
+            yield text
+    finally:
+        if first_at is not None:
+            elapsed = time.perf_counter() - first_at
+            observe("stream_chars", chars, **labels)
+            if elapsed > 0:
+                observe("stream_chars_per_second", chars / elapsed, **labels)
+
+
+def render_prometheus():
+    """集計値をPrometheusのテキスト形式で返す"""
+    def fmt_labels(label_key):
+        if not label_key:
+            return ""
+        inner = ",".join(f'{k}="{v}"' for k, v in label_key)
+        return "{" + inner + "}"
+
+    lines = []
+    with _lock:
+        for (name, label_key), value in sorted(_counters.items()):
+            lines.append(f"fsbot_{name}_total{fmt_labels(label_key)} {value}")
+        for (name, label_key), value in sorted(_gauges.items()):
+            lines.append(f"fsbot_{name}{fmt_labels(label_key)} {value}")
+        for (name, label_key), (count, total, maximum) in sorted(_summaries.items()):
+            lines.append(f"fsbot_{name}_count{fmt_labels(label_key)} {count}")
+            lines.append(f"fsbot_{name}_sum{fmt_labels(label_key)} {total}")
+            lines.append(f"fsbot_{name}_max{fmt_labels(label_key)} {maximum}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスログは出さない
+        pass
+
+
+def start_server():
+    """Prometheus形式のエンドポイントを起動する (プロセスにつき1回だけ)"""
+    global _server_started
+    if "prometheus" not in _SINKS:
+        return
+    with _lock:
+        if _server_started:
+            return
+        _server_started = True
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", config.METRICS_PORT), _MetricsHandler)
+    except OSError as e:
+        logger.warning("Failed to start metrics endpoint on port %s: %s", config.METRICS_PORT, e)
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
@@ -0,0 +1,168 @@
+import hashlib
+import io
+import re
+import unicodedata
+import config
+import extract_cache
+import metrics
+import prompts
+
+try:
+    import pypdf
+except ImportError:
+    # pypdf が無い環境では、従来どおりPDFをそのままアップロードする
+    pypdf = None
+
+# テキストを埋め込んだPDF (決算短信の多くはこちら) は手元で本文を取り出し、Geminiにはテキストとして送る
+# ページごとの抽出結果はページの内容ハッシュで extract_cache に保存するので、
+# 同じ資料の再アップロードや、一部のページだけ差し替えた訂正版では抽出をほぼ省略できる
+# テキストを取り出せないスキャン画像のページと、文字化けしたページだけを、別のPDFに切り出してアップロードする
+
+# 抽出処理の仕様を変えたときはこの値を上げて、古いキャッシュを無効にする
+EXTRACTOR_VERSION = 1
+
+
+def available():
+    """ローカルでのテキスト抽出を使うかどうか"""
+    return pypdf is not None and config.PDF_EXTRACT_MODE == "local"
+
+
+def _resolve(obj):
+    return obj.get_object() if obj is not None else None
+
+
+def page_hash(page):
+    """
+    ページの内容ストリームと、抽出結果に影響するフォント・フォームのデータからハッシュを作る。
+    (ファイル内のオブジェクト番号には依存しないので、別のPDFに含まれる同じページでも一致する)
+    """
+    digest = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    resources = _resolve(page.get("/Resources")) or {}
+    fonts = _resolve(resources.get("/Font")) or {}
+    for name in sorted(fonts):
+        font = _resolve(fonts[name])
+        digest.update(f"{name}:{font.get('/BaseFont')}:{_resolve(font.get('/Encoding'))}".encode("utf-8"))
+        to_unicode = _resolve(font.get("/ToUnicode"))
+        if to_unicode is not None:
+            digest.update(to_unicode.get_data())
+    xobjects = _resolve(resources.get("/XObject")) or {}
+    for name in sorted(xobjects):
+        xobject = _resolve(xobjects[name])
+        if xobject.get("/Subtype") == "/Form":
+            digest.update(name.encode("utf-8"))
+            digest.update(xobject.get_data())
+    return digest.hexdigest()
+
+
+def _has_images(page):
+    resources = _resolve(page.get("/Resources")) or {}
+    xobjects = _resolve(resources.get("/XObject")) or {}
+    return any(_resolve(x).get("/Subtype") == "/Image" for x in xobjects.values())
+
+
+# 決算書の本文に出てくる文字の範囲 (ASCII・記号・かな・漢字・全角英数など)
+_EXPECTED_RANGES = (
+    (0x20, 0x7E), (0xA0, 0xBF), (0xD7, 0xD7), (0xF7, 0xF7),
+    (0x2000, 0x27BF), (0x3000, 0x30FF), (0x3200, 0x33FF), (0x3400, 0x4DBF),
+    (0x4E00, 0x9FFF), (0xF900, 0xFAFF), (0xFF00, 0xFFEF),
+)
+# pdfminer などが対応の無い文字を書き出す形式
+_CID_PATTERN = re.compile(r"\(cid:\d+\)")
+
+
+def _is_expected(char):
+    code = ord(char)
+    return any(low <= code <= high for low, high in _EXPECTED_RANGES)
+
+
+def is_garbled(text):
+    """
+    取り出した本文が文字化けしているか (ToUnicode の無いCIDフォントでは、
+    字形の番号がそのまま制御文字・私用領域・他言語の文字として出てくる)。
+    """
+    text = _CID_PATTERN.sub("\ufffd", text or "")
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return False
+    unexpected = sum(1 for c in chars if not _is_expected(c) or unicodedata.category(c) in ("Cc", "Co", "Cn"))
+    return unexpected / len(chars) > config.PDF_TEXT_MAX_GARBLED_RATIO
+
+
+def _cache_key(page_digest):
+    return f"pdfpage-{page_digest}-v{EXTRACTOR_VERSION}"
+
+
+@metrics.timed("pdf_extract")
+def extract_pages(data):
+    """
+    PDFのバイト列からページごとの本文を取り出す (ページ単位のキャッシュ付き)。
+    プロセスプールからも呼ばれるため、トップレベル関数のままにしておくこと。
+
+    Returns:
+        list: ページ順の本文。テキストを取り出せないページ (スキャン画像・文字化け) は None
+    """
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    page_texts = []
+    for page in reader.pages:
+        key = _cache_key(page_hash(page))
+        text = extract_cache.get(key)
+        if text is None:
+            lines = (page.extract_text() or "").splitlines()
+            text = "\n".join(line.strip() for line in lines if line.strip())
+            # 1ページずつの書き込みでは上限の確認を省き、最後にまとめて行う
+            extract_cache.put(key, text, prune=False)
+        if len(text) < config.PDF_TEXT_MIN_CHARS and _has_images(page):
+            page_texts.append(None)
+        elif is_garbled(text):
+            # 文字化けしたテキストを送ると元のPDFより悪くなるので、このページはPDFのまま送る
+            page_texts.append(None)
+        else:
+            page_texts.append(text)
+    extract_cache.prune()
+    return page_texts
+
+
+def can_split():
+    """PDFをページ単位で切り出せるかどうか (ローカル抽出の設定には関係なく、pypdf があれば切り出せる)"""
+    return pypdf is not None
+
+
+def extract_scanned_pages(data, page_numbers):
+    """
+    指定したページ (1始まり) だけを含むPDFのバイト列を作る
+    (スキャン画像のページのアップロードや、分割要約で範囲ごとに送るPDFに使う)
+    """
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    writer = pypdf.PdfWriter()
+    for number in page_numbers:
+        writer.add_page(reader.pages[number - 1])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def scanned_display_name(display_name):
+    """スキャン画像のページを切り出したPDFの表示名"""
+    return f"{display_name} (スキャンページ)"
+
+
+def build_content(display_name, page_texts, first_page=1, last_page=None):
+    """
+    ページごとの本文に出典ページ「(P.XX)」の印を付け、ヘッダー付きのテキストにする。
+    スキャン画像のページには、切り出したPDFの何ページ目にあたるかを書いておく。
+    """
+    last_page = last_page or len(page_texts)
+    scanned_name = scanned_display_name(display_name)
+    # 範囲より前にあるスキャンページの数 (切り出したPDFのページ番号を合わせるため)
+    scanned = sum(1 for text in page_texts[:first_page - 1] if text is None)
+    blocks = [f"--- File: {display_name} ---"]
+    for number in range(first_page, last_page + 1):
+        text = page_texts[number - 1]
+        if text is None:
+            scanned += 1
+            text = prompts.PDF_SCANNED_PAGE_NOTE.format(scanned_name=scanned_name, page=scanned)
+        blocks.append(f"(P.{number})\n{text}")
+    return "\n".join(blocks)
@@ -10,3 +10,31 @@ PROMPT_TREND_ANALYSIS = "添付された複数の決算資料に基づき、こ
 
 # 企業比較用プロンプト (複数社の資料)
 PROMPT_COMPANY_COMPARISON = "添付された複数の決算資料は、異なる企業のものです。これらの企業を比較分析し、投資家視点で評価してください。以下の項目について日本語でまとめてください。財務パフォーマンスの比較では、表を作って比較しなさい。**各情報がどの企業のどの資料に基づくものか、`(A社 2024 P.10)` のように出典を明確にしてください。**1.各社の事業概要と特徴、2.財務パフォーマンスの比較（収益性、成長性、健全性）、3.各社の競合優位性とリスク、4.総合評価と業界内での位置づけ。"
+
+# 分割要約 (map-reduce) の部分要約用プロンプト
+# 大きな資料を分割して要約し、最後に上記のいずれかのプロンプトで統合する
+PROMPT_SECTION_SUMMARY = "これは決算資料「{display_name}」の一部（{section_label}）です。後で資料全体の分析に統合するため、この範囲に含まれる重要な財務数値、事業の状況、将来の見通し、リスク要因を、数値と出典ページ「(P.XX)」を保ったまま箇条書きで簡潔に抽出してください。前置きや結論は不要です。信頼度の診断や免責文も不要です。"
+
+# 分割要約の部分要約用のシステムプロンプト (信頼度・免責文を求める SYSTEM_INSTRUCTION の代わりに使う)
+SECTION_SYSTEM_INSTRUCTION = "あなたは決算資料から情報を抽出するアシスタントです。日本語で、資料に書かれている事実と数値だけを正確に抜き出してください。推測や評価は加えず、各情報に出典ページを「(P.XX)」の形式で付けてください。HTMLタグが含まれている場合は、タグを無視して本文の内容を読んでください。"
+
+# ページ範囲ごとに切り出したPDFを送るときに、部分要約の指示の後に付ける注意
+PROMPT_SECTION_PDF_PAGES = "添付PDFは元資料の P.{first_page}〜P.{last_page} を切り出したもので、1ページ目が P.{first_page} にあたります。出典ページは元資料のページ番号で示してください。"
+
+# 分割要約の統合時に、部分要約の前に付ける説明
+PROMPT_REDUCE_PREFIX = "以下は、添付資料が大きいため分割して抽出した部分要約です。これらを元資料とみなして、続く指示に従ってください。"
+
+# チャット履歴の圧縮時に、古い会話を要約させる指示
+PROMPT_HISTORY_SUMMARY = "以下は、添付資料についてのユーザーとAIのこれまでの会話です。今後の質問に答えるための文脈として、話題になった項目、回答に使った重要な数値と出典ページ「(P.XX)」、ユーザーの関心や前提条件を、日本語の箇条書きで簡潔に要約してください。前置きや結論は不要です。信頼度の診断や免責文も不要です。"
+
+# 履歴の要約用のシステムプロンプト (信頼度・免責文を求める SYSTEM_INSTRUCTION の代わりに使う)
+HISTORY_SUMMARY_SYSTEM_INSTRUCTION = "あなたは会話の記録を要約するアシスタントです。日本語で、会話に出てきた事実と数値だけを正確に残し、推測や評価は加えないでください。出典ページ「(P.XX)」は元の表記のまま残してください。"
+
+# 圧縮後の履歴で、要約した会話の前に付ける見出し
+HISTORY_SUMMARY_HEADER = "【これまでの会話の要約】"
+
+# 追加質問で、資料全体の代わりに検索で抜き出した箇所を送るときの見出し
+RETRIEVAL_CONTEXT_HEADER = "【資料から質問に関連する箇所を抜き出したもの】回答の出典には各箇所の見出しにあるファイル名・ページを使ってください。"
+
+# ローカルでテキストを取り出したPDFで、本文を取り出せない (スキャン画像・文字化け) ため別に添付したページの代わりに置く文
+PDF_SCANNED_PAGE_NOTE = "（このページは本文をテキストで取り出せないため、添付PDF「{scanned_name}」の{page}ページ目を参照してください）"
@@ -0,0 +1,152 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import config
+
+# 分析結果のキャッシュ
+# (資料のハッシュの集合, プロンプト, システムプロンプト, モデル, temperature) が同じなら、
+# Geminiを呼ばずに保存済みの回答を同じストリーミング表示で再生する
+# 複数のアナリストが同じ決算書を開く場合に共有できるよう、SQLiteに保存する
+
+_DB_PATH = os.path.join(config.CACHE_DIR, "response_cache.sqlite3")
+_lock = threading.Lock()
+
+
+def _connect():
+    os.makedirs(config.CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(_DB_PATH, timeout=10)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS responses (
+            cache_key TEXT PRIMARY KEY,
+            response_text TEXT NOT NULL,
+            used_model TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    return conn
+
+
+@contextlib.contextmanager
+def _db():
+    """コミットしてから確実にクローズする接続を返す"""
+    conn = _connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def make_key(document_hashes, prompt, system_instruction, model=None, temperature=None):
+    """キャッシュのキーを作る。資料の順番は問わない"""
+    payload = {
+        "documents": sorted(document_hashes),
+        "prompt": prompt,
+        "system_instruction": system_instruction,
+        "model": model or config.PRIMARY_MODEL,
+        "temperature": config.TEMPERATURE if temperature is None else temperature,
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _count(conn, name):
+    conn.execute(
+        "INSERT INTO stats (name, value) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+        (name,),
+    )
+
+
+def get(cache_key):
+    """
+    キャッシュ済みの回答を返す。無い、または期限切れの場合はNone。
+
+    Returns:
+        dict: {"text", "used_model"} or None
+    """
+    now = time.time()
+    with _lock, _db() as conn:
+        row = conn.execute(
+            "SELECT response_text, used_model, expires_at FROM responses WHERE cache_key = ?",
+            (cache_key,),
+        ).fetchone()
+        if row is None or row[2] <= now:
+            if row is not None:
+                conn.execute("DELETE FROM responses WHERE cache_key = ?", (cache_key,))
+            _count(conn, "misses")
+            return None
+        conn.execute(
+            "UPDATE responses SET last_used_at = ? WHERE cache_key = ?",
+            (now, cache_key),
+        )
+        _count(conn, "hits")
+    return {"text": row[0], "used_model": row[1]}
+
+
+def put(cache_key, response_text, used_model, ttl_seconds=None):
+    """回答を保存し、期限切れのものと上限サイズを超えた古いものを削除する"""
+    now = time.time()
+    if ttl_seconds is None:
+        ttl_seconds = config.RESPONSE_CACHE_TTL_SECONDS
+    size = len(response_text.encode("utf-8"))
+    with _lock, _db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(cache_key, response_text, used_model, size, expires_at, last_used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (cache_key, response_text, used_model, size, now + ttl_seconds, now),
+        )
+        _evict(conn, now)
+
+
+def _evict(conn, now):
+    conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+    limit = config.RESPONSE_CACHE_MAX_MB * 1024 * 1024
+    (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+    if total <= limit:
+        return
+    rows = conn.execute(
+        "SELECT cache_key, size FROM responses ORDER BY last_used_at ASC"
+    ).fetchall()
+    for cache_key, size in rows:
+        conn.execute("DELETE FROM responses WHERE cache_key = ?", (cache_key,))
+        _count(conn, "evictions")
+        total -= size
+        if total <= limit:
+            break
+
+
+def stats():
+    """ヒット数・ミス数などの累計を返す"""
+    with _lock, _db() as conn:
+        counters = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        (entries, total) = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+    return {
+        "hits": counters.get("hits", 0),
+        "misses": counters.get("misses", 0),
+        "evictions": counters.get("evictions", 0),
+        "entries": entries,
+        "bytes": total,
+    }
+
+
+def replay_stream(response_text, chunk_chars=None):
+    """保存済みの回答を、st.write_stream にそのまま渡せるよう少しずつ返すジェネレータ"""
+    chunk_chars = chunk_chars or config.RESPONSE_REPLAY_CHUNK_CHARS
+    for start in range(0, len(response_text), chunk_chars):
+        yield response_text[start:start + chunk_chars]
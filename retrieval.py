@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+import numpy as np
+import config
+import map_reduce
+import metrics
+import prompts
+
+# 資料の本文から検索用の索引 (BM25) を作り、追加質問では関連する抜粋だけを送る
+# 日本語は単語に分けずに文字の2-gram、英数字は単語単位で数える (外部の形態素解析器は使わない)
+# 索引は文書の内容ハッシュごとにディスクへ保存し、同じ資料では作り直さない
+
+logger = logging.getLogger(__name__)
+
+# 索引の仕様を変えたときはこの値を上げて、古い索引を無効にする
+INDEX_VERSION = 1
+
+# BM25のパラメータ
+_K1 = 1.2
+_B = 0.75
+
+_DISK_DIR = os.path.join(config.CACHE_DIR, "retrieval")
+_lock = threading.Lock()
+
+# 検索で抜粋を送る間、履歴から外した資料の代わりに最初の発言に残す文
+HISTORY_PLACEHOLDER = "（資料は質問ごとに関連する箇所を添付します）"
+
+_WORD_PATTERN = re.compile(r"[a-z0-9][a-z0-9.,%]*|[^\sa-z0-9]+")
+# EDINETのHTMLに残るページ番号の行 (「- 12 -」「― 12 ―」など)
+_PAGE_FOOTER_PATTERN = re.compile(r"^[-―－ー‐]\s*(\d{1,4})\s*[-―－ー‐]$")
+
+
+def tokenize(text):
+    """検索用のトークン列にする (英数字は単語、それ以外は文字の2-gram)"""
+    tokens = []
+    for word in _WORD_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if word[0].isascii() and word[0].isalnum():
+            tokens.append(word.rstrip(".,"))
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def chunks_from_text(text, chunk_chars=None):
+    """
+    HTMLから抽出した本文を、行の区切りで chunk_chars 程度の抜粋に分ける。
+    ページ番号の行があればページを、無ければ直前の見出しを抜粋の見出しにする。
+
+    Returns:
+        list: [(label, text), ...]
+    """
+    chunk_chars = chunk_chars or config.RETRIEVAL_CHUNK_CHARS
+    chunks = []
+    heading, page = "冒頭", None
+    label, lines, size = None, [], 0
+
+    def flush():
+        if lines:
+            chunks.append((label, "\n".join(lines)))
+
+    for line in text.split("\n"):
+        footer = _PAGE_FOOTER_PATTERN.match(line.strip())
+        if footer:
+            # フッターのページ番号の後ろは次のページ
+            flush()
+            page = int(footer.group(1)) + 1
+            label, lines, size = None, [], 0
+            continue
+        if map_reduce.is_heading(line):
+            heading = line
+        if lines and size + len(line) > chunk_chars:
+            flush()
+            label, lines, size = None, [], 0
+        if label is None:
+            label = f"P.{page}" if page else heading
+        lines.append(line)
+        size += len(line)
+    flush()
+    return chunks
+
+
+def chunks_from_pages(page_texts, chunk_chars=None):
+    """
+    ローカルで取り出したPDFのページごとの本文を、ページをまたがない抜粋に分ける。
+
+    Returns:
+        list: [(label, text), ...] (label は "P.N")
+    """
+    chunk_chars = chunk_chars or config.RETRIEVAL_CHUNK_CHARS
+    chunks = []
+    for number, text in enumerate(page_texts, start=1):
+        lines, size = [], 0
+        for line in text.split("\n") if text else []:
+            if lines and size + len(line) > chunk_chars:
+                chunks.append((f"P.{number}", "\n".join(lines)))
+                lines, size = [], 0
+            lines.append(line)
+            size += len(line)
+        if lines:
+            chunks.append((f"P.{number}", "\n".join(lines)))
+    return chunks
+
+
+class DocumentIndex:
+    """1文書分の抜粋と、トークンの出現位置 (転置索引)"""
+
+    def __init__(self, labels, texts, terms, offsets, chunk_ids, frequencies, lengths):
+        self.labels = labels
+        self.texts = texts
+        self.terms = {term: i for i, term in enumerate(terms)}
+        # 語 i の出現は chunk_ids / frequencies の offsets[i]:offsets[i + 1]
+        self.offsets = offsets
+        self.chunk_ids = chunk_ids
+        self.frequencies = frequencies
+        self.lengths = lengths
+
+    @classmethod
+    def build(cls, chunks):
+        labels = [label for label, _ in chunks]
+        texts = [text for _, text in chunks]
+        postings = {}
+        lengths = np.zeros(len(texts), dtype=np.int32)
+        for chunk_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths[chunk_id] = sum(counts.values())
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((chunk_id, count))
+        terms = list(postings)
+        sizes = np.fromiter((len(postings[t]) for t in terms), dtype=np.int64, count=len(terms))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        flat = [entry for t in terms for entry in postings[t]]
+        pairs = np.array(flat, dtype=np.int32).reshape(-1, 2)
+        return cls(labels, texts, terms, offsets, pairs[:, 0].copy(), pairs[:, 1].copy(), lengths)
+
+    def document_frequency(self, term):
+        i = self.terms.get(term)
+        return 0 if i is None else int(self.offsets[i + 1] - self.offsets[i])
+
+    def postings(self, term):
+        i = self.terms.get(term)
+        if i is None:
+            return None, None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.chunk_ids[start:end], self.frequencies[start:end]
+
+    # --- 保存 ---
+
+    def save(self, path):
+        meta = json.dumps({"labels": self.labels, "texts": self.texts, "terms": list(self.terms)}, ensure_ascii=False)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            meta=np.frombuffer(meta.encode("utf-8"), dtype=np.uint8),
+            offsets=self.offsets,
+            chunk_ids=self.chunk_ids,
+            frequencies=self.frequencies,
+            lengths=self.lengths,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+            return cls(
+                meta["labels"], meta["texts"], meta["terms"],
+                data["offsets"], data["chunk_ids"], data["frequencies"], data["lengths"],
+            )
+
+
+def _index_path(sha256):
+    # 抜粋の大きさを変えた場合は別の索引になるよう、ファイル名に含める
+    return os.path.join(_DISK_DIR, f"{sha256}-c{config.RETRIEVAL_CHUNK_CHARS}-v{INDEX_VERSION}.npz")
+
+
+def load_or_build(sha256, chunks_factory):
+    """
+    内容ハッシュに対応する索引を読み込む。無ければ chunks_factory() の抜粋から作って保存する。
+    """
+    path = _index_path(sha256)
+    try:
+        return DocumentIndex.load(path)
+    except (OSError, ValueError, KeyError):
+        pass
+    index = DocumentIndex.build(chunks_factory())
+    try:
+        with _lock:
+            os.makedirs(_DISK_DIR, exist_ok=True)
+            index.save(path)
+    except OSError as e:
+        logger.warning("Failed to save retrieval index: %s", e)
+    return index
+
+
+class RetrievalIndex:
+    """セッションの全資料をまとめて検索する索引 (統計量は全資料を1つのコーパスとして計算する)"""
+
+    def __init__(self, entries):
+        # [(display_name, DocumentIndex), ...]
+        self.entries = entries
+        self.total_chunks = sum(len(index.labels) for _, index in entries)
+        total_length = sum(int(index.lengths.sum()) for _, index in entries)
+        self.average_length = total_length / self.total_chunks if self.total_chunks else 0.0
+        # 全資料の本文の見積もりトークン数 (削減量の報告用)
+        self.document_tokens = sum(
+            map_reduce.estimate_tokens(text) for _, index in entries for text in index.texts
+        )
+
+    @classmethod
+    def from_documents(cls, documents):
+        """
+        ingest.ingest_files の文書から作る。本文の無い文書 (Geminiにファイルのまま送るPDF) や
+        スキャン画像のページを含むPDFが1つでもあれば、資料全体を検索で置き換えられないのでNoneを返す。
+        """
+        entries = []
+        for document in documents:
+            page_texts = document.get("page_texts")
+            if page_texts is not None:
+                if None in page_texts:
+                    return None
+                factory = lambda d=document: chunks_from_pages(d["page_texts"])
+            elif document.get("text"):
+                factory = lambda d=document: chunks_from_text(d["text"])
+            else:
+                return None
+            with metrics.span("retrieval_index"):
+                entries.append((document["display_name"], load_or_build(document["sha256"], factory)))
+        if not entries:
+            return None
+        return cls(entries)
+
+    def search(self, query, top_k=None):
+        """
+        BM25で上位の抜粋を返す。
+
+        Returns:
+            list: [(display_name, label, text, score), ...] (スコアの高い順)
+        """
+        top_k = top_k or config.RETRIEVAL_TOP_K
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.total_chunks:
+            return []
+
+        document_frequencies = {
+            term: sum(index.document_frequency(term) for _, index in self.entries) for term in terms
+        }
+        results = []
+        for display_name, index in self.entries:
+            scores = np.zeros(len(index.labels), dtype=np.float64)
+            norm = _K1 * (1 - _B + _B * index.lengths / max(self.average_length, 1e-9))
+            for term in terms:
+                chunk_ids, frequencies = index.postings(term)
+                if chunk_ids is None:
+                    continue
+                df = document_frequencies[term]
+                idf = np.log(1 + (self.total_chunks - df + 0.5) / (df + 0.5))
+                tf = frequencies.astype(np.float64)
+                scores[chunk_ids] += idf * tf * (_K1 + 1) / (tf + norm[chunk_ids])
+            if not scores.any():
+                continue
+            count = min(top_k, len(scores))
+            best = np.argpartition(-scores, count - 1)[:count]
+            for chunk_id in best:
+                if scores[chunk_id] > 0:
+                    results.append((display_name, index.labels[chunk_id], index.texts[chunk_id], float(scores[chunk_id])))
+        results.sort(key=lambda r: -r[3])
+        return results[:top_k]
+
+
+def format_passages(passages):
+    """検索した抜粋を、出典の見出し付きでメッセージに添付する形にする"""
+    blocks = [prompts.RETRIEVAL_CONTEXT_HEADER]
+    for number, (display_name, label, text, _) in enumerate(passages, start=1):
+        blocks.append(f"[{number}] {display_name} {label}\n{text}")
+    return "\n\n".join(blocks)
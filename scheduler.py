@@ -0,0 +1,249 @@
+import random
+import re
+import threading
+import time
+import config
+import metrics
+
+# Gemini APIへのリクエストを、プロセス内の全セッションで共有して制御するスケジューラ
+# - モデルごとのトークンバケットで送信ペースを揃える
+# - 同時に実行中のリクエスト数に上限を設ける
+# - 429/503の後は指数バックオフ+ジッターで待つ (Retry-Afterがあればそれに従う)
+# - 混雑が続くモデルはサーキットブレーカーで一定時間使わず、Fallbackモデルに回す
+
+_RETRYABLE_CODES = (429, 503)
+
+
+def is_retryable_error(error):
+    """混雑・一時的な障害 (429/503) によるエラーかどうか"""
+    code = getattr(error, "code", None)
+    if code in _RETRYABLE_CODES:
+        return True
+    message = str(error)
+    return any(str(c) in message for c in _RETRYABLE_CODES)
+
+
+def _parse_seconds(value):
+    """ "12s" / "1.5s" / "30" のような表記を秒数にする"""
+    match = re.match(r"^\s*([0-9]+(?:\.[0-9]+)?)\s*s?\s*$", str(value))
+    return float(match.group(1)) if match else None
+
+
+def retry_after_seconds(error):
+    """
+    エラーに含まれる再試行までの待ち時間 (秒) を返す。無ければNone。
+    HTTPの Retry-After ヘッダーと、Gemini APIの RetryInfo.retryDelay を見る。
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        if value is not None:
+            seconds = _parse_seconds(value)
+            if seconds is not None:
+                return seconds
+
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []) or []:
+            if isinstance(detail, dict) and "retryDelay" in detail:
+                seconds = _parse_seconds(detail["retryDelay"])
+                if seconds is not None:
+                    return seconds
+    return None
+
+
+class TokenBucket:
+    """1分あたりのリクエスト数を制限するトークンバケット"""
+
+    def __init__(self, requests_per_minute, burst):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """トークンが1つ取れるまで待つ"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    連続して混雑エラーになったモデルを一定時間「使用不可」にする。
+    クールダウン後は1件だけ試し (half-open)、成功すれば復帰する。
+    試しの1件は実際に送る時点 (begin) で決め、結果がどうであれ終わった時点で外す。
+    """
+
+    def __init__(self, failure_threshold, cooldown_seconds):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """このモデルに送ってよいか (状態は変えない)"""
+        with self.lock:
+            if self.opened_until <= 0:
+                return True
+            return time.monotonic() >= self.opened_until and not self.probing
+
+    def begin(self):
+        """
+        リクエストを実際に送る時に呼ぶ。クールダウンが明けていれば、このリクエストを試しの1件にする。
+
+        Returns:
+            bool: 試しの1件かどうか (結果を記録する時に probe として渡す)
+        """
+        with self.lock:
+            if self.opened_until <= 0 or self.probing or time.monotonic() < self.opened_until:
+                return False
+            self.probing = True
+            return True
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_until > 0 and (time.monotonic() < self.opened_until or self.probing)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_until = 0.0
+            self.probing = False
+
+    def record_failure(self, retry_after=None, probe=False):
+        with self.lock:
+            self.failures += 1
+            if probe:
+                self.probing = False
+            if probe or self.failures >= self.failure_threshold:
+                cooldown = max(self.cooldown_seconds, retry_after or 0)
+                self.opened_until = time.monotonic() + cooldown
+
+    def record_other(self, probe=False):
+        """混雑以外の結果 (400などのエラー、取り消し)。試しの1件だった場合は、次のリクエストで改めて試す"""
+        if probe:
+            with self.lock:
+                self.probing = False
+
+
+class RequestSlot:
+    """スケジューラから払い出される実行枠。release で結果を記録して枠を返す"""
+
+    def __init__(self, scheduler, model, probe=False):
+        self.scheduler = scheduler
+        self.model = model
+        # サーキットブレーカーの試しの1件かどうか
+        self.probe = probe
+        self.released = False
+        self.lock = threading.Lock()
+
+    def release(self, error=None):
+        # ストリームの終了・破棄など複数の経路から呼ばれるので、最初の1回だけ有効にする
+        self._finish(error, cancelled=False)
+
+    def cancel(self):
+        """結果を待たずに枠を返す (ヘッジで採用しなかったリクエストなど)。ブレーカーには成否を記録しない"""
+        self._finish(None, cancelled=True)
+
+    def _finish(self, error, cancelled):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.scheduler._finish(self.model, error, self.probe, cancelled)
+
+
+class RequestScheduler:
+    def __init__(self):
+        self.primary_model = config.PRIMARY_MODEL
+        self.fallback_model = config.FALLBACK_MODEL
+        self.buckets = {
+            self.primary_model: TokenBucket(config.SCHEDULER_PRIMARY_RPM, config.SCHEDULER_BURST),
+            self.fallback_model: TokenBucket(config.SCHEDULER_FALLBACK_RPM, config.SCHEDULER_BURST),
+        }
+        self.breakers = {
+            model: CircuitBreaker(config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_COOLDOWN_SECONDS)
+            for model in self.buckets
+        }
+        self.in_flight = threading.BoundedSemaphore(config.SCHEDULER_MAX_IN_FLIGHT)
+
+    def models_to_try(self):
+        """
+        試すモデルの順番を返す。
+        Primaryモデルのブレーカーが開いている間は、Fallbackモデルだけに送る。
+        状態は変えないので、1回のリクエストで何度呼んでもよい。
+        """
+        if self.breakers[self.primary_model].allow():
+            return [self.primary_model, self.fallback_model]
+        return [self.fallback_model]
+
+    def acquire(self, model):
+        """送信ペースと同時実行数の枠が空くまで待ち、実行枠を返す"""
+        started_at = time.perf_counter()
+        bucket = self.buckets.get(model)
+        if bucket:
+            bucket.acquire()
+        self.in_flight.acquire()
+        metrics.observe("scheduler_wait_seconds", time.perf_counter() - started_at, model=model)
+        breaker = self.breakers.get(model)
+        return RequestSlot(self, model, probe=breaker.begin() if breaker else False)
+
+    def _finish(self, model, error, probe=False, cancelled=False):
+        self.in_flight.release()
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            return
+        if cancelled:
+            breaker.record_other(probe)
+            return
+        if error is None:
+            breaker.record_success()
+            return
+        metrics.increment("api_errors", model=model, code=getattr(error, "code", "unknown"))
+        if is_retryable_error(error):
+            breaker.record_failure(retry_after_seconds(error), probe)
+        else:
+            breaker.record_other(probe)
+
+    def backoff_seconds(self, attempt, error=None):
+        """
+        attempt回目 (0始まり) の再試行前に待つ秒数。
+        指数バックオフにフルジッターをかけ、Retry-Afterの指定があればそれ以上待つ。
+        """
+        ceiling = min(config.BACKOFF_MAX_SECONDS, config.BACKOFF_BASE_SECONDS * (2 ** attempt))
+        delay = random.uniform(0, ceiling)
+        retry_after = retry_after_seconds(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, config.BACKOFF_MAX_SECONDS))
+        return delay
+
+    def wait_before_retry(self, attempt, error=None):
+        delay = self.backoff_seconds(attempt, error)
+        metrics.increment("retries")
+        metrics.observe("backoff_seconds", delay)
+        time.sleep(delay)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """プロセス全体で共有するスケジューラを返す (Streamlitの全セッションで共通)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
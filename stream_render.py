@@ -0,0 +1,114 @@
+import time
+import config
+import metrics
+
+# 回答のストリームを画面に表示する前に、細かいchunkをまとめる
+# st.write_stream は受け取ったchunkごとに表示中の回答全体を描画し直すため、
+# chunkが細かいほどWebSocketの送信とMarkdownの再描画が増え、長い表ではサーバーのCPUを使う
+# 文字数・経過時間で区切ってまとめ、区切る位置は段落や表の行の終わりに揃えて、書きかけの表がちらつかないようにする
+
+
+def _is_table_line(line):
+    return line.lstrip().startswith("|")
+
+
+def find_flush_point(text):
+    """
+    text のうち、表示しても見た目が崩れない位置 (最後の完結した行の直後) を返す。無ければ0。
+    表の見出し行は、区切り行 (|---|) が届くまでは表として表示されないので、その直前で止める。
+    """
+    end = text.rfind("\n") + 1
+    while end > 0:
+        line_start = text.rfind("\n", 0, end - 1) + 1
+        line = text[line_start:end - 1]
+        if not _is_table_line(line):
+            return end
+        previous_start = text.rfind("\n", 0, max(0, line_start - 1)) + 1
+        previous = text[previous_start:line_start - 1] if line_start else ""
+        if line_start and _is_table_line(previous):
+            # 表の2行目以降 (区切り行・データ行) の終わり
+            return end
+        # 表の見出し行かもしれないので、その行の前まで戻る
+        end = line_start
+    return 0
+
+
+def coalesce(chunks, min_chars=None, max_chars=None, window_seconds=None, stats=None):
+    """
+    テキストのchunkをまとめて返すジェネレータ。
+
+    最初のchunkはすぐに返す。以後は、たまった文字数が min_chars 以上か、前回から window_seconds 以上
+    経っていれば、区切りのよい位置 (find_flush_point) までを返す。max_chars を超えた場合と、
+    区切りが来ないまま window_seconds の4倍経った場合は、途中でもすべて返す。
+    空文字のchunk (jobs.Job.tail の heartbeat) は、時間による判定のためだけに使う。
+
+    Args:
+        stats: 渡すと {"chunks": 受け取ったchunk数, "renders": 返した回数} を書き込む
+    """
+    min_chars = min_chars or config.STREAM_RENDER_MIN_CHARS
+    max_chars = max_chars or config.STREAM_RENDER_MAX_CHARS
+    window_seconds = config.STREAM_RENDER_WINDOW_SECONDS if window_seconds is None else window_seconds
+    if stats is None:
+        stats = {}
+    stats.update({"chunks": 0, "renders": 0})
+
+    buffer = ""
+    last_flush = None
+    for chunk in chunks:
+        if chunk:
+            stats["chunks"] += 1
+            buffer += chunk
+        if not buffer:
+            continue
+
+        now = time.monotonic()
+        if last_flush is None or len(buffer) >= max_chars or now - last_flush >= window_seconds * 4:
+            end = len(buffer)
+        elif len(buffer) >= min_chars or now - last_flush >= window_seconds:
+            end = find_flush_point(buffer)
+        else:
+            end = 0
+        if end:
+            stats["renders"] += 1
+            last_flush = now
+            yield buffer[:end]
+            buffer = buffer[end:]
+
+    if buffer:
+        stats["renders"] += 1
+        yield buffer
+
+
+def render_stream(placeholder, chunks):
+    """
+    placeholder (st.empty() など) にストリームを表示し、表示の回数と描画にかかったCPU時間を記録する。
+    config.STREAM_RENDER_COALESCE が無効ならchunkをそのまま表示する (比較用)。
+
+    Returns:
+        tuple: (write_stream の戻り値, {"chunks", "renders", "cpu_seconds"})
+    """
+    stats = {}
+    mode = "coalesce" if config.STREAM_RENDER_COALESCE else "direct"
+    if config.STREAM_RENDER_COALESCE:
+        chunks = coalesce(chunks, stats=stats)
+    else:
+        chunks = _counted(chunks, stats)
+
+    # 描画はこのスレッドで行われるので、スレッドのCPU時間を測る (待ち時間は含まない)
+    started = time.thread_time()
+    result = placeholder.write_stream(chunks)
+    stats["cpu_seconds"] = time.thread_time() - started
+
+    if stats["chunks"]:
+        metrics.observe("stream_renders", stats["renders"], mode=mode)
+        metrics.observe("stream_render_cpu_seconds", stats["cpu_seconds"], mode=mode)
+    return result, stats
+
+
+def _counted(chunks, stats):
+    stats.update({"chunks": 0, "renders": 0})
+    for chunk in chunks:
+        if chunk:
+            stats["chunks"] += 1
+            stats["renders"] += 1
+            yield chunk
@@ -0,0 +1,132 @@
+import datetime
+import itertools
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+import pytest
+from google.genai import types
+
+# テスト用のキャッシュ置き場 (config は import 時に環境変数を読むので、アプリのモジュールより先に設定する)
+os.environ["FSBOT_CACHE_DIR"] = tempfile.mkdtemp(prefix="fsbot-test-")
+os.environ["FSBOT_METRICS_SINK"] = ""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """SQLite・ディスクのキャッシュをテストごとに別の場所にする"""
+    import config
+    import extract_cache
+    import file_cache
+    import file_lifecycle
+    import response_cache
+    import retrieval
+
+    monkeypatch.setattr(config, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(extract_cache, "_DISK_DIR", str(tmp_path / "html_text"))
+    extract_cache.clear()
+    monkeypatch.setattr(file_cache, "_DB_PATH", str(tmp_path / "upload_cache.sqlite3"))
+    monkeypatch.setattr(file_lifecycle, "_DB_PATH", str(tmp_path / "remote_files.sqlite3"))
+    monkeypatch.setattr(response_cache, "_DB_PATH", str(tmp_path / "response_cache.sqlite3"))
+    monkeypatch.setattr(retrieval, "_DISK_DIR", str(tmp_path / "retrieval"))
+    return tmp_path
+
+
+def _api_error(code, retry_delay_seconds=None):
+    """Gemini APIのエラー (429/503 は RetryInfo.retryDelay を付けられる)"""
+    from google.genai import errors
+
+    error = {"code": code, "message": f"error {code}"}
+    if retry_delay_seconds is not None:
+        error["details"] = [{
+            "@type": "type.googleapis.com/google.rpc.RetryInfo",
+            "retryDelay": f"{retry_delay_seconds}s",
+        }]
+    cls = errors.ClientError if code < 500 else errors.ServerError
+    return cls(code, {"error": error})
+
+
+@pytest.fixture
+def api_error():
+    return _api_error
+
+
+@pytest.fixture
+def fresh_scheduler(monkeypatch):
+    """プロセス共有のスケジューラを作り直す (ブレーカーの状態をテスト間で持ち越さない)"""
+    import scheduler
+
+    monkeypatch.setattr(scheduler, "_scheduler", None)
+    yield scheduler.get_scheduler()
+
+
+class _FakeChat:
+    def __init__(self, client, model):
+        self.client = client
+        self.model = model
+        self.history = []
+
+    def get_history(self, curated=False):
+        return self.history
+
+    def send_message_stream(self, message):
+        # 実APIと同様に、混雑エラーは最初のchunkを取り出す時点で起きる
+        if self.model in self.client.busy_models:
+            raise _api_error(429)
+        text = self.client.response_text
+        for start in range(0, len(text), 10):
+            yield SimpleNamespace(text=text[start:start + 10])
+
+
+class _FakeChats:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model, config=None, history=None):
+        return _FakeChat(self.client, model)
+
+
+class _FakeFiles:
+    def __init__(self):
+        self.store = {}
+        self.counter = itertools.count(1)
+
+    def upload(self, file, config=None):
+        if isinstance(file, str):
+            with open(file, "rb") as f:
+                size = len(f.read())
+        else:
+            size = len(file.read())
+        name = f"files/fake-{next(self.counter)}"
+        self.store[name] = types.File(
+            name=name,
+            display_name=config.get("display_name"),
+            mime_type=config.get("mime_type", "application/pdf"),
+            size_bytes=size,
+            uri=f"https://fake.invalid/{name}",
+            expiration_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48),
+        )
+        return self.store[name]
+
+    def delete(self, name):
+        self.store.pop(name, None)
+
+
+class FakeClient:
+    """
+    genai.Client の代わり (APIに通信しない)。このアプリが使う files.upload / files.delete、chats.create → send_message_stream だけを持つ。
+    busy_models に入れたモデルへの送信は 429 になる。
+    """
+
+    def __init__(self):
+        self.busy_models = set()
+        self.response_text = "売上高は1,234百万円です。\\n前期比10%増加しました。"
+        self.files = _FakeFiles()
+        self.chats = _FakeChats(self)
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient()
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+import pytest
+import analysis
+import jobs
+import scheduler
+
+
+@pytest.fixture
+def chat_job(monkeypatch):
+    """run_chat を送信関数だけ差し替えて動かす"""
+    monkeypatch.setattr(analysis.chat_history, "prepare_chat", lambda client, chat, *args: (chat, {"full_tokens": 0}))
+    # 待ち時間は送信側 (gemini_logic) だけが持つ
+    monkeypatch.setattr(scheduler.RequestScheduler, "wait_before_retry", lambda *args: pytest.fail("analysis waited"))
+    chat = SimpleNamespace(get_history=lambda curated=False: [])
+    calls = []
+
+    def run(existing, hedged):
+        def send_chat_message_stream(*args):
+            calls.append("existing")
+            return existing()
+
+        def send_message_stream_hedged(*args, **kwargs):
+            calls.append("hedged")
+            return chat, hedged(), "fallback-model"
+
+        monkeypatch.setattr(analysis.gemini_logic, "send_chat_message_stream", send_chat_message_stream)
+        monkeypatch.setattr(analysis.gemini_logic, "send_message_stream_hedged", send_message_stream_hedged)
+        job = jobs.Job("job", "chat", "owner")
+        analysis.run_chat(job, None, chat, "primary-model", "質問")
+        return job
+    run.calls = calls
+    return run
+
+
+def _broken_stream(error):
+    yield "途中まで"
+    raise error
+
+
+def test_busy_send_is_not_retried_again(chat_job, api_error):
+    def busy():
+        raise api_error(429)
+
+    with pytest.raises(jobs.JobError):
+        chat_job(busy, busy)
+    # 既存のセッションで1回、新しいセッション (送信側で再試行する) で1回だけ送る
+    assert chat_job.calls == ["existing", "hedged"]
+
+
+def test_stream_failure_restarts_from_scratch(chat_job, api_error):
+    job = chat_job(lambda: _broken_stream(api_error(503)), lambda: iter(["回答"]))
+    assert chat_job.calls == ["existing", "hedged"]
+    assert job.text == "回答"
+    assert job.result["used_model"] == "fallback-model"
+
+
+def test_stream_restarts_are_limited(chat_job, api_error):
+    broken = lambda: _broken_stream(api_error(503))
+    with pytest.raises(jobs.JobError):
+        chat_job(broken, broken)
+    assert chat_job.calls == ["existing"] + ["hedged"] * analysis.MAX_STREAM_RESTARTS
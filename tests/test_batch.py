@@ -0,0 +1,75 @@
+import io
+import json
+import batch
+
+
+def _item(item_id):
+    return {"id": item_id, "mode": "summary", "files": [f"/data/{item_id}.pdf"]}
+
+
+def _ids(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["id"] for line in f]
+
+
+def test_jsonl_rewrite_keeps_one_line_per_id(tmp_path):
+    writer = batch.ResultWriter(str(tmp_path), "jsonl")
+    path = writer.write(_item("a"), {"model": "m", "text": "1回目"})
+    writer.write(_item("b"), {"model": "m", "text": "b"})
+
+    # 完了を記録する前に止まり、再開後に同じ項目をもう一度書き出した場合
+    resumed = batch.ResultWriter(str(tmp_path), "jsonl")
+    resumed.write(_item("a"), {"model": "m", "text": "2回目"})
+    assert sorted(_ids(path)) == ["a", "b"]
+    with open(path, encoding="utf-8") as f:
+        texts = {r["id"]: r["text"] for r in map(json.loads, f)}
+    assert texts["a"] == "2回目"
+
+
+def test_jsonl_skips_partial_lines(tmp_path):
+    path = tmp_path / "results.jsonl"
+    path.write_text(json.dumps({"id": "a", "text": "x"}) + "\n" + '{"id": "b", "te', encoding="utf-8")
+    writer = batch.ResultWriter(str(tmp_path), "jsonl")
+    assert writer.written_ids == {"a"}
+    writer.write(_item("a"), {"model": "m", "text": "y"})
+    assert _ids(path) == ["a"]
+
+
+def test_markdown_output(tmp_path):
+    writer = batch.ResultWriter(str(tmp_path), "markdown")
+    path = writer.write(_item("7203/2024"), {"model": "m", "text": "本文"})
+    with open(path, encoding="utf-8") as f:
+        body = f.read()
+    assert body.startswith("# 7203/2024\n")
+    assert "本文" in body
+    assert "/" not in path[len(str(tmp_path)) + 1:]
+
+
+def test_checkpoint_resumes_done_items(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint = batch.Checkpoint(path)
+    checkpoint.record({"id": "a", "status": "done"})
+    checkpoint.record({"id": "b", "status": "failed", "error": "400"})
+    assert batch.Checkpoint(path).done == {"a"}
+
+
+def test_items_release_only_their_own_files(cache_dir, fake_client, monkeypatch):
+    import file_lifecycle
+
+    shared = fake_client.files.upload(io.BytesIO(b"%PDF"), {"display_name": "shared.pdf"})
+    # 2件目も同じファイル (アップロード索引から再利用したもの) を使っている途中の状態
+    file_lifecycle.register([shared.name], "batch:b")
+    seen = []
+
+    def fake_run_analysis(job, client, files, prompt, prepare_followups=True):
+        seen.append((job.owner, shared.name in client.files.store))
+        file_lifecycle.register([shared.name], job.owner)
+        job.result.update({"uploaded_names": [shared.name], "text": "本文", "used_model": "m"})
+
+    monkeypatch.setattr(batch.analysis, "run_analysis", fake_run_analysis)
+    items = [dict(_item("a"), files=[]), dict(_item("b"), files=[])]
+    batch.run(fake_client, items, str(cache_dir / "out"), concurrency=1)
+
+    # 1件目の片付けでは消えず、最後に使った項目の片付けで削除される
+    assert seen == [("batch:a", True), ("batch:b", True)]
+    assert shared.name not in fake_client.files.store
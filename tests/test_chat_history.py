@@ -0,0 +1,27 @@
+from google.genai import types
+import chat_history
+import prompts
+
+
+def _turn(question, answer):
+    return [
+        types.Content(role="user", parts=[types.Part.from_text(text=question)]),
+        types.Content(role="model", parts=[types.Part.from_text(text=answer)]),
+    ]
+
+
+def test_compaction_uses_summary_instruction(monkeypatch):
+    calls = []
+
+    def fake_generate(client, contents, system_instruction):
+        calls.append(system_instruction)
+        return "要約", "model"
+
+    monkeypatch.setattr(chat_history.gemini_logic, "generate_with_fallback", fake_generate)
+    history = _turn("売上高は？", "1,200百万円です。") + _turn("営業利益は？", "150百万円です。")
+    compacted = chat_history.compact_history(None, history, keep_turns=1, token_threshold=0)
+
+    # 信頼度・免責文を求める分析用の指示は使わない
+    assert calls == [prompts.HISTORY_SUMMARY_SYSTEM_INSTRUCTION]
+    assert prompts.HISTORY_SUMMARY_HEADER in compacted[0].parts[-1].text
+    assert compacted[-1].parts[0].text == "150百万円です。"
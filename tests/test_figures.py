@@ -0,0 +1,134 @@
+import io
+import pytest
+import figures
+import html_text
+
+_HTML = """
+<html><body>
+<p>【会社名】 テスト工業株式会社</p>
+<p>【事業年度】 第76期 (自 2023年4月1日 至 2024年3月31日)</p>
+<p>(単位：百万円)</p>
+<table>
+<tr><td>回次</td><td>第75期</td><td>第76期</td></tr>
+<tr><td>決算年月</td><td>2023年3月</td><td>2024年3月</td></tr>
+<tr><td>売上高</td><td>1,000</td><td>1,200</td></tr>
+<tr><td>営業利益</td><td>100</td><td>150</td></tr>
+<tr><td>自己資本比率(%)</td><td>40.1</td><td>42.3</td></tr>
+</table>
+<p>連結貸借対照表</p>
+<table>
+<tr><td></td><td>前連結会計年度</td><td>当連結会計年度</td></tr>
+<tr><td>資産合計</td><td>5,000</td><td>5,500</td></tr>
+<tr><td>純資産合計</td><td>2,000</td><td>△2,300</td></tr>
+</table>
+</body></html>
+"""
+
+
+@pytest.fixture
+def index():
+    data = _HTML.encode("utf-8")
+    text = "\n".join(html_text.iter_lines(io.BytesIO(data)))
+    document = {
+        "type": "html",
+        "display_name": "test.htm",
+        "text": text,
+        "figures": figures.extract_records(data),
+    }
+    return figures.FigureIndex.from_documents([document])
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1,234", 1234.0),
+    ("△1,234", -1234.0),
+    ("(56)", -56.0),
+    ("12.5%", 12.5),
+    ("-", None),
+    ("売上高", None),
+])
+def test_parse_number(text, expected):
+    assert figures.parse_number(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2024年3月", ("2024年3月期", 202403)),
+    ("自 2023年4月1日 至 2024年3月31日", ("2024年3月期", 202403)),
+    ("令和6年3月", ("2024年3月期", 202403)),
+    ("2024/3", ("2024年3月期", 202403)),
+    ("第76期", ("第76期", 76.0)),
+    ("当連結会計年度", ("当連結会計年度", 0.0)),
+    ("摘要", (None, None)),
+])
+def test_parse_period(text, expected):
+    assert figures.parse_period(text) == expected
+
+
+def test_normalize_metric():
+    assert figures.normalize_metric("(1) 自己資本比率 (%)") == ("自己資本比率", "%")
+    assert figures.normalize_metric("売上高※1") == ("売上高", "")
+
+
+def test_unit_is_carried_to_later_tables(index):
+    frame = index.frame
+    # 2つ目の表の前には単位が無いので、直前に書かれた単位を使う
+    assert set(frame[frame["metric"] == "資産合計"]["unit"]) == {"百万円"}
+    assert set(frame[frame["metric"] == "自己資本比率"]["unit"]) == {"%"}
+
+
+def test_relative_periods_are_resolved(index):
+    rows = index.lookup("純資産合計")
+    assert list(rows["period"]) == ["2023年3月期", "2024年3月期"]
+    assert list(rows["value"]) == [2000.0, -2300.0]
+
+
+def test_resolve_periods_uses_fiscal_year_text():
+    records = [("売上高", "第75期", 75.0, 1.0, "", 1), ("売上高", "前期", -1.0, 2.0, "", 2)]
+    resolved = figures.resolve_periods(records, "【事業年度】 第76期 (自 2023年4月1日 至 2024年3月31日)")
+    assert [(r[1], r[2]) for r in resolved] == [("2023年3月期", 202303), ("2023年3月期", 202303)]
+
+
+def test_company_is_detected(index):
+    assert set(index.frame["company"]) == {"テスト工業株式会社"}
+
+
+@pytest.mark.parametrize("question", [
+    "売上高は？",
+    "売上高を教えて",
+    "2024年3月期の営業利益はいくらですか",
+    "営業利益率の推移を教えて",
+    "自己資本比率は",
+])
+def test_lookup_questions_are_answered_locally(index, question):
+    answer = index.answer(question)
+    assert answer is not None
+    assert "出典" in answer
+
+
+@pytest.mark.parametrize("question", [
+    "日本での事業展開について教えて",
+    "その他の事業の状況を詳しく",
+    "売上高を増やすために何をしていますか",
+    "営業利益が増えた理由は？",
+    "研究開発費は？",
+])
+def test_other_questions_go_to_the_llm(index, question):
+    assert index.answer(question) is None
+
+
+def test_simple_question_answers_latest_period(index):
+    answer = index.answer("売上高は？")
+    assert "2024年3月期" in answer
+    assert "2023年3月期" not in answer
+    assert "(単位：百万円)" in answer
+
+
+def test_trend_question_includes_change(index):
+    answer = index.answer("営業利益率の推移")
+    assert "前期比" in answer
+    assert "12.5%" in answer
+    assert "+2.5pt" in answer
+
+
+def test_records_round_trip():
+    records = [("売上高", "2024年3月期", 202403, 1200.0, "百万円", 1)]
+    assert figures.load_records(figures.dump_records(records)) == records
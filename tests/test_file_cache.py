@@ -0,0 +1,42 @@
+import time
+import config
+import file_cache
+
+
+def _record(number, **kwargs):
+    return file_cache.record(
+        f"sha{number}", 100, config.PRIMARY_MODEL,
+        f"files/{number}", f"https://example.invalid/{number}", "application/pdf", **kwargs
+    )
+
+
+def test_lookup_after_record(cache_dir):
+    assert file_cache.lookup("sha1", 100, config.PRIMARY_MODEL) is None
+    assert _record(1) == []
+    assert file_cache.lookup("sha1", 100, config.PRIMARY_MODEL) == {
+        "name": "files/1", "uri": "https://example.invalid/1", "mime_type": "application/pdf"
+    }
+    # 大きさ・モデルが違えば別のファイル
+    assert file_cache.lookup("sha1", 101, config.PRIMARY_MODEL) is None
+    assert file_cache.lookup("sha1", 100, config.FALLBACK_MODEL) is None
+
+
+def test_expired_entry_is_not_returned(cache_dir):
+    _record(1, expires_at=time.time() - 1)
+    assert file_cache.lookup("sha1", 100, config.PRIMARY_MODEL) is None
+
+
+def test_least_recently_used_entries_are_evicted(cache_dir, monkeypatch):
+    monkeypatch.setattr(config, "UPLOAD_CACHE_MAX_ENTRIES", 2)
+    _record(1)
+    _record(2)
+    # 1 を使うと、次に追い出されるのは 2 になる
+    assert file_cache.lookup("sha1", 100, config.PRIMARY_MODEL)
+    assert _record(3) == ["files/2"]
+    assert file_cache.lookup("sha2", 100, config.PRIMARY_MODEL) is None
+
+
+def test_forget(cache_dir):
+    _record(1)
+    file_cache.forget(["files/1"])
+    assert file_cache.lookup("sha1", 100, config.PRIMARY_MODEL) is None
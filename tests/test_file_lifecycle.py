@@ -0,0 +1,85 @@
+import hashlib
+import io
+import time
+import config
+import file_cache
+import file_lifecycle
+import gemini_logic
+
+
+def _upload(client, data, owner):
+    return gemini_logic.upload_file_to_gemini_cached(
+        client, io.BytesIO(data), "test.pdf", hashlib.sha256(data).hexdigest(), len(data),
+        mime_type="application/pdf", owner=owner
+    )
+
+
+def test_release_keeps_files_used_by_other_sessions(cache_dir, fake_client):
+    uploaded, from_cache = _upload(fake_client, b"%PDF-1", "session-a")
+    reused, reused_from_cache = _upload(fake_client, b"%PDF-1", "session-b")
+    assert (from_cache, reused_from_cache) == (False, True)
+    assert reused.name == uploaded.name
+    # 再利用したセッションも、見つけた時点で持ち主になる
+    assert file_lifecycle.owned_files("session-b") == [uploaded.name]
+
+    assert file_lifecycle.release(fake_client, "session-a") == []
+    assert uploaded.name in fake_client.files.store
+    assert file_lifecycle.release(fake_client, "session-b") == [uploaded.name]
+    assert uploaded.name not in fake_client.files.store
+    assert file_cache.lookup(hashlib.sha256(b"%PDF-1").hexdigest(), 6, config.PRIMARY_MODEL) is None
+
+
+def test_file_object_is_opened_only_on_miss(cache_dir, fake_client):
+    data = b"%PDF-2"
+    _upload(fake_client, data, "session-a")
+    opened = []
+
+    def open_content():
+        opened.append(True)
+        return io.BytesIO(data)
+
+    _, from_cache = gemini_logic.upload_file_to_gemini_cached(
+        fake_client, open_content, "test.pdf", hashlib.sha256(data).hexdigest(), len(data),
+        mime_type="application/pdf", owner="session-b"
+    )
+    assert from_cache
+    assert opened == []
+
+
+def test_sweep_deletes_only_orphans(cache_dir, fake_client, monkeypatch):
+    monkeypatch.setattr(config, "FILE_ORPHAN_TTL_SECONDS", 60)
+    idle, _ = _upload(fake_client, b"%PDF-idle", "idle-session")
+    active, _ = _upload(fake_client, b"%PDF-active", "active-session")
+    later = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: later)
+    file_lifecycle.touch("active-session")
+
+    assert file_lifecycle.sweep(fake_client) == [idle.name]
+    assert idle.name not in fake_client.files.store
+    assert active.name in fake_client.files.store
+
+
+def test_reclaim_keeps_live_files(cache_dir, fake_client):
+    used, _ = _upload(fake_client, b"%PDF-used", "session-a")
+    unused, _ = _upload(fake_client, b"%PDF-unused", None)
+    # 台帳に載っていないファイル (どのセッションも使っていない)
+    file_lifecycle._forget([unused.name])
+
+    assert file_lifecycle.reclaim(fake_client, [used.name, unused.name]) == [unused.name]
+    assert used.name in fake_client.files.store
+
+
+def test_failed_delete_is_retried_by_sweep(cache_dir, fake_client, monkeypatch):
+    uploaded, _ = _upload(fake_client, b"%PDF-3", "session-a")
+    fail = {"delete": True}
+    delete = fake_client.files.delete
+
+    def flaky_delete(name):
+        if fail["delete"]:
+            raise RuntimeError("network error")
+        delete(name)
+
+    monkeypatch.setattr(fake_client.files, "delete", flaky_delete)
+    assert file_lifecycle.release(fake_client, "session-a") == []
+    fail["delete"] = False
+    assert file_lifecycle.sweep(fake_client) == [uploaded.name]
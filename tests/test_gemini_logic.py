@@ -0,0 +1,82 @@
+import threading
+import time
+from types import SimpleNamespace
+import config
+import gemini_logic
+
+
+def _chunks(*texts):
+    return [SimpleNamespace(text=text) for text in texts]
+
+
+def test_clean_stream_generator_fixes_escaped_newlines():
+    output = "".join(gemini_logic.clean_stream_generator(_chunks("a\\nb", None, "c")))
+    assert output == "a\nbc"
+
+
+def test_clean_stream_generator_joins_split_escape():
+    # chunkの境目で "\\" と "n" が分かれた場合
+    output = "".join(gemini_logic.clean_stream_generator(_chunks("a\\", "nb", "c\\")))
+    assert output == "a\nbc\\"
+
+
+def test_fallback_to_second_model_when_primary_is_busy(fresh_scheduler, fake_client):
+    fake_client.busy_models.add(config.PRIMARY_MODEL)
+    notices = []
+    chat, stream, used_model = gemini_logic.send_message_stream_with_fallback(
+        fake_client, [], "質問", "system", notify=notices.append
+    )
+    assert used_model == config.FALLBACK_MODEL
+    assert "".join(stream) == fake_client.response_text.replace("\\n", "\n")
+    assert notices and config.PRIMARY_MODEL in notices[0]
+
+
+def test_primary_is_used_again_after_cooldown(fresh_scheduler, fake_client):
+    breaker = fresh_scheduler.breakers[config.PRIMARY_MODEL]
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    _, stream, used_model = gemini_logic.send_message_stream_hedged(fake_client, [], "質問", "system")
+    "".join(stream)
+    assert used_model == config.FALLBACK_MODEL
+
+    breaker.opened_until = 0.001
+    _, stream, used_model = gemini_logic.send_message_stream_hedged(fake_client, [], "質問", "system")
+    "".join(stream)
+    assert used_model == config.PRIMARY_MODEL
+    assert not breaker.is_open()
+
+
+def test_hedge_loser_keeps_its_slot_until_closed(fresh_scheduler, fake_client, monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(config, "HEDGE_DELAY_SECONDS", 0.01)
+    finished = []
+    finish = fresh_scheduler._finish
+
+    def record_finish(model, error, probe=False, cancelled=False):
+        finished.append((model, cancelled))
+        finish(model, error, probe, cancelled)
+
+    monkeypatch.setattr(fresh_scheduler, "_finish", record_finish)
+    # Primaryは最初のchunkを返すまでに時間がかかる
+    primary_gate = threading.Event()
+    chat_class = type(fake_client.chats.create(config.PRIMARY_MODEL))
+    send = chat_class.send_message_stream
+
+    def slow_send(chat, message):
+        if chat.model == config.PRIMARY_MODEL:
+            primary_gate.wait(5)
+        yield from send(chat, message)
+
+    monkeypatch.setattr(chat_class, "send_message_stream", slow_send)
+    _, stream, used_model = gemini_logic.send_message_stream_hedged(fake_client, [], "質問", "system")
+    "".join(stream)
+    assert used_model == config.FALLBACK_MODEL
+    # 負けたPrimaryのリクエストはまだ終わっていないので、枠を持ったまま
+    assert finished == [(config.FALLBACK_MODEL, False)]
+
+    primary_gate.set()
+    for _ in range(100):
+        if len(finished) == 2:
+            break
+        time.sleep(0.01)
+    assert finished[1] == (config.PRIMARY_MODEL, True)
@@ -0,0 +1,52 @@
+import io
+import os
+import subprocess
+import sys
+import pytest
+import html_text
+
+
+def _lines(html, encoding="utf-8"):
+    return list(html_text.iter_lines(io.BytesIO(html.encode(encoding)), chunk_size=16))
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("12354", ("あ", "")),
+    ("x3042", ("あ", "")),
+    ("X3042", ("あ", "")),
+    ("128", ("€", "")),
+    ("0", ("�", "")),
+    ("55296", ("�", "")),
+    ("1114112", ("�", "")),
+    ("12abc", ("\x0c", "abc")),
+    ("xzz", ("", "zz")),
+])
+def test_dereference_charref(name, expected):
+    assert html_text._dereference_charref(name) == expected
+
+
+def test_iter_lines_extracts_visible_text():
+    html = (
+        "<html><head><style>p {}</style><script>var a;</script></head>"
+        "<body><p>売上高&#12354;&amp;</p><br><p>  営業利益  </p><!-- note --><template>x</template></body></html>"
+    )
+    assert _lines(html) == ["売上高あ&", "営業利益"]
+
+
+def test_iter_lines_falls_back_to_cp932():
+    assert _lines("<p>有価証券報告書</p>", encoding="cp932") == ["有価証券報告書"]
+
+
+def test_named_entities_match_bs4():
+    from bs4.dammit import EntitySubstitution
+
+    assert html_text._NAMED_ENTITIES == EntitySubstitution.HTML_ENTITY_TO_CHARACTER
+    # 未知の参照は bs4 と同じく ";" を落として残す
+    assert _lines("<p>&copy;&nbsp;&unknown;&amp</p>") == ["©\xa0&unknown&"]
+
+
+def test_import_does_not_load_bs4():
+    code = "import sys, html_text, utils; print('bs4' in sys.modules)"
+    root = os.path.dirname(os.path.abspath(html_text.__file__))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "False"
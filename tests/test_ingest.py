@@ -0,0 +1,42 @@
+import io
+import pytest
+import config
+import extract_cache
+import figures
+import ingest
+from test_figures import _HTML
+
+
+class _Upload(io.BytesIO):
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+@pytest.fixture
+def ingest_html(cache_dir, monkeypatch):
+    monkeypatch.setattr(config, "INGEST_PARSE_PROCESSES", 0)
+
+    def run(backend):
+        monkeypatch.setattr(config, "HTML_EXTRACT_BACKEND", backend)
+        documents, uploaded = ingest.ingest_files(None, [_Upload(_HTML.encode("utf-8"), "test.htm")])
+        assert uploaded == []
+        return documents[0]
+    return run
+
+
+def test_stream_parses_text_and_figures_in_one_pass(ingest_html, monkeypatch):
+    expected = ingest_html("bs4")
+    extract_cache.clear(disk=True)
+    # 1回の読み込みで取り出すので、表だけを別に解析することはない
+    monkeypatch.setattr(figures, "extract_records", lambda data: pytest.fail("parsed twice"))
+    document = ingest_html("stream")
+    assert document["text"] == expected["text"]
+    assert document["figures"] == expected["figures"]
+    assert document["content"] == expected["content"]
+
+
+def test_stream_results_are_cached(ingest_html, monkeypatch):
+    first = ingest_html("stream")
+    monkeypatch.setattr(ingest, "_parse_html", lambda data: pytest.fail("not cached"))
+    assert ingest_html("stream") == first
@@ -0,0 +1,76 @@
+import io
+import pytest
+import pdf_text
+
+
+def _make_pdf(page_texts):
+    """1ページ1行のテキストPDFを作る。None のページは画像だけのページ (スキャン画像の代わり) にする"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Type /XObject /Subtype /Image /Width 1 /Height 1 /ColorSpace /DeviceGray "
+        b"/BitsPerComponent 8 /Length 1 >>\nstream\n\x80\nendstream",
+    ]
+    kids = []
+    for text in page_texts:
+        if text is None:
+            stream = b"q 612 0 0 792 0 0 cm /Im1 Do Q"
+            resources = b"<< /XObject << /Im1 4 0 R >> >>"
+        else:
+            stream = b"BT /F1 12 Tf 72 720 Td (" + text.encode("ascii") + b") Tj ET"
+            resources = b"<< /Font << /F1 3 0 R >> >>"
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources " + resources + b" /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(kids) + b"] /Count %d >>" % len(kids)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref_at = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_at))
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("text", [
+    "当連結会計年度の売上高は1,234百万円となりました。",
+    "Financial summary page 1",
+    "",
+])
+def test_readable_text_is_not_garbled(text):
+    assert not pdf_text.is_garbled(text)
+
+
+@pytest.mark.parametrize("text", [
+    "\x01\x02\x03\x04\x05\x06",
+    "",
+    "(cid:12)(cid:34)(cid:56)",
+    "Ѐ Ё Ђ Ѓ Є Ѕ",
+])
+def test_mojibake_is_garbled(text):
+    assert pdf_text.is_garbled(text)
+
+
+@pytest.mark.skipif(not pdf_text.available(), reason="pypdf is not installed")
+def test_scanned_pages_are_marked():
+    pages = pdf_text.extract_pages(_make_pdf(["Financial summary page 1", None, "Revenue 1,234"]))
+    assert len(pages) == 3
+    assert pages[1] is None
+    assert "Revenue 1,234" in pages[2]
+
+
+def test_build_content_marks_pages():
+    content = pdf_text.build_content("a.pdf", ["1ページ目", None])
+    assert "(P.1)" in content
+    assert "1ページ目" in content
+    assert pdf_text.scanned_display_name("a.pdf") in content
@@ -0,0 +1,41 @@
+import config
+import response_cache
+
+
+def test_make_key_ignores_document_order():
+    key = response_cache.make_key(["a", "b"], "prompt", "system")
+    assert key == response_cache.make_key(["b", "a"], "prompt", "system")
+
+
+def test_make_key_depends_on_inputs():
+    key = response_cache.make_key(["a"], "prompt", "system")
+    assert key != response_cache.make_key(["a", "b"], "prompt", "system")
+    assert key != response_cache.make_key(["a"], "other prompt", "system")
+    assert key != response_cache.make_key(["a"], "prompt", "other system")
+    assert key != response_cache.make_key(["a"], "prompt", "system", model=config.FALLBACK_MODEL)
+    assert key != response_cache.make_key(["a"], "prompt", "system", temperature=config.TEMPERATURE + 0.5)
+    # 省略時は Primaryモデル・設定の temperature と同じキー
+    assert key == response_cache.make_key(["a"], "prompt", "system", model=config.PRIMARY_MODEL)
+
+
+def test_put_and_get(cache_dir):
+    key = response_cache.make_key(["a"], "prompt", "system")
+    assert response_cache.get(key) is None
+    response_cache.put(key, "回答", config.PRIMARY_MODEL)
+    assert response_cache.get(key) == {"text": "回答", "used_model": config.PRIMARY_MODEL}
+    stats = response_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_expired_entry_is_dropped(cache_dir):
+    key = response_cache.make_key(["a"], "prompt", "system")
+    response_cache.put(key, "回答", config.PRIMARY_MODEL, ttl_seconds=-1)
+    assert response_cache.get(key) is None
+    assert response_cache.stats()["entries"] == 0
+
+
+def test_replay_stream_returns_the_whole_text():
+    text = "あ" * 25
+    chunks = list(response_cache.replay_stream(text, chunk_chars=10))
+    assert [len(c) for c in chunks] == [10, 10, 5]
+    assert "".join(chunks) == text
@@ -0,0 +1,54 @@
+import config
+import retrieval
+
+
+def _document(name, sha256, pages):
+    return {"display_name": name, "sha256": sha256, "page_texts": pages, "text": "\n".join(p for p in pages if p)}
+
+
+def test_tokenize_uses_words_and_bigrams():
+    assert retrieval.tokenize("ROE 12.5%") == ["roe", "12.5%"]
+    assert retrieval.tokenize("売上高") == ["売上", "上高"]
+
+
+def test_search_finds_relevant_page(cache_dir):
+    documents = [_document("report.pdf", "sha-report", [
+        "会社の沿革と役員の状況について記載しています。",
+        "当期の売上高は前期比10%増加し、海外事業が伸長しました。",
+        "研究開発活動として新素材の開発を進めています。",
+    ])]
+    index = retrieval.RetrievalIndex.from_documents(documents)
+    results = index.search("売上高の増加要因", top_k=1)
+    assert len(results) == 1
+    display_name, label, text, score = results[0]
+    assert display_name == "report.pdf"
+    assert "売上高" in text
+    assert "P.2" in label
+    assert score > 0
+
+
+def test_index_is_reused_from_disk(cache_dir):
+    documents = [_document("report.pdf", "sha-disk", ["売上高が増加しました。"])]
+    retrieval.RetrievalIndex.from_documents(documents)
+    calls = []
+    retrieval.load_or_build("sha-disk", lambda: calls.append(True) or [])
+    assert calls == []
+
+
+def test_index_is_rebuilt_when_chunk_size_changes(cache_dir, monkeypatch):
+    documents = [_document("report.pdf", "sha-chunk", ["売上高が増加しました。"])]
+    retrieval.RetrievalIndex.from_documents(documents)
+    monkeypatch.setattr(config, "RETRIEVAL_CHUNK_CHARS", config.RETRIEVAL_CHUNK_CHARS // 2)
+    calls = []
+    retrieval.load_or_build("sha-chunk", lambda: calls.append(True) or [("P.1", "売上高")])
+    assert calls == [True]
+
+
+def test_documents_without_text_are_not_indexed(cache_dir):
+    assert retrieval.RetrievalIndex.from_documents([_document("scan.pdf", "sha-scan", ["本文", None])]) is None
+    assert retrieval.RetrievalIndex.from_documents([{"display_name": "a.pdf", "sha256": "x", "content": object()}]) is None
+
+
+def test_format_passages():
+    text = retrieval.format_passages([("a.pdf", "(P.2)", "売上高", 1.0)])
+    assert "[1] a.pdf (P.2)\n売上高" in text
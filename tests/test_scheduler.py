@@ -0,0 +1,137 @@
+import time
+import pytest
+import config
+import scheduler
+
+
+def _open(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def _cool_down(breaker):
+    breaker.opened_until = time.monotonic() - 0.01
+
+
+def test_breaker_opens_after_threshold():
+    breaker = scheduler.CircuitBreaker(failure_threshold=3, cooldown_seconds=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert breaker.is_open()
+
+
+def test_breaker_allow_has_no_side_effect():
+    breaker = scheduler.CircuitBreaker(failure_threshold=1, cooldown_seconds=60)
+    _open(breaker)
+    _cool_down(breaker)
+    # 何度問い合わせても、試しの1件は消費されない
+    assert all(breaker.allow() for _ in range(5))
+    assert breaker.begin()
+    assert not breaker.allow()
+    assert not breaker.begin()
+
+
+def test_breaker_recovers_after_successful_probe():
+    breaker = scheduler.CircuitBreaker(failure_threshold=1, cooldown_seconds=60)
+    _open(breaker)
+    _cool_down(breaker)
+    assert breaker.begin()
+    breaker.record_success()
+    assert breaker.allow()
+    assert not breaker.is_open()
+    assert breaker.failures == 0
+
+
+def test_breaker_reopens_after_failed_probe():
+    breaker = scheduler.CircuitBreaker(failure_threshold=3, cooldown_seconds=60)
+    _open(breaker)
+    _cool_down(breaker)
+    assert breaker.begin()
+    breaker.record_failure(probe=True)
+    assert not breaker.allow()
+    assert not breaker.probing
+
+
+def test_breaker_releases_probe_on_other_outcome():
+    breaker = scheduler.CircuitBreaker(failure_threshold=1, cooldown_seconds=60)
+    _open(breaker)
+    _cool_down(breaker)
+    assert breaker.begin()
+    breaker.record_other(probe=True)
+    # 400などで終わった試しの1件の後は、次のリクエストで改めて試せる
+    assert breaker.allow()
+    assert breaker.begin()
+
+
+def test_models_to_try_skips_open_primary(fresh_scheduler):
+    breaker = fresh_scheduler.breakers[config.PRIMARY_MODEL]
+    assert fresh_scheduler.models_to_try() == [config.PRIMARY_MODEL, config.FALLBACK_MODEL]
+    _open(breaker)
+    assert fresh_scheduler.models_to_try() == [config.FALLBACK_MODEL]
+
+
+def test_scheduler_probe_is_claimed_on_acquire(fresh_scheduler):
+    breaker = fresh_scheduler.breakers[config.PRIMARY_MODEL]
+    _open(breaker)
+    _cool_down(breaker)
+    # models_to_try を何度呼んでも、Primaryは候補に残る
+    assert fresh_scheduler.models_to_try()[0] == config.PRIMARY_MODEL
+    assert fresh_scheduler.models_to_try()[0] == config.PRIMARY_MODEL
+
+    slot = fresh_scheduler.acquire(config.PRIMARY_MODEL)
+    assert slot.probe
+    assert fresh_scheduler.models_to_try() == [config.FALLBACK_MODEL]
+    slot.release()
+    assert fresh_scheduler.models_to_try()[0] == config.PRIMARY_MODEL
+    assert not breaker.is_open()
+
+
+def test_scheduler_non_retryable_probe_clears_probing(fresh_scheduler, api_error):
+    breaker = fresh_scheduler.breakers[config.PRIMARY_MODEL]
+    _open(breaker)
+    _cool_down(breaker)
+    slot = fresh_scheduler.acquire(config.PRIMARY_MODEL)
+    slot.release(api_error(400))
+    assert not breaker.probing
+    assert fresh_scheduler.models_to_try()[0] == config.PRIMARY_MODEL
+
+
+def test_cancelled_slot_returns_capacity_without_recording(fresh_scheduler):
+    breaker = fresh_scheduler.breakers[config.PRIMARY_MODEL]
+    breaker.record_failure()
+    available = fresh_scheduler.in_flight._value
+    slot = fresh_scheduler.acquire(config.PRIMARY_MODEL)
+    assert fresh_scheduler.in_flight._value == available - 1
+    slot.cancel()
+    slot.release()
+    assert fresh_scheduler.in_flight._value == available
+    # 取り消しは成功として数えない
+    assert breaker.failures == 1
+
+
+def test_retryable_errors(api_error):
+    assert scheduler.is_retryable_error(api_error(429))
+    assert scheduler.is_retryable_error(api_error(503))
+    assert not scheduler.is_retryable_error(api_error(400))
+
+
+@pytest.mark.parametrize("value, expected", [("12s", 12.0), ("1.5s", 1.5), ("30", 30.0), ("soon", None)])
+def test_parse_seconds(value, expected):
+    assert scheduler._parse_seconds(value) == expected
+
+
+def test_retry_after_from_retry_info(api_error):
+    assert scheduler.retry_after_seconds(api_error(429, retry_delay_seconds=7)) == 7.0
+    assert scheduler.retry_after_seconds(api_error(429)) is None
+
+
+def test_backoff_respects_retry_after(fresh_scheduler, monkeypatch, api_error):
+    monkeypatch.setattr(config, "BACKOFF_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(config, "BACKOFF_MAX_SECONDS", 5.0)
+    assert fresh_scheduler.backoff_seconds(0) <= 0.01
+    assert fresh_scheduler.backoff_seconds(0, api_error(429, retry_delay_seconds=3)) >= 3.0
+    # 上限を超える Retry-After は上限で打ち切る
+    assert fresh_scheduler.backoff_seconds(0, api_error(429, retry_delay_seconds=60)) == 5.0
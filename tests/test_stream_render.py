@@ -0,0 +1,40 @@
+import stream_render
+
+
+def test_find_flush_point_stops_at_last_complete_line():
+    assert stream_render.find_flush_point("abc") == 0
+    assert stream_render.find_flush_point("line1\nline2") == len("line1\n")
+    assert stream_render.find_flush_point("line1\nline2\n") == len("line1\nline2\n")
+
+
+def test_find_flush_point_holds_table_header():
+    text = "intro\n| 期間 | 値 |\n"
+    # 区切り行が届くまでは見出し行を表示しない
+    assert stream_render.find_flush_point(text) == len("intro\n")
+    text += "|---|---|\n| 2024年3月期 | 100 |\n"
+    assert stream_render.find_flush_point(text) == len(text)
+
+
+def test_coalesce_preserves_text_and_reduces_renders():
+    chunks = [f"行{i}です。\n" for i in range(200)]
+    stats = {}
+    output = list(stream_render.coalesce(chunks, min_chars=100, max_chars=1000, window_seconds=10, stats=stats))
+    assert "".join(output) == "".join(chunks)
+    assert stats["chunks"] == 200
+    assert stats["renders"] == len(output) < 200
+    # 最初のchunkはすぐに返す
+    assert output[0] == chunks[0]
+
+
+def test_coalesce_flushes_at_max_chars_without_line_break():
+    chunks = ["x" * 50] * 10
+    output = list(stream_render.coalesce(chunks, min_chars=100, max_chars=120, window_seconds=10))
+    assert "".join(output) == "x" * 500
+    assert all(len(part) <= 170 for part in output)
+
+
+def test_coalesce_ignores_heartbeats():
+    stats = {}
+    output = list(stream_render.coalesce(["", "a\n", "", "", "b\n"], window_seconds=0, stats=stats))
+    assert "".join(output) == "a\nb\n"
+    assert stats["chunks"] == 2
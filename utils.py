@@ -1,8 +1,22 @@
-import streamlit as st
 import streamlit.components.v1 as components
+import io
+import logging
 import os
+import re
+import hashlib
 import tempfile
-from bs4 import BeautifulSoup
+import threading
+import time
+import config
+import html_text
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# アップロード用の一時ファイルの置き場所 (掃除の対象をこのアプリのファイルに限るため専用にする)
+_TEMP_DIR = os.path.join(config.CACHE_DIR, "tmp")
+_janitor_lock = threading.Lock()
+_janitor_started = False
 
 def setup_japanese_language():
     """ブラウザに日本語サイトとして認識させるためのJavascriptを注入"""
@@ -12,61 +26,143 @@ def setup_japanese_language():
         </script>
     """, height=0)
 
-def process_uploaded_file(uploaded_file):
+def get_file_type(file_name):
+    """拡張子からファイル種別 ("pdf" / "html") を判定する。対象外ならNone"""
+    file_ext = os.path.splitext(file_name)[1].lower()
+    if file_ext == ".pdf":
+        return "pdf"
+    if file_ext in [".htm", ".html"]:
+        return "html"
+    return None
+
+def prepare_pdf(data, display_name, via_temp_file=None):
     """
-    アップロードされたファイルを処理し、Geminiに送れる形式またはテキストを返す。
-    
+    PDFのバイト列から、アップロード用の情報を返す。
+    通常はバイト列をBytesIOで包んでそのままアップロードする (bytesを共有するのでコピーも
+    ディスクへの書き出しも発生しない)。config.UPLOAD_VIA_TEMP_FILE が有効な場合だけ一時ファイルに書き出す。
+    並列取り込みのワーカースレッドからも呼ばれるため、Streamlitの表示は行わない。
+
     Args:
-        uploaded_file: StreamlitのUploadedFileオブジェクト
-        
-    Returns:
-        dict: {
-            "type": "pdf" or "html" or "text",
-            "content": content_to_send,
-            "tmp_path": temporary_file_path (for PDF cleanup, optional),
-            "display_name": filename
-        }
+        via_temp_file: 一時ファイルに書き出すかどうか。Noneなら config.UPLOAD_VIA_TEMP_FILE に従う
+            (アップロードが必要か分かってから書き出す場合は False を渡す)
     """
-    file_ext = os.path.splitext(uploaded_file.name)[1].lower()
+    if via_temp_file is None:
+        via_temp_file = config.UPLOAD_VIA_TEMP_FILE
+    tmp_path = write_temp_file(data, ".pdf") if via_temp_file else None
     
-    if file_ext == ".pdf":
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_path = tmp_file.name
-            
-            return {
-                "type": "pdf",
-                "content": tmp_path, # Geminiへのアップロードはこのパスを使用
-                "tmp_path": tmp_path,
-                "display_name": uploaded_file.name
-            }
-        except Exception as e:
-            st.error(f"PDF処理エラー: {e}")
-            return None
-
-    elif file_ext in [".htm", ".html"]:
-        try:
+    return {
+        "type": "pdf",
+        # Geminiへのアップロードはこれを使用
+        "content": tmp_path or io.BytesIO(data),
+        "mime_type": "application/pdf",
+        "tmp_path": tmp_path,
+        "display_name": display_name,
+        # アップロード済みファイルの再利用判定に使う
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "size": len(data),
+        # トークン数の見積もりに使う
+        "pages": count_pdf_pages(data)
+    }
+
+def write_temp_file(data, suffix):
+    """
+    専用のディレクトリに一時ファイルを書き出してパスを返す。
+    使い終わったら呼び出し側で削除すること (異常終了などで残った分は start_temp_janitor が削除する)。
+    """
+    os.makedirs(_TEMP_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=_TEMP_DIR) as tmp_file:
+        tmp_file.write(data)
+        return tmp_file.name
+
+def clean_temp_files(max_age_seconds=None):
+    """
+    作成から max_age_seconds 以上経った一時ファイルを削除する。
+
+    Returns:
+        int: 削除したファイル数
+    """
+    if max_age_seconds is None:
+        max_age_seconds = config.TEMP_FILE_MAX_AGE_SECONDS
+    if not os.path.isdir(_TEMP_DIR):
+        return 0
+    deadline = time.time() - max_age_seconds
+    removed = 0
+    with os.scandir(_TEMP_DIR) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                # 他のプロセスが先に削除した場合など
+                continue
+    if removed:
+        metrics.increment("temp_files_cleaned", removed)
+    return removed
+
+def start_temp_janitor():
+    """一時ファイルの掃除を起動時に1回行い、以後は定期的に行うスレッドを起動する (プロセスにつき1回だけ)"""
+    global _janitor_started
+    with _janitor_lock:
+        if _janitor_started:
+            return
+        _janitor_started = True
+
+    def run():
+        while True:
             try:
-                html_content = uploaded_file.getvalue().decode("utf-8")
-            except UnicodeDecodeError:
-                html_content = uploaded_file.getvalue().decode("cp932")
-            
-            soup = BeautifulSoup(html_content, 'html.parser')
-            for script_or_style in soup(["script", "style"]):
-                script_or_style.decompose()
-            text_data = soup.get_text(separator="\n") 
-            lines = [line.strip() for line in text_data.splitlines() if line.strip()]
-            clean_text = "\n".join(lines)
-            
-            return {
-                "type": "html",
-                "content": clean_text,
-                "tmp_path": None,
-                "display_name": uploaded_file.name
-            }
-        except Exception as e:
-            st.error(f"HTML処理エラー: {e}")
-            return None
+                clean_temp_files()
+            except OSError as e:
+                logger.warning("Failed to clean temp files: %s", e)
+            time.sleep(config.TEMP_JANITOR_INTERVAL_SECONDS)
+
+    threading.Thread(target=run, name="temp-janitor", daemon=True).start()
+
+# ページオブジェクト (/Type /Pages は除く) を数えるための正規表現
+_PDF_PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+def count_pdf_pages(data):
+    """
+    PDFのページ数を見積もる。
+    ページオブジェクトが圧縮されていて数えられない場合は、ファイルサイズから推定する。
+    """
+    pages = len(_PDF_PAGE_PATTERN.findall(data))
+    if pages == 0:
+        # 決算短信・有報のPDFは1ページあたりおおよそ100KB前後
+        pages = max(1, len(data) // (100 * 1024))
+    return pages
+
+@metrics.timed("html_extract")
+def extract_text_from_html(data, backend=None):
+    """
+    HTMLのバイト列から本文テキストを抽出する。
+    プロセスプールからも呼ばれるため、トップレベル関数のままにしておくこと。
+
+    Args:
+        backend: "bs4" or "stream"。省略時は config.HTML_EXTRACT_BACKEND
+    """
+    if (backend or config.HTML_EXTRACT_BACKEND) == "stream":
+        # 木を作らずに少しずつ抽出する (結果はbs4と同一)
+        return "\n".join(iter_html_lines(io.BytesIO(data)))
+
+    # bs4 はこの経路でだけ使うので、使う時点で読み込む
+    from bs4 import BeautifulSoup
+
+    try:
+        html_content = data.decode("utf-8")
+    except UnicodeDecodeError:
+        html_content = data.decode("cp932")
     
-    return None
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for script_or_style in soup(["script", "style"]):
+        script_or_style.decompose()
+    text_data = soup.get_text(separator="\n") 
+    lines = [line.strip() for line in text_data.splitlines() if line.strip()]
+    return "\n".join(lines)
+
+def iter_html_lines(fileobj, on_text=None):
+    """
+    HTMLファイルを少しずつ読み、空白を除いた本文の行を順に返すジェネレータ。
+    on_text は html_text.iter_lines と同じ (読み込んだ文字列の断片ごとに呼ばれる)。
+    """
+    return html_text.iter_lines(fileobj, chunk_size=config.HTML_STREAM_CHUNK_KB * 1024, on_text=on_text)